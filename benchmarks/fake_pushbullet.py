@@ -0,0 +1,302 @@
+# coding=utf-8
+"""
+Local stand-in for the parts of the Pushbullet API the plugin uses, for testing without network access.
+
+Implements listing and creating devices, listing chats, channels and the user, the upload request
+plus the S3 style upload it points to, creating, listing (with ``modified_after``) and dismissing
+pushes, and the realtime event stream at ``/websocket/<token>``, which sends a ``nop`` every
+``--nop-interval`` seconds and a push ``tickle`` whenever a push is created or modified. Latency
+and a failure rate can be configured to simulate a slow or flaky API. ``GET /stats`` returns
+counters of what was received.
+
+Usage:
+
+    python benchmarks/fake_pushbullet.py [--port 8181] [--token secret] [--channel tag] [--latency 0.1] [--failure-rate 0.1] [--nop-interval 30]
+
+Point the plugin's or relay's API URL at ``http://127.0.0.1:<port>`` and the plugin's stream URL at
+``ws://127.0.0.1:<port>/websocket/``.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+	from urllib.parse import parse_qs
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+	from urlparse import parse_qs
+
+_WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class FakePushbulletServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, token=None, channels=None, latency=0.0, failure_rate=0.0, ratelimit=1000,
+	             nop_interval=30.0):
+		HTTPServer.__init__(self, address, _Handler)
+		self.token = token
+		self.channels = channels or []
+		self.latency = latency
+		self.failure_rate = failure_rate
+		self.ratelimit = ratelimit
+		self.nop_interval = nop_interval
+
+		self.lock = threading.Condition()
+		self.stats = dict(requests=0, uploads=0, upload_bytes=0, pushes=0, failures=0, streams=0, tickles=0)
+		self.pushes = []
+		self.devices = []
+		self.streams = []
+
+	@property
+	def url(self):
+		return "http://{}:{}".format(self.server_address[0], self.server_address[1])
+
+	def start(self):
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def count(self, key, amount=1):
+		with self.lock:
+			self.stats[key] += amount
+
+	def tickle(self):
+		# must be called with the lock held
+		for stream in self.streams:
+			stream.append(dict(type="tickle", subtype="push"))
+		self.stats["tickles"] += len(self.streams)
+		self.lock.notify_all()
+
+	def drop_streams(self):
+		"""
+		Closes all stream connections, e.g. to test reconnecting.
+		"""
+
+		with self.lock:
+			for stream in self.streams:
+				stream.append(None)
+			self.lock.notify_all()
+
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		if self.path.startswith("/websocket/"):
+			self._stream()
+			return
+
+		if not self._begin(authenticated=not self.path.startswith("/stats")):
+			return
+
+		path, _, query = self.path.partition("?")
+		if path == "/v2/devices":
+			with self.server.lock:
+				devices = list(self.server.devices)
+			self._json(dict(devices=devices))
+		elif path == "/v2/chats":
+			self._json(dict(chats=[]))
+		elif path == "/v2/users/me":
+			self._json(dict(iden="fake", name="Fake User"))
+		elif path == "/v2/channels":
+			self._json(dict(channels=[dict(iden="channel-{}".format(tag), tag=tag, name=tag, active=True)
+			                          for tag in self.server.channels]))
+		elif path == "/v2/pushes":
+			params = parse_qs(query)
+			modified_after = float(params.get("modified_after", ["0"])[0])
+			active = params.get("active", [""])[0] == "true"
+			with self.server.lock:
+				pushes = [push for push in self.server.pushes
+				          if push["modified"] > modified_after and (push["active"] or not active)]
+			# newest first, like the real thing
+			self._json(dict(pushes=sorted(pushes, key=lambda push: push["modified"], reverse=True)))
+		elif path == "/stats":
+			with self.server.lock:
+				stats = dict(self.server.stats)
+			self._json(stats)
+		else:
+			self._json(dict(error="not found"), status=404)
+
+	def do_POST(self):
+		length = int(self.headers.get("Content-Length", 0))
+		body = self.rfile.read(length) if length else b""
+
+		if not self._begin(authenticated=self.path != "/upload"):
+			return
+
+		if self.path == "/v2/upload-request":
+			request = json.loads(body.decode("utf-8"))
+			self._json(dict(file_name=request["file_name"],
+			                file_type=request["file_type"],
+			                file_url="{}/files/{}".format(self.server.url, request["file_name"]),
+			                upload_url="{}/upload".format(self.server.url),
+			                data=dict(key="fake")))
+
+		elif self.path == "/upload":
+			self.server.count("uploads")
+			self.server.count("upload_bytes", len(body))
+			self.send_response(204)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+
+		elif self.path == "/v2/devices":
+			device = json.loads(body.decode("utf-8"))
+			device.update(iden="device-{}".format(random.getrandbits(32)), active=True, created=time.time(),
+			              modified=time.time())
+			with self.server.lock:
+				self.server.devices.append(device)
+			self._json(device)
+
+		elif self.path.startswith("/v2/pushes/"):
+			iden = self.path[len("/v2/pushes/"):]
+			update = json.loads(body.decode("utf-8"))
+			with self.server.lock:
+				push = next((push for push in self.server.pushes if push["iden"] == iden), None)
+				if push is not None:
+					push.update(update)
+					push["modified"] = time.time()
+					self.server.tickle()
+			if push is None:
+				self._json(dict(error="not found"), status=404)
+			else:
+				self._json(push)
+
+		elif self.path == "/v2/pushes":
+			push = json.loads(body.decode("utf-8"))
+			push.update(iden="push-{}".format(random.getrandbits(32)), modified=time.time(), active=True,
+			            dismissed=False)
+			if "device_iden" in push:
+				push["target_device_iden"] = push.pop("device_iden")
+			with self.server.lock:
+				self.server.stats["pushes"] += 1
+				self.server.pushes.append(push)
+				self.server.tickle()
+				remaining = max(0, self.server.ratelimit - self.server.stats["pushes"])
+			self._json(push, headers={"X-Ratelimit-Limit": str(self.server.ratelimit),
+			                          "X-Ratelimit-Remaining": str(remaining),
+			                          "X-Ratelimit-Reset": str(int(time.time()) + 3600)})
+
+		else:
+			self._json(dict(error="not found"), status=404)
+
+	def log_message(self, *args):
+		pass
+
+	def _stream(self):
+		token = self.path[len("/websocket/"):]
+		key = self.headers.get("Sec-WebSocket-Key")
+		if not key or (self.server.token is not None and token != self.server.token):
+			self._json(dict(error="invalid access token"), status=401)
+			return
+
+		accept = base64.b64encode(hashlib.sha1((key + _WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+		self.send_response(101)
+		self.send_header("Upgrade", "websocket")
+		self.send_header("Connection", "Upgrade")
+		self.send_header("Sec-WebSocket-Accept", accept)
+		self.end_headers()
+		self.wfile.flush()
+		self.close_connection = True
+
+		messages = []
+		with self.server.lock:
+			self.server.streams.append(messages)
+			self.server.stats["streams"] += 1
+
+		try:
+			while True:
+				with self.server.lock:
+					if not messages:
+						self.server.lock.wait(self.server.nop_interval)
+					pending = list(messages) or [dict(type="nop")]
+					del messages[:]
+
+				for message in pending:
+					if message is None:
+						return
+					self._frame(json.dumps(message).encode("utf-8"))
+		except (IOError, OSError):
+			pass
+		finally:
+			with self.server.lock:
+				self.server.streams.remove(messages)
+
+	def _frame(self, payload):
+		# a single unmasked text frame, as sent by servers
+		if len(payload) < 126:
+			header = struct.pack("!BB", 0x81, len(payload))
+		elif len(payload) < 65536:
+			header = struct.pack("!BBH", 0x81, 126, len(payload))
+		else:
+			header = struct.pack("!BBQ", 0x81, 127, len(payload))
+		self.wfile.write(header + payload)
+		self.wfile.flush()
+
+	def _begin(self, authenticated=True):
+		self.server.count("requests")
+
+		if self.server.latency:
+			time.sleep(self.server.latency)
+
+		if authenticated and self.server.token is not None:
+			expected = "Basic " + base64.b64encode((self.server.token + ":").encode("utf-8")).decode("ascii")
+			if self.headers.get("Authorization") != expected:
+				self._json(dict(error="invalid access token"), status=401)
+				return False
+
+		if self.server.failure_rate and random.random() < self.server.failure_rate:
+			self.server.count("failures")
+			self._json(dict(error="simulated failure"), status=503)
+			return False
+
+		return True
+
+	def _json(self, data, status=200, headers=None):
+		body = json.dumps(data).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		for key, value in (headers or dict()).items():
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8181)
+	parser.add_argument("--token", help="only accept this access token")
+	parser.add_argument("--channel", action="append", default=[], help="channel tag to offer, may be repeated")
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds to delay every request")
+	parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests to fail with a 503")
+	parser.add_argument("--nop-interval", type=float, default=30.0, help="seconds between nop messages on the stream")
+	args = parser.parse_args()
+
+	server = FakePushbulletServer((args.host, args.port),
+	                              token=args.token,
+	                              channels=args.channel,
+	                              latency=args.latency,
+	                              failure_rate=args.failure_rate,
+	                              nop_interval=args.nop_interval)
+	print("Fake Pushbullet API listening on {}".format(server.url))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,178 @@
+# coding=utf-8
+"""
+Local stand-in for a webcam server like mjpg-streamer, for testing without a camera.
+
+``GET /snapshot`` returns a single JPEG, ``GET /stream`` an endless MJPEG stream
+(``multipart/x-mixed-replace``) at the configured frame rate. Latency and a failure rate can be
+configured to simulate a slow or flaky camera. ``GET /stats`` returns counters of what was served.
+
+The image is either read from the given file or generated with Pillow.
+
+Usage:
+
+    python benchmarks/fake_webcam.py [--port 8080] [--image snapshot.jpg] [--size 1920x1080] [--fps 10] [--latency 0.1] [--failure-rate 0.1]
+
+Point OctoPrint's snapshot URL at ``http://127.0.0.1:<port>/snapshot`` and its stream URL at
+``http://127.0.0.1:<port>/stream``.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import io
+import json
+import random
+import threading
+import time
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+
+
+_BOUNDARY = "fakewebcamframe"
+
+
+def generate_image(width=1920, height=1080, quality=90):
+	from PIL import Image
+
+	image = Image.new("RGB", (width, height))
+	image.putdata([((x * 7) % 256, (y * 3) % 256, ((x + y) * 5) % 256)
+	               for y in range(height) for x in range(width)])
+	output = io.BytesIO()
+	image.save(output, format="JPEG", quality=quality)
+	return output.getvalue()
+
+
+class FakeWebcamServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, image, fps=10.0, latency=0.0, failure_rate=0.0):
+		HTTPServer.__init__(self, address, _Handler)
+		self.image = image
+		self.fps = fps
+		self.latency = latency
+		self.failure_rate = failure_rate
+
+		self.lock = threading.Lock()
+		self.stats = dict(requests=0, snapshots=0, frames=0, bytes=0, failures=0)
+
+	@property
+	def url(self):
+		return "http://{}:{}".format(self.server_address[0], self.server_address[1])
+
+	@property
+	def snapshot_url(self):
+		return self.url + "/snapshot"
+
+	@property
+	def stream_url(self):
+		return self.url + "/stream"
+
+	def start(self):
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def count(self, key, amount=1):
+		with self.lock:
+			self.stats[key] += amount
+
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		self.server.count("requests")
+
+		path = self.path.split("?", 1)[0]
+		if path == "/stats":
+			with self.server.lock:
+				stats = dict(self.server.stats)
+			self._send(200, "application/json", json.dumps(stats).encode("utf-8"))
+			return
+
+		if self.server.latency:
+			time.sleep(self.server.latency)
+
+		if self.server.failure_rate and random.random() < self.server.failure_rate:
+			self.server.count("failures")
+			self._send(503, "text/plain", b"simulated failure")
+			return
+
+		if path == "/snapshot":
+			self.server.count("snapshots")
+			self.server.count("bytes", len(self.server.image))
+			self._send(200, "image/jpeg", self.server.image)
+		elif path == "/stream":
+			self._stream()
+		else:
+			self._send(404, "text/plain", b"not found")
+
+	def log_message(self, *args):
+		pass
+
+	def _stream(self):
+		self.send_response(200)
+		self.send_header("Content-Type", "multipart/x-mixed-replace; boundary={}".format(_BOUNDARY))
+		self.send_header("Connection", "close")
+		self.end_headers()
+
+		interval = 1.0 / self.server.fps if self.server.fps > 0 else 0
+		try:
+			while True:
+				image = self.server.image
+				self.wfile.write("--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n".format(_BOUNDARY,
+				                                                                                     len(image)).encode("ascii"))
+				self.wfile.write(image)
+				self.wfile.write(b"\r\n")
+				self.wfile.flush()
+				self.server.count("frames")
+				self.server.count("bytes", len(image))
+				time.sleep(interval)
+		except Exception:
+			# client went away
+			self.close_connection = True
+
+	def _send(self, status, content_type, body):
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--image", help="JPEG to serve, generated with Pillow if not given")
+	parser.add_argument("--size", default="1920x1080", help="size of the generated image")
+	parser.add_argument("--fps", type=float, default=10.0, help="frame rate of the MJPEG stream")
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds to delay every request")
+	parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests to fail with a 503")
+	args = parser.parse_args()
+
+	if args.image:
+		with open(args.image, "rb") as f:
+			image = f.read()
+	else:
+		width, height = (int(x) for x in args.size.lower().split("x"))
+		image = generate_image(width, height)
+
+	server = FakeWebcamServer((args.host, args.port), image,
+	                          fps=args.fps,
+	                          latency=args.latency,
+	                          failure_rate=args.failure_rate)
+	print("Fake webcam listening on {}, serving a {} byte image".format(server.url, len(image)))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == "__main__":
+	main()
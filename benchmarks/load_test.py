@@ -0,0 +1,302 @@
+# coding=utf-8
+"""
+Drives one or more plugin instances through simulated print jobs against a local fake Pushbullet API
+and fake webcam, and reports how the notification pipeline holds up.
+
+Every instance runs ``--jobs`` print jobs one after the other: PRINT_STARTED, a progress event for
+every percent (with milestone updates at the configured percentages) and PRINT_DONE. Reported are
+
+* the end-to-end latency from the PRINT_DONE event to its push arriving at the fake API,
+* how long OctoPrint's event and progress threads were blocked by the plugin's callbacks,
+* throughput in pushes per second,
+* bytes written to disk by the process (from ``/proc/self/io``, Linux only) and its peak RSS,
+* the plugin's own per stage timings.
+
+Usage:
+
+    python benchmarks/load_test.py [--instances 4] [--jobs 10] [--milestones 25,50,75] [--api-latency 0.05] [--webcam-latency 0.02]
+
+Run it before and after a change to compare.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import copy
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_pushbullet import FakePushbulletServer
+from fake_webcam import FakeWebcamServer, generate_image
+
+import octoprint_octobullet
+from octoprint.events import Events
+from octoprint_octobullet.clients import ClientCache
+from octoprint_octobullet.api import PooledPushBullet
+
+_TOKEN = "load-test-token"
+
+
+class Settings(object):
+	"""
+	Just enough of OctoPrint's plugin settings for the plugin to run outside of OctoPrint.
+	"""
+
+	def __init__(self, defaults, overrides, webcam):
+		self._data = copy.deepcopy(defaults)
+		for path, value in overrides.items():
+			self.set(path, value)
+		self._global = dict(webcam=webcam)
+
+	def get(self, path, **kwargs):
+		return self._walk(self._data, path)
+
+	def get_int(self, path, **kwargs):
+		value = self.get(path)
+		return int(value) if value is not None else None
+
+	def get_float(self, path, **kwargs):
+		value = self.get(path)
+		return float(value) if value is not None else None
+
+	def get_boolean(self, path, **kwargs):
+		return bool(self.get(path))
+
+	def set(self, path, value, **kwargs):
+		data = self._data
+		for key in path[:-1]:
+			data = data.setdefault(key, dict())
+		data[path[-1]] = value
+
+	def global_get(self, path, **kwargs):
+		return self._walk(self._global, path)
+
+	def global_get_boolean(self, path, **kwargs):
+		return bool(self.global_get(path))
+
+	@staticmethod
+	def _walk(data, path):
+		for key in path:
+			if not isinstance(data, dict) or key not in data:
+				return None
+			data = data[key]
+		return data
+
+
+class Printer(object):
+	def __init__(self):
+		self.path = None
+		self.progress = 0
+		self.started = None
+
+	def is_printing(self):
+		return self.path is not None
+
+	def get_current_data(self):
+		elapsed = time.time() - self.started if self.started is not None else None
+		return dict(job=dict(file=dict(path=self.path)),
+		            progress=dict(completion=self.progress,
+		                          printTime=elapsed,
+		                          printTimeLeft=3600 * (100 - self.progress) / 100.0))
+
+
+class PluginManager(object):
+	def send_plugin_message(self, plugin, data):
+		pass
+
+
+class Instance(object):
+	def __init__(self, index, api, webcam, data_folder, overrides):
+		self.index = index
+		self.printer = Printer()
+
+		plugin = octoprint_octobullet.PushbulletPlugin()
+		plugin._identifier = "octobullet"
+		plugin._plugin_version = "load-test"
+		plugin._logger = logging.getLogger("octobullet.{}".format(index))
+		plugin._data_folder = data_folder
+		plugin._printer = self.printer
+		plugin._plugin_manager = PluginManager()
+		plugin._settings = Settings(plugin.get_settings_defaults(),
+		                            overrides,
+		                            dict(snapshot=webcam.snapshot_url, flipH=False, flipV=False, rotate90=False,
+		                                 ffmpeg=None))
+		plugin.initialize()
+
+		# talk to the fake API instead of the real one
+		plugin._clients = ClientCache(lambda token: PooledPushBullet(token, pool=plugin._connections, api_url=api.url),
+		                              logger=plugin._logger)
+		plugin.on_after_startup()
+
+		self.plugin = plugin
+		self.blocked = []
+		self.done = dict()
+
+	def run(self, jobs, step_delay):
+		for job in range(jobs):
+			path = "instance{}-job{}.gcode".format(self.index, job)
+
+			self.printer.path = path
+			self.printer.progress = 0
+			self.printer.started = time.time()
+			self._call(self.plugin.on_event, Events.PRINT_STARTED, dict(name=path, path=path))
+
+			for progress in range(1, 101):
+				self.printer.progress = progress
+				self._call(self.plugin.on_print_progress, "local", path, progress)
+				if step_delay:
+					time.sleep(step_delay)
+
+			self.printer.path = None
+			self.done[path] = time.time()
+			self._call(self.plugin.on_event, Events.PRINT_DONE, dict(name=path, path=path, time=3600))
+
+	def shutdown(self):
+		self.plugin.on_shutdown()
+
+	def _call(self, callback, *args):
+		start = time.time()
+		callback(*args)
+		self.blocked.append(time.time() - start)
+
+
+def percentile(values, fraction):
+	if not values:
+		return float("nan")
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def disk_write_bytes():
+	try:
+		with open("/proc/self/io") as f:
+			for line in f:
+				if line.startswith("write_bytes:"):
+					return int(line.split(":", 1)[1])
+	except IOError:
+		pass
+	return None
+
+
+def peak_rss():
+	try:
+		import resource
+	except ImportError:
+		return None
+	# kilobytes on Linux, bytes on macOS
+	usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return usage if sys.platform == "darwin" else usage * 1024
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--instances", type=int, default=4, help="plugin instances to run in parallel")
+	parser.add_argument("--jobs", type=int, default=10, help="print jobs per instance")
+	parser.add_argument("--step-delay", type=float, default=0.001, help="seconds between progress events")
+	parser.add_argument("--milestones", default="25,50,75", help="progress percentages to push updates at")
+	parser.add_argument("--workers", type=int, default=1, help="dispatcher workers per instance")
+	parser.add_argument("--digest-window", type=float, default=0, help="digest window in seconds, 0 to disable")
+	parser.add_argument("--api-latency", type=float, default=0.05)
+	parser.add_argument("--api-failure-rate", type=float, default=0.0)
+	parser.add_argument("--webcam-latency", type=float, default=0.02)
+	parser.add_argument("--webcam-failure-rate", type=float, default=0.0)
+	parser.add_argument("--image-size", default="1280x720", help="size of the fake webcam's image")
+	parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for all pushes to arrive")
+	parser.add_argument("--verbose", action="store_true")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARN)
+
+	width, height = (int(x) for x in args.image_size.lower().split("x"))
+	api = FakePushbulletServer(("127.0.0.1", 0), token=_TOKEN,
+	                           latency=args.api_latency,
+	                           failure_rate=args.api_failure_rate).start()
+	webcam = FakeWebcamServer(("127.0.0.1", 0), generate_image(width, height),
+	                          latency=args.webcam_latency,
+	                          failure_rate=args.webcam_failure_rate).start()
+
+	overrides = {("access_token",): _TOKEN,
+	             ("periodic_updates",): bool(args.milestones),
+	             ("periodic_updates_interval",): 0,
+	             ("periodic_updates_milestones",): args.milestones,
+	             ("dispatch", "workers"): args.workers,
+	             ("digest", "window"): args.digest_window}
+
+	data_folder = tempfile.mkdtemp(prefix="octobullet-load-test-")
+	try:
+		instances = []
+		for index in range(args.instances):
+			folder = os.path.join(data_folder, str(index))
+			os.makedirs(folder)
+			instances.append(Instance(index, api, webcam, folder, overrides))
+
+		written_before = disk_write_bytes()
+		start = time.time()
+
+		threads = [threading.Thread(target=instance.run, args=(args.jobs, args.step_delay)) for instance in instances]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		# wait for the done pushes to arrive
+		expected = dict()
+		for instance in instances:
+			expected.update(instance.done)
+
+		arrived = dict()
+		deadline = time.time() + args.timeout
+		while len(arrived) < len(expected) and time.time() < deadline:
+			with api.lock:
+				pushes = list(api.pushes)
+			for push in pushes:
+				text = "{} {}".format(push.get("title") or "", push.get("body") or "")
+				for path in expected:
+					if path not in arrived and path + " " in text:
+						arrived[path] = push["modified"]
+			time.sleep(0.05)
+
+		elapsed = time.time() - start
+		written_after = disk_write_bytes()
+
+		for instance in instances:
+			instance.shutdown()
+	finally:
+		shutil.rmtree(data_folder, ignore_errors=True)
+
+	latencies = [arrived[path] - expected[path] for path in arrived]
+	blocked = [value for instance in instances for value in instance.blocked]
+	pushes = api.stats["pushes"]
+
+	print("Instances:            {} with {} print jobs each".format(args.instances, args.jobs))
+	print("Done pushes:          {} of {} arrived".format(len(arrived), len(expected)))
+	print("Pushes:               {} in {:.2f}s, {:.1f} pushes/s".format(pushes, elapsed, pushes / elapsed))
+	print("Uploads:              {}, {} bytes".format(api.stats["uploads"], api.stats["upload_bytes"]))
+	print("End-to-end latency:   p50 {:.3f}s, p95 {:.3f}s, max {:.3f}s".format(percentile(latencies, 0.5),
+	                                                                          percentile(latencies, 0.95),
+	                                                                          max(latencies) if latencies else float("nan")))
+	print("Event thread blocked: mean {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms over {} callbacks".format(
+		1000 * sum(blocked) / len(blocked), 1000 * percentile(blocked, 0.99), 1000 * max(blocked), len(blocked)))
+
+	if written_before is not None and written_after is not None:
+		print("Written to disk:      {} bytes".format(written_after - written_before))
+	rss = peak_rss()
+	if rss is not None:
+		print("Peak RSS:             {:.1f} MiB".format(rss / 1024.0 / 1024.0))
+
+	print("Stage means:")
+	for stage in ("queue", "fetch", "transform", "upload", "push"):
+		count = sum(instance.plugin._metrics.as_dict()["stages"][stage]["count"] for instance in instances)
+		total = sum(instance.plugin._metrics.as_dict()["stages"][stage]["sum"] for instance in instances)
+		print("  {:10s} {:8.3f}ms over {} calls".format(stage, 1000 * total / count if count else 0, count))
+
+
+if __name__ == "__main__":
+	main()
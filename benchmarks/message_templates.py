@@ -0,0 +1,114 @@
+# coding=utf-8
+"""
+Compares rendering notification messages the old way (looking the templates up in OctoPrint's
+settings and formatting them with every placeholder computed up front) with the precompiled
+templates that only evaluate the placeholders they reference.
+
+Simulates a stream of progress and print done events of ``--printers`` printers, using OctoPrint's
+real settings implementation on a temporary configuration.
+
+Usage:
+
+    python benchmarks/message_templates.py [--printers 1000] [--updates 10] [--body "{progress}% on {file}"]
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import octoprint.settings
+from octoprint.plugin import PluginSettings
+
+import octoprint_octobullet
+from octoprint_octobullet import _get_time_from_seconds, _get_eta_from_seconds, _MESSAGE_PLACEHOLDERS
+from octoprint_octobullet.messages import MessageTemplate
+
+
+def events(printers, updates):
+	for update in range(1, updates + 1):
+		for printer in range(printers):
+			yield "printProgress", dict(path="printer{}.gcode".format(printer),
+			                            progress=100 * update // (updates + 1),
+			                            elapsed=600 * update,
+			                            remaining=600 * (updates + 1 - update))
+	for printer in range(printers):
+		yield "printDone", dict(path="printer{}.gcode".format(printer),
+		                        elapsed=600 * (updates + 1))
+
+
+def legacy(settings, stream):
+	for message, event in stream:
+		if message == "printDone":
+			placeholders = dict(file=event["path"],
+			                    elapsed_time=_get_time_from_seconds(event["elapsed"], default="?"))
+		else:
+			placeholders = dict(progress=event["progress"],
+			                    file=event["path"],
+			                    elapsed_time=_get_time_from_seconds(event["elapsed"], default="?"),
+			                    remaining_time=_get_time_from_seconds(event["remaining"], default="?"),
+			                    eta=_get_eta_from_seconds(event["remaining"], default="?"))
+
+		settings.get([message, "title"]).format(**placeholders)
+		settings.get([message, "body"]).format(**placeholders)
+
+
+def compiled(settings, stream):
+	templates = dict((message[-1], (MessageTemplate(settings.get(list(message) + ["title"]), placeholders=placeholders),
+	                                MessageTemplate(settings.get(list(message) + ["body"]), placeholders=placeholders)))
+	                 for message, placeholders in _MESSAGE_PLACEHOLDERS.items())
+
+	for message, event in stream:
+		if message == "printDone":
+			placeholders = dict(file=event["path"],
+			                    elapsed_time=lambda: _get_time_from_seconds(event["elapsed"], default="?"))
+		else:
+			placeholders = dict(progress=event["progress"],
+			                    file=event["path"],
+			                    elapsed_time=lambda: _get_time_from_seconds(event["elapsed"], default="?"),
+			                    remaining_time=lambda: _get_time_from_seconds(event["remaining"], default="?"),
+			                    eta=lambda: _get_eta_from_seconds(event["remaining"], default="?"))
+
+		title, body = templates[message]
+		title.render(placeholders)
+		body.render(placeholders)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--printers", type=int, default=1000)
+	parser.add_argument("--updates", type=int, default=10, help="progress updates per printer")
+	parser.add_argument("--runs", type=int, default=5)
+	parser.add_argument("--body", help="progress body template to use instead of the default")
+	args = parser.parse_args()
+
+	basedir = tempfile.mkdtemp(prefix="octobullet-templates-")
+	try:
+		defaults = octoprint_octobullet.PushbulletPlugin().get_settings_defaults()
+		settings = PluginSettings(octoprint.settings.settings(init=True, basedir=basedir), "octobullet",
+		                          defaults=defaults)
+		if args.body:
+			settings.set(["printProgress", "body"], args.body)
+
+		stream = list(events(args.printers, args.updates))
+		print("{} events from {} printers, best of {} runs".format(len(stream), args.printers, args.runs))
+
+		for name, func in (("legacy", legacy), ("compiled", compiled)):
+			durations = []
+			for _ in range(args.runs):
+				start = time.time()
+				func(settings, stream)
+				durations.append(time.time() - start)
+			best = min(durations)
+			print("{:10s} {:8.3f}s total, {:8.2f}us per event".format(name, best, 1000000 * best / len(stream)))
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
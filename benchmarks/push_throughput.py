@@ -0,0 +1,127 @@
+# coding=utf-8
+"""
+Compares how many pushes per second the threaded and the asyncio delivery backend get through.
+
+A single plugin instance is handed ``--pushes`` notifications at once and the time until all of
+them have arrived at a local fake Pushbullet API, which answers every request after
+``--api-latency`` seconds, is measured. With ``--snapshots`` every notification also fetches a
+snapshot from a local fake webcam and uploads it, otherwise they are plain notes.
+
+Usage:
+
+    python benchmarks/push_throughput.py [--pushes 200] [--api-latency 0.05] [--workers 1] [--concurrency 16] [--snapshots]
+
+The asyncio backend needs Python 3 and aiohttp.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_pushbullet import FakePushbulletServer
+from fake_webcam import FakeWebcamServer, generate_image
+from load_test import Settings, Printer, PluginManager
+
+import octoprint_octobullet
+from octoprint_octobullet.api import PooledPushBullet
+from octoprint_octobullet.clients import ClientCache
+from octoprint_octobullet.dispatch import NotificationJob, JOB_ALERT
+
+_TOKEN = "push-throughput-token"
+
+
+def run(backend, args, webcam):
+	api = FakePushbulletServer(("127.0.0.1", 0), token=_TOKEN, latency=args.api_latency,
+	                           ratelimit=1000000).start()
+	data_folder = tempfile.mkdtemp(prefix="octobullet-push-throughput-")
+	try:
+		plugin = octoprint_octobullet.PushbulletPlugin()
+		plugin._identifier = "octobullet"
+		plugin._plugin_version = "push-throughput"
+		plugin._logger = logging.getLogger("octobullet.{}".format(backend))
+		plugin._data_folder = data_folder
+		plugin._printer = Printer()
+		plugin._plugin_manager = PluginManager()
+		plugin._settings = Settings(plugin.get_settings_defaults(),
+		                            {("access_token",): _TOKEN,
+		                             ("dispatch", "backend"): backend,
+		                             ("dispatch", "workers"): args.workers,
+		                             ("dispatch", "concurrency"): args.concurrency,
+		                             ("connection", "pool_size"): max(args.workers, args.concurrency),
+		                             ("outbox", "enabled"): False},
+		                            dict(snapshot=webcam.snapshot_url if webcam is not None else None,
+		                                 flipH=False, flipV=False, rotate90=False, ffmpeg=None))
+		plugin.initialize()
+		plugin._clients = ClientCache(lambda token: PooledPushBullet(token, pool=plugin._connections, api_url=api.url),
+		                              logger=plugin._logger)
+		plugin.on_after_startup()
+		plugin._reconnector.wait(timeout=10)
+		if backend != "threads":
+			# not part of the measurement
+			plugin._get_async_backend()
+
+		baseline = api.stats["pushes"]
+		start = time.time()
+		for index in range(args.pushes):
+			plugin._dispatcher.submit(NotificationJob("Push {}".format(index), "Benchmark",
+			                                          filename="push-{}.jpg".format(index),
+			                                          kind=JOB_ALERT,
+			                                          snapshot=webcam is not None))
+
+		deadline = start + args.timeout
+		while api.stats["pushes"] - baseline < args.pushes and time.time() < deadline:
+			time.sleep(0.005)
+		elapsed = time.time() - start
+		arrived = api.stats["pushes"] - baseline
+
+		plugin.on_shutdown()
+		counters = plugin._metrics.as_dict()["counters"]
+		return arrived, elapsed, counters
+	finally:
+		api.shutdown()
+		shutil.rmtree(data_folder, ignore_errors=True)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--pushes", type=int, default=200, help="notifications to send per backend")
+	parser.add_argument("--backends", default="threads,asyncio", help="comma separated backends to compare")
+	parser.add_argument("--workers", type=int, default=1, help="dispatcher workers")
+	parser.add_argument("--concurrency", type=int, default=16, help="pushes in flight at once on the asyncio backend")
+	parser.add_argument("--api-latency", type=float, default=0.05)
+	parser.add_argument("--snapshots", action="store_true", help="attach a webcam snapshot to every push")
+	parser.add_argument("--webcam-latency", type=float, default=0.02)
+	parser.add_argument("--image-size", default="1280x720", help="size of the fake webcam's image")
+	parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for all pushes to arrive")
+	parser.add_argument("--verbose", action="store_true")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARN)
+
+	webcam = None
+	if args.snapshots:
+		width, height = (int(x) for x in args.image_size.lower().split("x"))
+		webcam = FakeWebcamServer(("127.0.0.1", 0), generate_image(width, height),
+		                          latency=args.webcam_latency).start()
+
+	print("{} pushes, API latency {:.0f}ms, {}, {} dispatcher worker(s)".format(args.pushes,
+	                                                                             1000 * args.api_latency,
+	                                                                             "with snapshots" if webcam else "notes only",
+	                                                                             args.workers))
+	for backend in args.backends.split(","):
+		arrived, elapsed, counters = run(backend.strip(), args, webcam)
+		label = backend if backend != "asyncio" else "asyncio ({} in flight)".format(args.concurrency)
+		print("  {:24s} {:4d} arrived in {:6.2f}s, {:7.1f} pushes/s, {} failed, {} sent as notes".format(
+			label, arrived, elapsed, arrived / elapsed, counters.get("failed", 0), counters.get("note_fallback", 0)))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,92 @@
+# coding=utf-8
+"""
+Compares the per notification cost of the old temporary file based snapshot handling with the
+in-memory pipeline.
+
+The upload is simulated by reading the file object handed to ``upload_file`` to its end, just
+like requests does when building the multipart body.
+
+Usage:
+
+    python benchmarks/snapshot_pipeline.py [--ffmpeg /usr/bin/ffmpeg] [--runs 50] image.jpg
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from octoprint_octobullet.snapshot import ffmpeg_filters, transform_with_ffmpeg
+
+
+def legacy(data, ffmpeg, filters):
+	written = 0
+
+	temp = tempfile.NamedTemporaryFile(delete=False)
+	temp.write(data)
+	temp.close()
+	written += len(data)
+
+	path = temp.name + ".jpg"
+	os.rename(temp.name, path)
+
+	if ffmpeg and filters:
+		import sarge
+		sarge.run([ffmpeg, "-y", "-loglevel", "error", "-i", path, "-vf", ",".join(filters), path],
+		          stdout=sarge.Capture(), stderr=sarge.Capture())
+		written += os.stat(path).st_size
+
+	with open(path, "rb") as f:
+		f.read()
+	os.remove(path)
+
+	return written
+
+
+def in_memory(data, ffmpeg, filters):
+	if ffmpeg and filters:
+		data = transform_with_ffmpeg(ffmpeg, data, filters)
+	io.BytesIO(data).read()
+	return 0
+
+
+def run(name, func, data, ffmpeg, filters, runs):
+	durations = []
+	written = 0
+	for _ in range(runs):
+		start = time.time()
+		written += func(data, ffmpeg, filters)
+		durations.append(time.time() - start)
+
+	durations.sort()
+	print("{:<10} median {:8.2f}ms  p95 {:8.2f}ms  bytes written/notification {:>10}".format(
+		name,
+		durations[len(durations) // 2] * 1000,
+		durations[int(len(durations) * 0.95) - 1] * 1000,
+		written // runs))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("image", help="JPEG to use as snapshot")
+	parser.add_argument("--ffmpeg", help="ffmpeg binary, if set snapshots get rotated and flipped")
+	parser.add_argument("--runs", type=int, default=50)
+	args = parser.parse_args()
+
+	with open(args.image, "rb") as f:
+		data = f.read()
+
+	filters = ffmpeg_filters(hflip=True, vflip=True, rotate=True) if args.ffmpeg else []
+
+	print("Snapshot of {} bytes, {} runs, transform: {}".format(len(data), args.runs, ",".join(filters) or "none"))
+	run("legacy", legacy, data, args.ffmpeg, filters, args.runs)
+	run("in-memory", in_memory, data, args.ffmpeg, filters, args.runs)
+
+
+if __name__ == "__main__":
+	main()
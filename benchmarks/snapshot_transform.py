@@ -0,0 +1,58 @@
+# coding=utf-8
+"""
+Measures the per snapshot cost of flipping and rotating a snapshot with each transform backend.
+
+Usage:
+
+    python benchmarks/snapshot_transform.py [--ffmpeg /usr/bin/ffmpeg] [--runs 20] image.jpg
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from octoprint_octobullet.snapshot import ffmpeg_filters, transform_with_ffmpeg, transform_with_pillow, \
+	pillow_available
+
+
+def run(name, func, runs):
+	durations = []
+	for _ in range(runs):
+		start = time.time()
+		func()
+		durations.append(time.time() - start)
+
+	durations.sort()
+	print("{:<8} median {:8.2f}ms  p95 {:8.2f}ms".format(name,
+	                                                     durations[len(durations) // 2] * 1000,
+	                                                     durations[int(len(durations) * 0.95) - 1] * 1000))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("image", help="JPEG to use as snapshot")
+	parser.add_argument("--ffmpeg", help="ffmpeg binary to compare against")
+	parser.add_argument("--runs", type=int, default=20)
+	args = parser.parse_args()
+
+	with open(args.image, "rb") as f:
+		data = f.read()
+
+	print("Snapshot of {} bytes, {} runs, flipH + flipV + rotate90".format(len(data), args.runs))
+
+	if pillow_available():
+		run("pillow", lambda: transform_with_pillow(data, hflip=True, vflip=True, rotate=True), args.runs)
+	else:
+		print("pillow   not installed")
+
+	if args.ffmpeg:
+		filters = ffmpeg_filters(hflip=True, vflip=True, rotate=True)
+		run("ffmpeg", lambda: transform_with_ffmpeg(args.ffmpeg, data, filters), args.runs)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,108 @@
+# coding=utf-8
+"""
+Measures how long uploading a snapshot takes over a throttled uplink, depending on the webcam's
+resolution and the plugin's size limits.
+
+Synthetic snapshots are generated for a couple of common webcam resolutions, processed the same
+way the plugin does before uploading and then posted to a local server that reads the upload at
+the given bandwidth.
+
+Usage:
+
+    python benchmarks/snapshot_upload.py [--bandwidth 1000] [--max-size 1280] [--quality 85]
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import io
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import requests
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from PIL import Image
+
+from octoprint_octobullet.snapshot import transform_with_pillow
+
+
+RESOLUTIONS = [("480p", (640, 480)), ("720p", (1280, 720)), ("1080p", (1920, 1080)), ("4K", (3840, 2160))]
+
+
+def throttled_server(bandwidth):
+	bytes_per_second = bandwidth * 1000 / 8.0
+
+	class Handler(BaseHTTPRequestHandler):
+		def do_POST(self):
+			remaining = int(self.headers["Content-Length"])
+			start = time.time()
+			received = 0
+			while remaining:
+				chunk = self.rfile.read(min(remaining, 16 * 1024))
+				remaining -= len(chunk)
+				received += len(chunk)
+				delay = start + received / bytes_per_second - time.time()
+				if delay > 0:
+					time.sleep(delay)
+			self.send_response(204)
+			self.end_headers()
+
+		def log_message(self, *args):
+			pass
+
+	server = HTTPServer(("127.0.0.1", 0), Handler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server
+
+
+def snapshot(size):
+	image = Image.effect_noise(size, 40).convert("RGB")
+	output = io.BytesIO()
+	image.save(output, format="JPEG", quality=95)
+	return output.getvalue()
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--bandwidth", type=int, default=1000, help="uplink bandwidth in kbit/s")
+	parser.add_argument("--max-size", type=int, default=1280, help="max width and height, 0 for no limit")
+	parser.add_argument("--quality", type=int, default=85)
+	args = parser.parse_args()
+
+	server = throttled_server(args.bandwidth)
+	url = "http://127.0.0.1:{}/upload".format(server.server_port)
+	session = requests.Session()
+
+	print("Uplink {} kbit/s, max size {}, quality {}".format(args.bandwidth, args.max_size or "unlimited", args.quality))
+	for name, size in RESOLUTIONS:
+		original = snapshot(size)
+
+		start = time.time()
+		processed = transform_with_pillow(original, max_width=args.max_size, max_height=args.max_size,
+		                                  quality=args.quality)
+		processing = time.time() - start
+
+		results = []
+		for data in (original, processed):
+			start = time.time()
+			session.post(url, files={"file": ("snapshot.jpg", io.BytesIO(data), "image/jpeg")})
+			results.append((len(data), time.time() - start))
+
+		print("{:<6} as-is {:>9} bytes in {:6.2f}s, processed {:>9} bytes in {:6.2f}s (+{:.0f}ms processing)".format(
+			name, results[0][0], results[0][1], results[1][0], results[1][1], processing * 1000))
+
+	server.shutdown()
+
+
+if __name__ == "__main__":
+	main()
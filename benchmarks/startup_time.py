@@ -0,0 +1,128 @@
+# coding=utf-8
+"""
+Measures what the plugin adds to OctoPrint's import and startup time.
+
+Import time is measured in fresh interpreters that have already imported everything OctoPrint
+itself has loaded by the time it gets to its plugins, so only the plugin's own share is counted,
+together with the top level modules only the plugin pulls in. Startup time is the time
+``initialize`` and ``on_after_startup`` block OctoPrint's startup against a local fake Pushbullet
+API answering every request after ``--api-latency`` seconds, plus the time until the plugin is
+connected and ready to push.
+
+Usage:
+
+    python benchmarks/startup_time.py [--runs 10] [--api-latency 0.2]
+
+Run it before and after a change to compare.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_pushbullet import FakePushbulletServer
+from load_test import Settings, Printer, PluginManager
+
+import octoprint_octobullet
+from octoprint_octobullet.api import PooledPushBullet
+from octoprint_octobullet.clients import ClientCache
+
+_TOKEN = "startup-token"
+
+_IMPORT_SCRIPT = """
+import sys, time
+sys.path.insert(0, {root!r})
+
+# already loaded by OctoPrint by the time plugins are imported
+import flask, flask_login, requests, sarge
+import octoprint.events, octoprint.plugin, octoprint.server, octoprint.util
+
+before = set(sys.modules)
+start = time.time()
+import octoprint_octobullet
+print(time.time() - start)
+print(" ".join(sorted(set(name.split(".")[0] for name in set(sys.modules) - before) - set(["octoprint_octobullet"]))))
+"""
+
+
+def measure_import(runs):
+	script = _IMPORT_SCRIPT.format(root=os.path.abspath(_ROOT))
+	durations = []
+	modules = ""
+	for _ in range(runs):
+		output = subprocess.check_output([sys.executable, "-c", script]).decode("utf-8").splitlines()
+		durations.append(float(output[0]))
+		modules = output[1] if len(output) > 1 else ""
+	return durations, modules
+
+
+def measure_startup(api, data_folder):
+	plugin = octoprint_octobullet.PushbulletPlugin()
+	plugin._identifier = "octobullet"
+	plugin._plugin_version = "startup"
+	plugin._logger = logging.getLogger("octobullet")
+	plugin._data_folder = data_folder
+	plugin._printer = Printer()
+	plugin._plugin_manager = PluginManager()
+	plugin._settings = Settings(plugin.get_settings_defaults(),
+	                            {("access_token",): _TOKEN},
+	                            dict(snapshot=None, flipH=False, flipV=False, rotate90=False, ffmpeg=None))
+
+	start = time.time()
+	plugin.initialize()
+	initialized = time.time()
+
+	# talk to the fake API instead of the real one
+	plugin._clients = ClientCache(lambda token: PooledPushBullet(token, pool=plugin._connections, api_url=api.url),
+	                              logger=plugin._logger)
+
+	plugin.on_after_startup()
+	started = time.time()
+
+	while plugin._sender is None and time.time() - started < 30:
+		time.sleep(0.001)
+	connected = time.time()
+
+	plugin.on_shutdown()
+	return initialized - start, started - initialized, connected - start
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--runs", type=int, default=10)
+	parser.add_argument("--api-latency", type=float, default=0.2, help="seconds the fake API takes per request")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARN)
+
+	durations, modules = measure_import(args.runs)
+	print("Import:           median {:.1f}ms, min {:.1f}ms over {} fresh interpreters".format(
+		1000 * sorted(durations)[len(durations) // 2], 1000 * min(durations), len(durations)))
+	print("Modules pulled in: {}".format(modules or "-"))
+
+	api = FakePushbulletServer(("127.0.0.1", 0), token=_TOKEN, latency=args.api_latency).start()
+	data_folder = tempfile.mkdtemp(prefix="octobullet-startup-")
+	try:
+		results = [measure_startup(api, data_folder) for _ in range(args.runs)]
+	finally:
+		shutil.rmtree(data_folder, ignore_errors=True)
+
+	for index, name in enumerate(("initialize", "on_after_startup", "until connected")):
+		values = sorted(result[index] for result in results)
+		print("{:17s} median {:.1f}ms, max {:.1f}ms".format(name + ":", 1000 * values[len(values) // 2],
+		                                                       1000 * values[-1]))
+
+
+if __name__ == "__main__":
+	main()
@@ -6,9 +6,15 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 __copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
 __plugin_pythoncompat__ = ">=2.7,<4"
 
+import functools
+import io
+import mimetypes
 import os
-
+import random
+import string
+import threading
 import time
+
 import octoprint.util
 import octoprint.plugin
 
@@ -16,12 +22,28 @@ from octoprint.events import Events
 from octoprint.server import admin_permission
 from flask_login import current_user
 
-import pushbullet
 import flask
-import datetime
-import sarge
-import collections
-import threading
+import requests
+
+from .cameras import Camera, CapturePool, NoSnapshotError, parse_cameras
+from .clients import ClientCache, Reconnector
+from .connections import ConnectionPool
+from .metrics import Metrics, STAGE_QUEUE, STAGE_FETCH, STAGE_TRANSFORM, STAGE_UPLOAD, STAGE_PUSH, \
+	COUNTER_DELIVERED, COUNTER_FAILED, COUNTER_NOTE_FALLBACK, COUNTER_RATELIMIT_DEGRADED, COUNTER_RATELIMIT_SKIPPED, \
+	COUNTER_CAMERA_DROPPED
+from .ratelimit import ADMIT_FULL, ADMIT_SKIP, PRIORITY_NORMAL, PRIORITY_HIGH, PRIORITY_NAMES
+from .grabber import FrameGrabber, NoFrameError
+from .history import DeliveryHistory, DeliveryRecord, STATUSES, STATUS_DELIVERED, STATUS_NOTE, STATUS_FAILED, \
+	STATUS_SKIPPED
+from .dispatch import NotificationDispatcher, NotificationJob, DigestCollector, JOB_DONE, JOB_PROGRESS, JOB_DIGEST, \
+	JOB_MOVIE, JOB_ALERT, JOB_REPLY, BACKEND_ASYNCIO
+from .listener import StreamListener, parse_command, DEFAULT_STREAM_URL
+from .outbox import Outbox
+from .scheduler import ProgressScheduler, parse_milestones
+from .messages import MessageTemplate, TemplateError
+from .snapshot import SnapshotCache, SnapshotTransformError, fetch_snapshot, jpeg_dimensions, ffmpeg_filters, \
+	transform_with_ffmpeg, transform_with_pillow, composite_with_pillow, pillow_available, TRANSFORM_AUTO, \
+	TRANSFORM_PILLOW, TRANSFORM_FFMPEG
 
 
 _TIME_REMAINING_FORMAT = "{hours:d}h {minutes:d}min"
@@ -29,6 +51,43 @@ _TIME_DAYS_REMAINING_FORMAT = "{days:d}d {hours:d}h {minutes:d}min"
 _ETA_STRFTIME = "%H:%M"
 _ETA_DAYS_STRFTIME = "%Y-%m-%d %H:%M"
 _PERIODIC_FILENAME_FORMAT = "{name}-{progress}.jpg"
+_HISTORY_FILENAME = "history.jsonl"
+_DIGEST_TITLE_FORMAT = "{count} print jobs finished"
+
+# seconds to wait for further settings saves before reconnecting
+_RECONNECT_DELAY = 1.0
+
+_CONNECTION_CONNECTED = "connected"
+_CONNECTION_UNCONFIGURED = "unconfigured"
+_CONNECTION_CHANNEL = "channel"
+_CONNECTION_APIKEY = "apikey"
+_CONNECTION_ERROR = "error"
+
+# any OctoPrint event can be configured to send a notification under events.<event name>, except for
+# these which come with messages of their own
+_OWN_MESSAGE_EVENTS = (Events.PRINT_DONE, Events.MOVIE_DONE)
+
+# further conditions for an event to send a notification, a cancelled print also fires PRINT_FAILED
+_ALERT_FILTERS = {Events.PRINT_FAILED: lambda payload: payload.get("reason") != "cancelled"}
+
+# title and body of an event notification whose configured templates are invalid and that has no defaults
+_ALERT_FALLBACK_TEMPLATES = ("{event}", "")
+
+# placeholders available in the title and body templates of each message, by settings path, the
+# templates of event notifications may use any key of the event's payload instead
+_MESSAGE_PLACEHOLDERS = {("printDone",): ("file", "elapsed_time"),
+                         ("movieDone",): ("file", "movie"),
+                         ("printProgress",): ("progress", "file", "elapsed_time", "remaining_time", "eta")}
+
+# commands that can be sent to the plugin's Pushbullet device, see commands.allowed
+_COMMAND_STATUS = "status"
+_COMMAND_SNAPSHOT = "snapshot"
+_COMMAND_PAUSE = "pause"
+_COMMAND_RESUME = "resume"
+_COMMAND_CANCEL = "cancel"
+
+_STREAM_CURSOR_FILENAME = "stream_cursor.json"
+_SNAPSHOT_FILENAME_FORMAT = "snapshot-{timestamp}.jpg"
 
 _SECONDS_PER_DAY = 86400
 _SECONDS_PER_HOUR = 3600
@@ -65,6 +124,40 @@ def _get_time_from_seconds(seconds, default=None):
 		return _TIME_REMAINING_FORMAT.format(**locals())
 
 
+def _get_movie_type(path):
+	"""
+	Tests:
+
+		>>> _get_movie_type("/timelapse/test_20240101.mp4")
+		'video/mp4'
+		>>> _get_movie_type("/timelapse/test_20240101")
+		'video/mpeg'
+	"""
+
+	movie_type, _ = mimetypes.guess_type(path)
+	return movie_type if movie_type else "video/mpeg"
+
+
+def _get_camera_filename(filename, camera):
+	"""
+	Tests:
+
+		>>> _get_camera_filename("benchy-50.jpg", None)
+		'benchy-50.jpg'
+		>>> _get_camera_filename("benchy-50.jpg", "nozzle")
+		'benchy-50-nozzle.jpg'
+	"""
+
+	if camera is None:
+		return filename
+	root, ext = os.path.splitext(filename)
+	return "{}-{}{}".format(root, camera, ext)
+
+
+def _get_random_filename():
+	return "test-{}.jpg".format("".join([random.choice(string.ascii_letters) for _ in range(16)]))
+
+
 def _get_eta_from_seconds(seconds, default=None):
 	if seconds is None:
 		return default
@@ -85,6 +178,7 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
                        octoprint.plugin.ProgressPlugin,
                        octoprint.plugin.SettingsPlugin,
                        octoprint.plugin.StartupPlugin,
+                       octoprint.plugin.ShutdownPlugin,
                        octoprint.plugin.TemplatePlugin,
                        octoprint.plugin.SimpleApiPlugin,
                        octoprint.plugin.AssetPlugin):
@@ -93,22 +187,116 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 		self._bullet = None
 		self._channel = None
 		self._sender = None
+		self._connection_status = None
+		self._reconnector = None
 
 		self._periodic_updates = False
 		self._periodic_updates_interval = 0
-		self._next_message = None
-
-		self._periodic_updates_lock = threading.RLock()
+		self._periodic_updates_milestones = []
+		self._scheduler = None
+
+		self._dispatcher = None
+		self._aio = None
+		self._aio_lock = threading.Lock()
+		self._aio_unavailable = False
+		self._connections = None
+		self._clients = None
+		self._outbox = None
+		self._snapshots = None
+		self._grabber = None
+		self._cameras = []
+		self._capture = None
+		self._relay = None
+		self._listener = None
+		self._listener_key = None
+		self._command_device = None
+		self._digest = None
+		self._digest_saved = 0
+		self._history = None
+		self._delivery = threading.local()
+
+		self._uploads = 0
+		self._uploaded_bytes = 0
+		self._metrics = Metrics()
+		self._templates = dict()
+		self._routes = dict()
+		self._alerts = dict()
+
+	def initialize(self):
+		self._compile_templates()
+		self._build_routes()
+
+		self._connections = ConnectionPool(pool_size=self._settings.get_int(["connection", "pool_size"]),
+		                                   webcam_timeout=self._get_timeout("webcam"),
+		                                   api_timeout=self._get_timeout("api"),
+		                                   logger=self._logger)
+		self._snapshots = SnapshotCache(ttl=self._settings.get_float(["snapshot", "cache_ttl"]),
+		                                max_bytes=self._settings.get_int(["snapshot", "cache_max_bytes"]))
+		self._configure_ratelimit()
+		self._clients = ClientCache(self._create_client,
+		                            ttl=self._settings.get_int(["connection", "client_ttl"]),
+		                            logger=self._logger)
+
+		self._configure_relay()
+		self._configure_grabber()
+		self._configure_cameras()
+		self._configure_history()
+
+		self._reconnector = Reconnector(self._create_connection, self._apply_connection,
+		                                delay=_RECONNECT_DELAY, logger=self._logger)
+		self._reconnector.start()
+
+		self._dispatcher = NotificationDispatcher(self._deliver_job,
+		                                          queue_size=self._settings.get_int(["dispatch", "queue_size"]),
+		                                          workers=self._settings.get_int(["dispatch", "workers"]),
+		                                          rejected=self._keep_for_retry,
+		                                          logger=self._logger)
+		self._dispatcher.start()
+		self._configure_digest()
+
+		self._scheduler = ProgressScheduler(self._send_periodic_update, logger=self._logger)
+		self._scheduler.start()
+
+		if self._settings.get_boolean(["outbox", "enabled"]):
+			self._outbox = Outbox(os.path.join(self.get_plugin_data_folder(), "outbox.jsonl"),
+			                      self._retry_job,
+			                      max_entries=self._settings.get_int(["outbox", "max_entries"]),
+			                      max_age=self._settings.get_int(["outbox", "max_age"]),
+			                      retry_delay=self._settings.get_float(["outbox", "retry_delay"]),
+			                      max_retry_delay=self._settings.get_float(["outbox", "max_retry_delay"]),
+			                      not_before=lambda: self._connections.ratelimited_until,
+			                      logger=self._logger)
+			self._outbox.load()
+
+	def _create_client(self, token):
+		# the pushbullet library (and what it pulls in) is only imported once there is something to
+		# connect to, instead of slowing down OctoPrint's startup
+		from .api import PooledPushBullet
+		return PooledPushBullet(token, pool=self._connections)
+
+	def _create_connection(self, apikey, channel_name=""):
+		# does all the talking to Pushbullet, returns the client, the sender and a status for the settings UI
+		if not apikey:
+			return None, None, _CONNECTION_UNCONFIGURED
+
+		from pushbullet import InvalidKeyError
 
-	def _connect_bullet(self, apikey, channel_name=""):
 		try:
-			self._bullet, self._sender = self._create_sender(apikey, channel=channel_name)
+			bullet, sender = self._create_sender(apikey, channel=channel_name)
 		except NoSuchChannel:
 			self._logger.warn("Could not find channel {}, please check your configuration!".format(channel_name))
-			self._bullet, self._sender = self._create_sender(apikey)
-		except pushbullet.InvalidKeyError:
+			bullet, sender = self._create_sender(apikey)
+			return bullet, sender, _CONNECTION_CHANNEL if bullet is not None else _CONNECTION_ERROR
+		except InvalidKeyError:
 			self._logger.error("Invalid Pushbullet API key, please check your configuration!")
-			self._bullet = self._sender = None
+			return None, None, _CONNECTION_APIKEY
+
+		return bullet, sender, _CONNECTION_CONNECTED if bullet is not None else _CONNECTION_ERROR
+
+	def _apply_connection(self, connection):
+		self._bullet, self._sender, self._connection_status = connection
+		self._plugin_manager.send_plugin_message(self._identifier, dict(type="connection",
+		                                                                status=self._connection_status))
 
 	#~~ progress message helpers
 
@@ -121,15 +309,49 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 	#~~ PrintProgressPlugin
 
 	def on_print_progress(self, storage, path, progress):
-		self._send_periodic_update(progress)
+		self._scheduler.progress(progress)
 
 	#~~ StartupPlugin
 
 	def on_after_startup(self):
-		self._connect_bullet(self._settings.get(["access_token"]),
-		                     self._settings.get(["push_channel"]))
-		self._periodic_updates = self._settings.get(["periodic_updates"])
-		self._periodic_updates_interval = self._settings.get_int(["periodic_updates_interval"]) * 60
+		# connecting takes a couple of round trips to Pushbullet, OctoPrint's startup shouldn't wait for them
+		self._reconnector.request(self._settings.get(["access_token"]),
+		                          self._settings.get(["push_channel"]),
+		                          delay=0)
+		self._load_periodic_update_settings()
+		self._configure_commands()
+
+		if self._outbox is not None:
+			self._outbox.start()
+
+	#~~ ShutdownPlugin
+
+	def on_shutdown(self):
+		if self._scheduler is not None:
+			self._scheduler.shutdown()
+		if self._reconnector is not None:
+			self._reconnector.stop()
+		if self._listener is not None:
+			self._listener.stop(timeout=1.0)
+		if self._grabber is not None:
+			self._grabber.stop()
+		if self._capture is not None:
+			self._capture.shutdown()
+		if self._digest is not None:
+			self._digest.flush()
+		if self._dispatcher is not None:
+			for job in self._dispatcher.shutdown(timeout=self._settings.get_float(["dispatch", "shutdown_timeout"])):
+				self._keep_for_retry(job)
+		if self._aio is not None:
+			# what the dispatcher handed over is still in flight, what doesn't finish in time ends up in the outbox
+			self._aio.shutdown(timeout=self._settings.get_float(["dispatch", "shutdown_timeout"]))
+		if self._outbox is not None:
+			# anything still pending stays in the journal and is retried after the next start
+			self._outbox.stop(timeout=1.0)
+		if self._history is not None:
+			self._history.close()
+		if self._connections is not None:
+			self._connections.close()
 
 	#~~ SettingsPlugin
 
@@ -137,7 +359,7 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 		data = octoprint.plugin.SettingsPlugin.on_settings_load(self)
 
 		# only return our restricted settings to admin users - this is only needed for OctoPrint <= 1.2.16
-		restricted = ("access_token", "push_channel")
+		restricted = ("access_token", "push_channel", "relay")
 		for r in restricted:
 			if r in data and (current_user is None or current_user.is_anonymous() or not current_user.is_admin()):
 				data[r] = None
@@ -152,6 +374,35 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 				self._logger.exception("Got an invalid value to save for periodic_updates_interval, ignoring it")
 				del data["periodic_updates_interval"]
 
+		if "periodic_updates_milestones" in data:
+			try:
+				data["periodic_updates_milestones"] = parse_milestones(data["periodic_updates_milestones"])
+			except:
+				self._logger.exception("Got an invalid value to save for periodic_updates_milestones, ignoring it")
+				del data["periodic_updates_milestones"]
+
+		messages = list(_MESSAGE_PLACEHOLDERS.items())
+		if isinstance(data.get("events"), dict):
+			# which placeholders exist depends on the payload, only the syntax can be checked here
+			messages += [(("events", event), None) for event in data["events"]]
+
+		for message, placeholders in messages:
+			templates = data
+			for key in message:
+				templates = templates.get(key) if isinstance(templates, dict) else None
+			if not isinstance(templates, dict):
+				continue
+
+			for part in ("title", "body"):
+				if templates.get(part) is None:
+					continue
+				try:
+					MessageTemplate(templates[part], placeholders=placeholders)
+				except TemplateError:
+					self._logger.exception("Got an invalid {} {} template to save, "
+					                       "ignoring it".format(".".join(message), part))
+					del templates[part]
+
 		if "access_token" in data and not data["access_token"]:
 			data["access_token"] = None
 
@@ -160,20 +411,41 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 
 		octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
 
-		import threading
-		thread = threading.Thread(target=self._connect_bullet, args=(self._settings.get(["access_token"]),
-		                                                             self._settings.get(["push_channel"])))
-		thread.daemon = True
-		thread.start()
-
-		with self._periodic_updates_lock:
-			# Periodic update settings
-			self._periodic_updates = self._settings.get(["periodic_updates"])
-			self._periodic_updates_interval = self._settings.get_int(["periodic_updates_interval"]) * 60
-
-			# Changing settings mid-print resets the timer
-			if self._next_message is not None:
-				self._next_message = time.time() + self._periodic_updates_interval
+		# reconnect in the background, repeated saves in quick succession only lead to one attempt
+		self._reconnector.request(self._settings.get(["access_token"]),
+		                          self._settings.get(["push_channel"]))
+
+		if self._dispatcher is not None:
+			self._dispatcher.set_queue_size(self._settings.get_int(["dispatch", "queue_size"]))
+		self._configure_backend()
+		if self._connections is not None:
+			self._connections.set_timeouts(webcam_timeout=self._get_timeout("webcam"),
+			                               api_timeout=self._get_timeout("api"))
+			self._configure_ratelimit()
+		self._compile_templates()
+		self._build_routes()
+		self._configure_relay()
+		self._configure_digest()
+		self._configure_grabber()
+		self._configure_cameras()
+		self._configure_commands()
+		self._configure_history()
+
+		if self._snapshots is not None:
+			# transform settings might have changed
+			self._snapshots.clear()
+			self._snapshots.configure(ttl=self._settings.get_float(["snapshot", "cache_ttl"]),
+			                          max_bytes=self._settings.get_int(["snapshot", "cache_max_bytes"]))
+		if self._clients is not None:
+			self._clients.set_ttl(self._settings.get_int(["connection", "client_ttl"]))
+
+		self._load_periodic_update_settings()
+
+		# Changing settings mid-print resets the timer
+		if self._periodic_updates:
+			self._scheduler.reconfigure(self._periodic_updates_interval, self._periodic_updates_milestones)
+		else:
+			self._scheduler.end()
 
 
 	def get_settings_defaults(self):
@@ -182,19 +454,140 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 			push_channel=None,
 			periodic_updates = False,
 			periodic_updates_interval = 15,
+			periodic_updates_milestones = [],
 			printDone=dict(
 				title="Print job finished",
 				body="{file} finished printing in {elapsed_time}"
 			),
+			movieDone=dict(
+				title="Timelapse rendered",
+				body="The timelapse of {file} is ready"
+			),
 			printProgress=dict(
 				title="Print job {progress}% complete",
 				body="{progress}% on {file}\nTime elapsed: {elapsed_time}\nTime left: {remaining_time}\nETA: {eta}"
+			),
+			dispatch=dict(
+				queue_size=10,
+				workers=1,
+				shutdown_timeout=10.0,
+				backend="threads",
+				concurrency=16
+			),
+			snapshot=dict(
+				transform=TRANSFORM_AUTO,
+				cache_ttl=2.0,
+				cache_max_bytes=4 * 1024 * 1024,
+				max_width=1280,
+				max_height=1280,
+				quality=85,
+				max_fetch_bytes=16 * 1024 * 1024
+			),
+			ratelimit=dict(
+				degrade_below=0.5,
+				skip_below=0.2,
+				reserve=0.05
+			),
+			stream=dict(
+				enabled=False,
+				url=None,
+				buffer_frames=2,
+				max_age=2.0,
+				linger=30.0
+			),
+			cameras=dict(
+				sources=[],
+				deadline=5.0,
+				workers=3,
+				composite=False
+			),
+			events=dict(
+				PrintFailed=dict(
+					enabled=True,
+					title="Print job failed",
+					body="{file} failed after {elapsed_time}",
+					snapshot=True,
+					priority="high"
+				),
+				PrintCancelled=dict(
+					enabled=False,
+					title="Print job cancelled",
+					body="{file} was cancelled after {elapsed_time}",
+					snapshot=True,
+					priority="high"
+				),
+				PrintPaused=dict(
+					enabled=False,
+					title="Print job paused",
+					body="{file} has been paused",
+					snapshot=True,
+					priority="high"
+				),
+				Error=dict(
+					enabled=True,
+					title="Printer error",
+					body="{error}",
+					snapshot=False,
+					priority="high"
+				),
+				Disconnected=dict(
+					enabled=False,
+					title="Printer disconnected",
+					body="OctoPrint lost the connection to the printer",
+					snapshot=False,
+					priority="high"
+				)
+			),
+			timelapse=dict(
+				enabled=False,
+				max_size=25 * 1024 * 1024
+			),
+			connection=dict(
+				pool_size=4,
+				client_ttl=3600,
+				webcam=dict(
+					connect_timeout=3.0,
+					read_timeout=10.0
+				),
+				api=dict(
+					connect_timeout=5.0,
+					read_timeout=30.0
+				)
+			),
+			outbox=dict(
+				enabled=True,
+				max_entries=50,
+				max_age=86400,
+				retry_delay=10.0,
+				max_retry_delay=900.0
+			),
+			history=dict(
+				capacity=200,
+				persist=False,
+				max_file_size=1024 * 1024
+			),
+			digest=dict(
+				window=0
+			),
+			relay=dict(
+				enabled=False,
+				url="http://127.0.0.1:8765",
+				secret=None
+			),
+			commands=dict(
+				enabled=False,
+				device_name="OctoPrint",
+				allowed=[_COMMAND_STATUS, _COMMAND_SNAPSHOT, _COMMAND_PAUSE, _COMMAND_RESUME],
+				stream_url=DEFAULT_STREAM_URL,
+				timeout=90.0,
+				retry_delay=1.0,
+				max_retry_delay=300.0
 			)
 		)
 
 	def get_settings_restricted_paths(self):
 		# only used in OctoPrint versions > 1.2.16
-		return dict(admin=[["access_token"], ["push_channel"]])
+		return dict(admin=[["access_token"], ["push_channel"], ["relay"]])
 
 	#~~ TemplatePlugin API
 
@@ -210,6 +603,56 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 
 	#~~ SimpleApiPlugin
 
+	def on_api_get(self, request):
+		if not admin_permission.can():
+			return flask.make_response("Insufficient rights", 403)
+
+		if "history" in request.values:
+			return self._get_history(request.values)
+
+		gauges = dict(queue_pending=self._dispatcher.pending if self._dispatcher is not None else 0,
+		              outbox_pending=len(self._outbox) if self._outbox is not None else 0,
+		              ratelimit_budget=self._connections.budget.fraction if self._connections is not None else 1.0,
+		              stream_connected=1 if self._listener is not None and self._listener.connected else 0,
+		              pushes_in_flight=self._aio.in_flight if self._aio is not None else 0)
+		# these only ever go up
+		counters = dict(queue_dropped=self._dispatcher.dropped if self._dispatcher is not None else 0,
+		                pushes_saved=self.pushes_saved,
+		                uploaded_bytes=self._uploaded_bytes)
+
+		if request.values.get("format") == "prometheus":
+			return flask.make_response(self._metrics.prometheus(gauges=gauges, counters=counters), 200,
+			                           {"Content-Type": "text/plain; version=0.0.4"})
+
+		data = self._metrics.as_dict()
+		data.update(gauges)
+		data.update(counters)
+		data.update(connection=self._connection_status)
+		return flask.jsonify(**data)
+
+	def _get_history(self, values):
+		try:
+			since = float(values["since"]) if values.get("since") else None
+			until = float(values["until"]) if values.get("until") else None
+			limit = int(values["limit"]) if values.get("limit") else None
+		except ValueError:
+			return flask.make_response("since and until must be timestamps, limit a number", 400)
+
+		status = values.get("status") or None
+		if status is not None and status not in STATUSES:
+			return flask.make_response("status must be one of {}".format(", ".join(STATUSES)), 400)
+
+		if self._history is None:
+			return flask.jsonify(history=[], capacity=0)
+
+		records = self._history.query(kind=values.get("kind") or None,
+		                              event=values.get("event") or None,
+		                              status=status,
+		                              since=since,
+		                              until=until,
+		                              limit=limit)
+		return flask.jsonify(history=[record.as_dict() for record in records], capacity=self._history.capacity)
+
 	def get_api_commands(self):
 		return dict(test=["token"])
 
@@ -224,40 +667,140 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 		token = data["token"]
 		channel = data.get("channel", None)
 
+		from pushbullet import InvalidKeyError
 		try:
 			_, sender = self._create_sender(token, channel=channel)
 		except NoSuchChannel:
 			return flask.make_response(flask.jsonify(result=False, error="channel"))
-		except pushbullet.InvalidKeyError:
+		except InvalidKeyError:
 			return flask.make_response(flask.jsonify(result=False, error="apikey"))
 
-		result = self._send_message_with_webcam_image("Test from the OctoPrint PushBullet Plugin", message, sender=sender)
+		snapshot = self._admit(PRIORITY_NORMAL) == ADMIT_FULL
+		result = self._send_message_with_webcam_image("Test from the OctoPrint PushBullet Plugin", message,
+		                                              sender=sender, snapshot=snapshot)
 		return flask.make_response(flask.jsonify(result=result))
 
 	#~~ EventHandlerPlugin
 
 	def on_event(self, event, payload):
+		# OctoPrint sends us every single event, most of which nobody is interested in
+		handlers = self._routes.get(event)
+		if handlers is None:
+			return
+
+		for handler in handlers:
+			handler(event, payload or dict())
+
+	def _build_routes(self):
+		# maps event names to what to do about them, rebuilt whenever the settings are saved
+		routes = dict()
+
+		def add(event, handler):
+			routes.setdefault(event, []).append(handler)
+
+		add(Events.PRINT_STARTED, self._on_print_started)
+		add(Events.PRINT_DONE, self._notify_print_done)
+		for event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+			add(event, self._on_print_ended)
+
+		if self._settings.get_boolean(["timelapse", "enabled"]):
+			add(Events.MOVIE_DONE, self._notify_movie_done)
 
-		if event == Events.PRINT_DONE:
-			path = os.path.basename(payload["name"])
-			elapsed_time_in_seconds = payload["time"]
+		alerts = dict()
+		for event, config in (self._settings.get(["events"]) or dict()).items():
+			if not isinstance(config, dict) or not config.get("enabled") or event in _OWN_MESSAGE_EVENTS:
+				continue
+			alerts[event] = self._build_alert(event, config)
+			add(event, self._notify_alert)
 
-			placeholders = dict(file=path,
-			                    elapsed_time=_get_time_from_seconds(elapsed_time_in_seconds, default="?"))
+		self._alerts = alerts
+		self._routes = routes
 
-			title = self._settings.get(["printDone", "title"]).format(**placeholders)
-			body = self._settings.get(["printDone", "body"]).format(**placeholders)
-			filename = os.path.splitext(path)[0] + "-done.jpg"
+	def _build_alert(self, event, config):
+		defaults = self.get_settings_defaults()["events"].get(event, dict())
 
-			self._send_message_with_webcam_image(title, body, filename=filename)
+		templates = []
+		for part, fallback in zip(("title", "body"), _ALERT_FALLBACK_TEMPLATES):
+			try:
+				if config.get(part) is None:
+					raise TemplateError("No template configured")
+				templates.append(MessageTemplate(config[part]))
+			except TemplateError as e:
+				self._logger.warn("Invalid events.{} {} template, using the default: {}".format(event, part, e))
+				templates.append(MessageTemplate(defaults.get(part, fallback)))
+
+		priority = PRIORITY_NAMES.get(config.get("priority") or "high")
+		if priority is None:
+			self._logger.warn("Invalid events.{} priority {!r}, using high".format(event, config.get("priority")))
+			priority = PRIORITY_HIGH
+
+		return _Alert(templates[0], templates[1], snapshot=bool(config.get("snapshot")), priority=priority)
+
+	def _on_print_started(self, event, payload):
+		if self._grabber is not None:
+			self._grabber.begin()
+		if self._periodic_updates:
+			self._scheduler.begin(self._periodic_updates_interval, self._periodic_updates_milestones)
+
+	def _on_print_ended(self, event, payload):
+		self._scheduler.end()
+		if self._grabber is not None:
+			self._grabber.end()
+
+	def _notify_print_done(self, event, payload):
+		path = os.path.basename(payload["name"])
+		elapsed_time_in_seconds = payload["time"]
+
+		placeholders = dict(file=path,
+		                    elapsed_time=lambda: _get_time_from_seconds(elapsed_time_in_seconds, default="?"))
+
+		title, body = self._render_message(("printDone",), placeholders)
+		filename = os.path.splitext(path)[0] + "-done.jpg"
+
+		self._dispatcher.submit(NotificationJob(title, body, filename=filename, kind=JOB_DONE, event=event))
+
+	def _notify_movie_done(self, event, payload):
+		movie = payload["movie"]
+		placeholders = dict(file=os.path.basename(payload["gcode"]),
+		                    movie=os.path.basename(movie))
+
+		title, body = self._render_message(("movieDone",), placeholders)
+		self._dispatcher.submit(NotificationJob(title, body,
+		                                        filename=os.path.basename(movie),
+		                                        kind=JOB_MOVIE,
+		                                        path=movie,
+		                                        event=event))
+
+	def _notify_alert(self, event, payload):
+		alert = self._alerts.get(event)
+		if alert is None:
+			return
+
+		accept = _ALERT_FILTERS.get(event)
+		if accept is not None and not accept(payload):
+			return
 
-			with self._periodic_updates_lock:
-				self._next_message = None
+		name = payload.get("name") or payload.get("path")
+		placeholders = dict(payload)
+		placeholders.update(event=event,
+		                    file=os.path.basename(name) if name else "?",
+		                    elapsed_time=lambda: _get_time_from_seconds(payload.get("time"), default="?"))
 
-		elif event == Events.PRINT_STARTED:
-			if self._periodic_updates:
-				with self._periodic_updates_lock:
-					self._next_message = time.time() + self._periodic_updates_interval
+		missing = (alert.title.fields | alert.body.fields) - set(placeholders)
+		if missing:
+			self._logger.warn("The payload of {} has no {}, using ? instead".format(
+				event, ", ".join("{" + name + "}" for name in sorted(missing))))
+			placeholders.update((name, "?") for name in missing)
+
+		filename = "{}-{}.jpg".format(os.path.splitext(os.path.basename(name))[0] if name else "printer", event.lower())
+
+		self._dispatcher.submit(NotificationJob(alert.title.render(placeholders),
+		                                        alert.body.render(placeholders),
+		                                        filename=filename,
+		                                        kind=JOB_ALERT,
+		                                        snapshot=alert.snapshot,
+		                                        event=event,
+		                                        priority=alert.priority))
 
 
 	##~~ Softwareupdate hook
@@ -281,57 +824,624 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 
 	##~~ Internal utility methods
 
-	def _send_periodic_update(self, progress):
-		if not self._periodic_updates:
+	def _load_periodic_update_settings(self):
+		self._periodic_updates = self._settings.get_boolean(["periodic_updates"])
+		self._periodic_updates_interval = self._settings.get_int(["periodic_updates_interval"]) * 60
+		try:
+			self._periodic_updates_milestones = parse_milestones(self._settings.get(["periodic_updates_milestones"]))
+		except ValueError:
+			self._logger.warn("Invalid periodic_updates_milestones configured, ignoring them")
+			self._periodic_updates_milestones = []
+
+	def _send_periodic_update(self, progress, milestone=False):
+		# called by the scheduler whenever an interval has passed or a milestone has been reached
+
+		if not self._printer.is_printing():
+			# paused, no updates until we resume
 			return
 
-		with self._periodic_updates_lock:
-			# Check if we even are supposed to run
-			if self._next_message is None:
-				return
+		current_data = self._printer.get_current_data()
+		elapsed_time, remaining_time = self._get_progress_data(current_data)
 
-			# Check if enough time has passed since last message
-			if time.time() < self._next_message:
-				return
+		if elapsed_time is None:
+			# doesn't really make sense to send a progress if we haven't properly started yet
+			return
 
-			self._next_message = time.time() + self._periodic_updates_interval
+		if remaining_time is None:
+			# also can't check if we need to send a report if time_left is None
+			return
 
-			current_data = self._printer.get_current_data()
-			elapsed_time, remaining_time = self._get_progress_data(current_data)
+		# check if there is time for another message before job ends
+		if not milestone and remaining_time < self._periodic_updates_interval:
+			self._logger.debug("Skip trailing message since print "
+			                   "is nearly done: {} of {}".format(remaining_time,
+			                                                     self._periodic_updates_interval))
+			return
 
-			if elapsed_time is None:
-				# doesn't really make sense to send a progress if we haven't properly started yet
-				return
+		path = current_data["job"]["file"]["path"]
+		placeholders = dict(progress=progress,
+		                    file=path,
+		                    elapsed_time=lambda: _get_time_from_seconds(elapsed_time, default="?"),
+		                    remaining_time=lambda: _get_time_from_seconds(remaining_time, default="?"),
+		                    eta=lambda: _get_eta_from_seconds(remaining_time, default="?"))
 
-			if remaining_time is None:
-				# also can't check if we need to send a report if time_left is None
-				return
+		title, body = self._render_message(("printProgress",), placeholders)
+		filename = _PERIODIC_FILENAME_FORMAT.format(name=os.path.splitext(path)[0],
+		                                            progress=progress)
+
+		self._dispatcher.submit(NotificationJob(title, body, filename=filename, kind=JOB_PROGRESS, key=path))
+
+	def _compile_templates(self):
+		# parsed once here instead of on every notification, recompiled whenever the settings are saved
+		defaults = self.get_settings_defaults()
+
+		templates = dict()
+		for message, placeholders in _MESSAGE_PLACEHOLDERS.items():
+			default = defaults
+			for key in message:
+				default = default[key]
+
+			compiled = []
+			for part in ("title", "body"):
+				template = self._settings.get(list(message) + [part])
+				try:
+					if template is None:
+						raise TemplateError("No template configured")
+					compiled.append(MessageTemplate(template, placeholders=placeholders))
+				except TemplateError as e:
+					self._logger.warn("Invalid {} {} template, using the default: {}".format(".".join(message), part, e))
+					compiled.append(MessageTemplate(default[part], placeholders=placeholders))
+			templates[message] = tuple(compiled)
+
+		self._templates = templates
+
+	def _render_message(self, message, placeholders):
+		title, body = self._templates[message]
+		return title.render(placeholders), body.render(placeholders)
+
+	def _get_timeout(self, target):
+		return (self._settings.get_float(["connection", target, "connect_timeout"]),
+		        self._settings.get_float(["connection", target, "read_timeout"]))
+
+	def _deliver_job(self, job):
+		if self._relay is None and self._sender is None:
+			# the first notifications after startup might be faster than the connection attempt
+			self._reconnector.wait(timeout=sum(self._get_timeout("api")))
+
+		if job.kind == JOB_DONE and self._digest is not None and self._relay is None and self._sender:
+			self._collect_for_digest(job)
+			return
+
+		self._metrics.observe(STAGE_QUEUE, max(0.0, time.time() - job.created))
+
+		if self._deliver_async(job):
+			return
+
+		if self._deliver(job):
+			return
+
+		self._keep_for_retry(job)
+
+	def _keep_for_retry(self, job):
+		if self._outbox is not None and not job.droppable and (self._relay is not None or self._settings.get(["access_token"])):
+			self._logger.info("Could not deliver {!r}, keeping it in the outbox for a retry".format(job))
+			data = job.as_dict()
+			# a snapshot taken when it is retried, possibly hours later, would show the printer as it is
+			# then and not what the notification is about, so the retry is a plain note
+			data["snapshot"] = False
+			self._outbox.add(data)
+
+	def _retry_job(self, data):
+		if self._relay is None and self._sender is None:
+			self._reconnector.wait(timeout=sum(self._get_timeout("api")))
+
+		if self._relay is None and self._sender is None:
+			# we might not have been able to connect in the first place, the attempt goes through the
+			# reconnector as well so it can't overwrite the result of a newer settings save
+			self._reconnector.request(self._settings.get(["access_token"]),
+			                          self._settings.get(["push_channel"]),
+			                          delay=0)
+			self._reconnector.wait(timeout=sum(self._get_timeout("api")))
+
+		return self._deliver(NotificationJob.from_dict(data), retry=True)
+
+	def _deliver(self, job, retry=False):
+		started = time.time()
+		self._delivery.fallback = False
+
+		if self._relay is not None:
+			# the relay applies the rate limit itself
+			result = self._send_via_relay(job.title, job.body, filename=job.filename,
+			                              snapshot=job.snapshot and job.kind != JOB_MOVIE)
+		elif job.kind == JOB_DIGEST:
+			result = self._send_digest(job)
+		elif job.kind == JOB_MOVIE:
+			result = self._send_movie(job)
+		else:
+			admission = self._admit_job(job, started, retry=retry)
+			if admission == ADMIT_SKIP:
+				return True
+			sender = self._get_reply_sender(job.device) if job.kind == JOB_REPLY else None
+			result = self._send_message_with_webcam_image(job.title, job.body, filename=job.filename,
+			                                              sender=sender,
+			                                              snapshot=job.snapshot and admission == ADMIT_FULL)
+
+		if not result:
+			status = STATUS_FAILED
+		else:
+			status = STATUS_NOTE if self._delivery.fallback else STATUS_DELIVERED
+		self._finish_delivery(job, status, started, retry=retry)
+		return result
+
+	def _admit_job(self, job, started, retry=False):
+		# the rate limit admission of a note or snapshot, a skipped job is recorded as such right away
+		admission = self._admit(job.priority)
+		if admission == ADMIT_SKIP:
+			self._logger.info("Rate limit budget is running low, skipping {!r}".format(job))
+			self._record(job, STATUS_SKIPPED, started, retry=retry)
+		return admission
+
+	def _finish_delivery(self, job, status, started, retry=False):
+		self._metrics.increment(COUNTER_DELIVERED if status != STATUS_FAILED else COUNTER_FAILED)
+		self._record(job, status, started, retry=retry)
+
+	def _note_fallback(self):
+		# only the file or snapshot could not be sent, the notification still goes out as a note
+		self._metrics.increment(COUNTER_NOTE_FALLBACK)
+		self._delivery.fallback = True
+
+	def _record(self, job, status, started, retry=False):
+		if self._history is None:
+			return
+		self._history.add(DeliveryRecord(job.kind, job.event, job.title, status, job.created, started, time.time(),
+		                                 retry=retry))
+
+	def _deliver_async(self, job):
+		# hands the job over to the event loop backend if that is enabled and the job is a plain note or
+		# snapshot, returns False if it has to be delivered on this thread instead
+		if self._relay is not None or not self._sender or job.kind in (JOB_DIGEST, JOB_MOVIE, JOB_REPLY):
+			# replies go to a device instead of the channel, which the async client doesn't support
+			return False
+		if self._cameras or self._grabber is not None:
+			# multiple cameras and the frame grabber are thread based
+			return False
+
+		backend = self._get_async_backend()
+		if backend is None:
+			return False
+
+		from .aio import AsyncPushBullet, send_message
+
+		started = time.time()
+		admission = self._admit_job(job, started)
+		if admission == ADMIT_SKIP:
+			return True
 
-			# check if there is time for another message before job ends
-			if remaining_time < self._periodic_updates_interval:
-				self._logger.debug("Skip trailing message since print "
-				                   "is nearly done: {} of {}".format(remaining_time,
-				                                                     self._periodic_updates_interval))
+		filename = job.filename if job.filename is not None else _get_random_filename()
+
+		snapshot = None
+		snapshot_url = self._settings.global_get(["webcam", "snapshot"])
+		if job.snapshot and admission == ADMIT_FULL and snapshot_url:
+			# fetched through the snapshot cache on the loop's executor, so it is shared with any other
+			# notification wanting the same snapshot just like on the threaded backend
+			snapshot = functools.partial(self._get_snapshot, snapshot_url)
+
+		channel = self._settings.get(["push_channel"]) if self._connection_status == _CONNECTION_CONNECTED else None
+
+		client = AsyncPushBullet(backend.session, self._bullet.api_key,
+		                         api_url=getattr(self._bullet, "api_url", None),
+		                         timeout=self._get_timeout("api"),
+		                         on_response=self._connections.track_ratelimit if self._connections is not None else None)
+		message = send_message(client, self._metrics, job.title, job.body,
+		                       filename=filename,
+		                       snapshot=snapshot,
+		                       channel=channel,
+		                       on_upload=self._count_upload,
+		                       logger=self._logger)
+
+		def done(status):
+			# status is None if the delivery was cancelled
+			status = status or STATUS_FAILED
+			self._finish_delivery(job, status, started)
+			if status == STATUS_FAILED:
+				self._keep_for_retry(job)
+
+		try:
+			# blocks while the backend is at its concurrency limit, so the queue in front of it still fills up
+			backend.submit(message, callback=done)
+		except RuntimeError:
+			# the backend was shut down in the meantime
+			return False
+		return True
+
+	def _get_async_backend(self):
+		with self._aio_lock:
+			if self._aio is not None or self._aio_unavailable:
+				return self._aio
+			if self._settings.get(["dispatch", "backend"]) != BACKEND_ASYNCIO:
+				return None
+
+			try:
+				from .aio import EventLoopBackend
+			except (ImportError, SyntaxError) as e:
+				# needs Python 3 and aiohttp
+				self._logger.warn("The asyncio delivery backend is not available, using threads: {}".format(e))
+				self._aio_unavailable = True
+				return None
+
+			backend = EventLoopBackend(concurrency=self._settings.get_int(["dispatch", "concurrency"]),
+			                           logger=self._logger)
+			backend.start()
+			self._aio = backend
+			return backend
+
+	def _configure_backend(self):
+		# a new backend is started on the next delivery that needs one
+		with self._aio_lock:
+			self._aio_unavailable = False
+			backend = self._aio
+			if backend is None:
 				return
+			if self._settings.get(["dispatch", "backend"]) == BACKEND_ASYNCIO \
+					and self._settings.get_int(["dispatch", "concurrency"]) == backend.concurrency:
+				return
+			self._aio = None
 
-			path = current_data["job"]["file"]["path"]
-			placeholders = dict(progress=progress,
-			                    file=path,
-			                    elapsed_time=_get_time_from_seconds(elapsed_time, default="?"),
-			                    remaining_time=_get_time_from_seconds(remaining_time, default="?"),
-			                    eta=_get_eta_from_seconds(remaining_time, default="?"))
+		# draining what is still in flight can take up to the shutdown timeout, which saving the settings
+		# mustn't wait for
+		thread = threading.Thread(target=backend.shutdown,
+		                          kwargs=dict(timeout=self._settings.get_float(["dispatch", "shutdown_timeout"])),
+		                          name="OctobulletBackendShutdown")
+		thread.daemon = True
+		thread.start()
+
+	def _configure_history(self):
+		capacity = self._settings.get_int(["history", "capacity"])
+		max_file_size = self._settings.get_int(["history", "max_file_size"])
+		path = None
+		if self._settings.get_boolean(["history", "persist"]):
+			path = os.path.join(self.get_plugin_data_folder(), _HISTORY_FILENAME)
 
-			title = self._settings.get(["printProgress", "title"]).format(**placeholders)
-			body = self._settings.get(["printProgress", "body"]).format(**placeholders)
-			filename = _PERIODIC_FILENAME_FORMAT.format(name=os.path.splitext(path)[0],
-			                                            progress=progress)
+		if self._history is not None and self._history.path == path \
+				and self._history.max_file_size == max_file_size:
+			self._history.resize(capacity)
+			return
 
-			self._send_message_with_webcam_image(title, body, filename=filename)
+		if self._history is not None:
+			self._history.close()
+		self._history = DeliveryHistory(capacity=capacity, path=path, max_file_size=max_file_size, logger=self._logger)
+		self._history.load()
+
+	def _configure_ratelimit(self):
+		self._connections.budget.configure(degrade_below=self._settings.get_float(["ratelimit", "degrade_below"]),
+		                                   skip_below=self._settings.get_float(["ratelimit", "skip_below"]),
+		                                   reserve=self._settings.get_float(["ratelimit", "reserve"]))
+
+	def _admit(self, priority):
+		admission = self._connections.budget.admit(priority) if self._connections is not None else ADMIT_FULL
+		if admission == ADMIT_SKIP:
+			self._metrics.increment(COUNTER_RATELIMIT_SKIPPED)
+		elif admission != ADMIT_FULL:
+			self._metrics.increment(COUNTER_RATELIMIT_DEGRADED)
+		return admission
+
+	def _configure_digest(self):
+		if self._digest is not None:
+			self._digest.flush()
+			self._digest = None
+
+		window = self._settings.get_float(["digest", "window"])
+		if window and window > 0:
+			self._digest = DigestCollector(window, self._queue_digest)
+
+	def _collect_for_digest(self, job):
+		# take and upload the snapshot right away so it shows this print, the push itself is sent once the
+		# digest window closes
+		file_data = None
 
-	def _send_message_with_webcam_image(self, title, body, filename=None, sender=None):
+		snapshot_url = self._settings.global_get(["webcam", "snapshot"])
+		if self._has_snapshot_source(snapshot_url):
+			try:
+				snapshot = self._take_snapshot(snapshot_url)
+			except Exception as e:
+				self._logger.exception("Exception while fetching snapshot from webcam: {}".format(str(e)))
+			else:
+				file_data = self._upload_snapshot(snapshot, job.filename)
+
+		self._digest.add((job, file_data))
+
+	def _queue_digest(self, items):
+		if len(items) == 1:
+			job, file_data = items[0]
+			digest = NotificationJob(job.title, job.body,
+			                         filename=job.filename,
+			                         kind=JOB_DIGEST,
+			                         attachments=[file_data] if file_data else None,
+			                         event=job.event)
+		else:
+			parts = []
+			for job, file_data in items:
+				part = "{}\n{}".format(job.title, job.body)
+				if file_data:
+					part += "\n" + file_data["file_url"]
+				parts.append(part)
+
+			digest = NotificationJob(_DIGEST_TITLE_FORMAT.format(count=len(items)),
+			                         "\n\n".join(parts),
+			                         kind=JOB_DIGEST,
+			                         attachments=[file_data for _, file_data in items if file_data])
+
+			self._digest_saved += len(items) - 1
+			self._logger.info("Merged {} notifications into a digest, {} pushes saved so far".format(len(items),
+			                                                                                         self.pushes_saved))
+
+		self._dispatcher.submit(digest)
+
+	@property
+	def pushes_saved(self):
+		superseded = self._dispatcher.superseded if self._dispatcher is not None else 0
+		return self._digest_saved + superseded
+
+	def _send_digest(self, job):
+		sender = self._sender
+		if not sender:
+			return False
+
+		if len(job.attachments) == 1:
+			file_data = job.attachments[0]
+			try:
+				with self._metrics.timed(STAGE_PUSH):
+					sender.push_file(file_data["file_name"], file_data["file_url"], file_data["file_type"],
+					                 body=job.title + " " + job.body)
+				return True
+			except Exception as e:
+				self._logger.exception("Exception while pushing snapshot, sending only a note: {}".format(str(e)))
+				self._note_fallback()
+
+		# the snapshots of several prints are linked in the body
+		return self._send_note(sender, job.title, job.body)
+
+	def _send_movie(self, job):
+		sender = self._sender
+		if not sender:
+			return False
+
+		max_size = self._settings.get_int(["timelapse", "max_size"])
+		try:
+			size = os.stat(job.path).st_size
+		except OSError:
+			self._logger.warn("Timelapse {} does not exist (anymore), sending only a note".format(job.path))
+			return self._send_note(sender, job.title, job.body)
+
+		if max_size and size > max_size:
+			self._logger.info("Timelapse {} is larger than {} bytes, sending only a note".format(job.path, max_size))
+			return self._send_note(sender, job.title, job.body)
+
+		try:
+			# streamed from disk in chunks, memory use doesn't depend on the size of the movie
+			with open(job.path, "rb") as f:
+				with self._metrics.timed(STAGE_UPLOAD):
+					file_data = self._bullet.upload_file(f, job.filename, file_type=_get_movie_type(job.path))
+			self._count_upload(size)
+
+			with self._metrics.timed(STAGE_PUSH):
+				sender.push_file(file_data["file_name"], file_data["file_url"], file_data["file_type"],
+				                 body=job.title + " " + job.body)
+			return True
+		except Exception as e:
+			self._logger.exception("Exception while uploading timelapse, sending only a note: {}".format(str(e)))
+			self._note_fallback()
+
+		return self._send_note(sender, job.title, job.body)
+
+	def _configure_grabber(self):
+		if self._grabber is not None:
+			self._grabber.stop()
+			self._grabber = None
+
+		if not self._settings.get_boolean(["stream", "enabled"]):
+			return
+
+		stream_url = self._settings.get(["stream", "url"]) or self._settings.global_get(["webcam", "stream"])
+		if not stream_url or not stream_url.startswith(("http://", "https://")):
+			self._logger.warn("Grabbing frames from the webcam stream needs an absolute stream URL, "
+			                  "got {!r}, please configure one".format(stream_url))
+			return
+
+		self._grabber = FrameGrabber(stream_url,
+		                             session=self._connections.webcam if self._connections else None,
+		                             frames=self._settings.get_int(["stream", "buffer_frames"]),
+		                             max_age=self._settings.get_float(["stream", "max_age"]),
+		                             linger=self._settings.get_float(["stream", "linger"]),
+		                             logger=self._logger)
+
+		if self._printer.is_printing():
+			self._grabber.begin()
+
+	def _configure_cameras(self):
+		self._cameras = parse_cameras(self._settings.get(["cameras", "sources"]))
+
+		workers = self._settings.get_int(["cameras", "workers"])
+		if self._capture is None:
+			self._capture = CapturePool(workers=workers, logger=self._logger)
+		else:
+			self._capture.set_workers(workers)
+
+	def _configure_relay(self):
+		if not self._settings.get_boolean(["relay", "enabled"]):
+			self._relay = None
+			return
+
+		from .relay import RelayClient
+
+		session = requests.Session()
+		if self._connections is not None:
+			self._connections.mount_api(session)
+		self._relay = RelayClient(self._settings.get(["relay", "url"]),
+		                          secret=self._settings.get(["relay", "secret"]),
+		                          session=session)
+
+	def _configure_commands(self):
+		token = self._settings.get(["access_token"])
+		enabled = self._settings.get_boolean(["commands", "enabled"]) and token and self._relay is None
+		key = (token, self._settings.get(["commands", "stream_url"]), self._settings.get(["commands", "device_name"])) \
+			if enabled else None
+
+		if key == self._listener_key:
+			return
+
+		if self._listener is not None:
+			self._listener.stop(timeout=1.0)
+			self._listener = None
+		self._listener_key = key
+		self._command_device = None
+
+		if not enabled:
+			return
+
+		self._listener = StreamListener(self._settings.get(["commands", "stream_url"]) + token,
+		                                self._fetch_pushes,
+		                                self._on_push,
+		                                os.path.join(self.get_plugin_data_folder(), _STREAM_CURSOR_FILENAME),
+		                                timeout=self._settings.get_float(["commands", "timeout"]),
+		                                retry_delay=self._settings.get_float(["commands", "retry_delay"]),
+		                                max_retry_delay=self._settings.get_float(["commands", "max_retry_delay"]),
+		                                logger=self._logger)
+		self._listener.start()
+
+	def _fetch_pushes(self, modified_after):
+		# called by the listener, on its own thread
+		if self._bullet is None:
+			self._reconnector.wait(timeout=sum(self._get_timeout("api")))
+		bullet = self._bullet
+		if bullet is None:
+			raise IOError("Not connected to Pushbullet")
+
+		if self._command_device is None:
+			name = self._settings.get(["commands", "device_name"])
+			device = next((device for device in bullet.devices if device.nickname == name), None)
+			if device is None:
+				self._logger.info("Creating Pushbullet device {} to receive commands".format(name))
+				device = bullet.new_device(name)
+			self._command_device = device.device_iden
+
+		return bullet.get_pushes(modified_after=modified_after)
+
+	def _on_push(self, push):
+		command = parse_command(push, self._command_device, self._settings.get(["commands", "allowed"]) or [])
+		if command is None:
+			return
+
+		command, _ = command
+		self._logger.info("Received command {!r} via Pushbullet".format(command))
+
+		# the reply goes back to where the command came from, not to the channel
+		device = push.get("source_device_iden")
+		try:
+			reply = self._handle_command(command)
+		except Exception as e:
+			# not dismissed, so it still shows up as unhandled on the phone
+			self._logger.exception("Error while handling command {!r}".format(command))
+			self._dispatcher.submit(NotificationJob("Command {} failed".format(command), str(e),
+			                                        kind=JOB_REPLY, snapshot=False, device=device))
+			return
+
+		if reply is None:
+			return
+
+		try:
+			# shows the command as handled on the phone, and keeps it from being handled twice
+			self._bullet.dismiss_push(push["iden"])
+		except Exception as e:
+			self._logger.warn("Could not dismiss the command push: {}".format(e))
+
+		title, body, filename, snapshot = reply
+		self._dispatcher.submit(NotificationJob(title, body, filename=filename, kind=JOB_REPLY, snapshot=snapshot,
+		                                        device=device))
+
+	def _handle_command(self, command):
+		# carries out the command, returns the title, body, filename and snapshot flag of the reply
+		snapshot = False
+		filename = None
+		if command == _COMMAND_STATUS:
+			title, body = "Printer status", self._get_status_text()
+		elif command == _COMMAND_SNAPSHOT:
+			title, body = "Snapshot", self._get_status_text()
+			snapshot = True
+			filename = _SNAPSHOT_FILENAME_FORMAT.format(timestamp=int(time.time()))
+		elif command == _COMMAND_PAUSE:
+			if self._printer.is_printing():
+				self._printer.pause_print()
+				title, body = "Pausing print", self._get_status_text()
+			else:
+				title, body = "Nothing to pause", self._printer.get_state_string()
+		elif command == _COMMAND_RESUME:
+			if self._printer.is_paused():
+				self._printer.resume_print()
+				title, body = "Resuming print", self._get_status_text()
+			else:
+				title, body = "Nothing to resume", self._printer.get_state_string()
+		elif command == _COMMAND_CANCEL:
+			if self._printer.is_printing() or self._printer.is_paused():
+				self._printer.cancel_print()
+				title, body = "Cancelling print", self._get_status_text()
+			else:
+				title, body = "Nothing to cancel", self._printer.get_state_string()
+		else:
+			return None
+
+		return title, body, filename, snapshot
+
+	def _get_reply_sender(self, device_iden):
+		# the device a command came from, or the whole account if it didn't say or isn't known (anymore)
+		bullet = self._bullet
+		if bullet is None:
+			return None
+		if device_iden:
+			device = next((device for device in bullet.devices if device.device_iden == device_iden), None)
+			if device is not None:
+				return device
+		return bullet
+
+	def _get_status_text(self):
+		state = self._printer.get_state_string()
+		current_data = self._printer.get_current_data()
+
+		path = current_data["job"]["file"]["path"]
+		if not path:
+			return state
+
+		elapsed_time, remaining_time = self._get_progress_data(current_data)
+		return "{state}: {file} at {progress:.0f}%\nTime elapsed: {elapsed}\nTime left: {remaining}".format(
+			state=state,
+			file=path,
+			progress=current_data["progress"]["completion"] or 0,
+			elapsed=_get_time_from_seconds(elapsed_time, default="?"),
+			remaining=_get_time_from_seconds(remaining_time, default="?"))
+
+	def _send_via_relay(self, title, body, filename=None, snapshot=True):
+		image = None
+
+		snapshot_url = self._settings.global_get(["webcam", "snapshot"])
+		if snapshot and self._has_snapshot_source(snapshot_url):
+			try:
+				image = self._take_snapshot(snapshot_url)
+			except Exception as e:
+				self._logger.exception("Exception while fetching snapshot from webcam, "
+				                       "relaying only a note: {message}".format(message=str(e)))
+
+		try:
+			with self._metrics.timed(STAGE_PUSH):
+				self._relay.send(title, body, filename=filename, image=image,
+				                 channel=self._settings.get(["push_channel"]))
+		except Exception as e:
+			self._logger.exception("Error while sending notification to the relay: {}".format(str(e)))
+			return False
+		return True
+
+	def _send_message_with_webcam_image(self, title, body, filename=None, sender=None, snapshot=True):
 		if filename is None:
-			import random, string
-			filename = "test-{}.jpg".format("".join([random.choice(string.ascii_letters) for _ in range(16)]))
+			filename = _get_random_filename()
 
 		if sender is None:
 			sender = self._sender
@@ -340,120 +1450,252 @@ class PushbulletPlugin(octoprint.plugin.EventHandlerPlugin,
 			return False
 
 		snapshot_url = self._settings.global_get(["webcam", "snapshot"])
-		if snapshot_url:
+		if snapshot and self._has_snapshot_source(snapshot_url):
 			try:
-				from requests import get
-				import tempfile
-				tempFile = tempfile.NamedTemporaryFile(delete=False)
-				response = get(
-					snapshot_url,
-					verify=False
-                )
-				response.raise_for_status()
-				tempFile.write(response.content)
-				tempFile.close()
+				snapshots = self._take_snapshots(snapshot_url)
 			except Exception as e:
 				self._logger.exception(
 					"Exception while fetching snapshot from webcam, sending only a note: {message}".format(
 						message=str(e)))
 			else:
-				# ffmpeg can't guess file type it seems
-				os.rename(tempFile.name, tempFile.name + ".jpg")
-				tempFile.name += ".jpg"
-
-				# flip or rotate as needed
-				self._process_snapshot(tempFile)
-
-				if self._send_file(sender, tempFile.name, filename, title + " " + body):
+				if self._send_snapshots(sender, snapshots, filename, title, body):
 					return True
 				self._logger.warn("Could not send a file message with the webcam image, sending only a note")
+			self._note_fallback()
 
 		return self._send_note(sender, title, body)
 
+	def _send_snapshots(self, sender, snapshots, filename, title, body):
+		if len(snapshots) > 1 and self._settings.get_boolean(["cameras", "composite"]):
+			snapshots = [(None, self._composite_snapshots(snapshots))]
+
+		# the first push that goes out carries the message, the ones of further cameras only say which camera
+		# they show, so the message isn't lost if the first camera's push fails
+		sent = False
+		for camera, snapshot in snapshots:
+			text = title + " " + body if not sent else "{} ({})".format(title, camera)
+			if self._send_file(sender, snapshot, _get_camera_filename(filename, camera), text):
+				sent = True
+		return sent
+
 	def _send_note(self, sender, title, body):
 		try:
-			sender.push_note(title, body)
+			with self._metrics.timed(STAGE_PUSH):
+				sender.push_note(title, body)
 		except:
 			self._logger.exception("Error while pushing a note")
 			return False
 		return True
 
-	def _send_file(self, sender, path, filename, body):
+	def _upload_snapshot(self, snapshot, filename):
 		try:
-			with open(path, "rb") as pic:
-				try:
-					file_data = self._bullet.upload_file(pic, filename)
-				except Exception as e:
-					self._logger.exception("Error while uploading snapshot, sending only a note: {}".format(str(e)))
-					return False
+			with self._metrics.timed(STAGE_UPLOAD):
+				file_data = self._bullet.upload_file(io.BytesIO(snapshot), filename, file_type="image/jpeg")
+		except Exception as e:
+			self._logger.exception("Error while uploading snapshot: {}".format(str(e)))
+			return None
+
+		self._count_upload(len(snapshot))
+		return file_data
+
+	def _count_upload(self, size):
+		self._uploads += 1
+		self._uploaded_bytes += size
+		self._logger.debug("Uploaded {} bytes, {} bytes per upload on average".format(size,
+		                                                                            self._uploaded_bytes // self._uploads))
+
+	def _send_file(self, sender, snapshot, filename, body):
+		try:
+			file_data = self._upload_snapshot(snapshot, filename)
+			if file_data is None:
+				return False
 
-			sender.push_file(file_data["file_name"], file_data["file_url"], file_data["file_type"], body=body)
+			with self._metrics.timed(STAGE_PUSH):
+				sender.push_file(file_data["file_name"], file_data["file_url"], file_data["file_type"], body=body)
 			return True
 		except Exception as e:
 			self._logger.exception("Exception while uploading snapshot to Pushbullet, sending only a note: {message}".format(message=str(e)))
 			return False
-		finally:
-			try:
-				os.remove(path)
-			except:
-				self._logger.exception("Could not remove temporary snapshot file {}".format(path))
 
 	def _create_sender(self, token, channel=None):
+		from pushbullet import InvalidKeyError
 		try:
-			bullet = pushbullet.PushBullet(token)
+			bullet, channels = self._clients.get(token)
 			sender = bullet
 
 			# Setup channel object if channel setting is present
 			if channel:
-				for channel_obj in bullet.channels:
-					if channel_obj.channel_tag == channel:
-						sender = channel_obj
-						self._logger.info("Connected to PushBullet on channel {}".format(channel))
-						break
-				else:
+				sender = channels.get(channel)
+				if sender is None:
+					# the channel might have been created since we listed the account's channels, so list
+					# them again on the next attempt
+					self._clients.invalidate(token)
 					self._logger.warn("Could not find channel {}, please check your configuration!".format(channel))
 					raise NoSuchChannel(channel)
+				self._logger.info("Connected to PushBullet on channel {}".format(channel))
 
 			self._logger.info("Connected to PushBullet")
 			return bullet, sender
 		except NoSuchChannel:
 			raise
-		except pushbullet.InvalidKeyError:
+		except InvalidKeyError:
 			raise
 		except:
 			self._logger.exception("Error while instantiating PushBullet")
 			return None, None
 
-	def _process_snapshot(self, snapshot_path, pixfmt="yuv420p"):
-		hflip  = self._settings.global_get_boolean(["webcam", "flipH"])
-		vflip  = self._settings.global_get_boolean(["webcam", "flipV"])
-		rotate = self._settings.global_get_boolean(["webcam", "rotate90"])
-		ffmpeg = self._settings.global_get(["webcam", "ffmpeg"])
-		
-		if not ffmpeg or not os.access(ffmpeg, os.X_OK) or (not vflip and not hflip and not rotate):
-			return
+	def _has_snapshot_source(self, snapshot_url):
+		return bool(snapshot_url or self._grabber is not None or self._cameras)
+
+	def _take_snapshots(self, snapshot_url):
+		# returns (camera name, snapshot) for every camera that delivered in time, the name is None for
+		# OctoPrint's own webcam
+		if not self._cameras:
+			return [(None, self._get_snapshot(snapshot_url))]
+
+		cameras = list(self._cameras)
+		if snapshot_url or self._grabber is not None:
+			cameras.insert(0, Camera("webcam"))
+
+		def take(camera, timeout):
+			# a camera that never answers mustn't keep its worker busy for longer than its deadline
+			if camera.url is None:
+				return self._get_snapshot(snapshot_url, timeout=timeout)
+			return self._get_snapshot(camera.url, camera=camera, timeout=timeout)
+
+		# all cameras at once, a slow or dead one doesn't hold up the others or the push
+		snapshots = self._capture.capture(cameras, take, self._settings.get_float(["cameras", "deadline"]))
+		if len(snapshots) < len(cameras):
+			self._metrics.increment(COUNTER_CAMERA_DROPPED, len(cameras) - len(snapshots))
+		if not snapshots:
+			raise NoSnapshotError("None of the {} cameras delivered a snapshot in time".format(len(cameras)))
+
+		return [(camera.name if camera.url is not None else None, snapshot) for camera, snapshot in snapshots]
+
+	def _take_snapshot(self, snapshot_url):
+		# a single image for where there is only room for one
+		snapshots = self._take_snapshots(snapshot_url)
+		if len(snapshots) == 1:
+			return snapshots[0][1]
+		return self._composite_snapshots(snapshots)
+
+	def _composite_snapshots(self, snapshots):
+		try:
+			with self._metrics.timed(STAGE_TRANSFORM):
+				return composite_with_pillow([snapshot for _, snapshot in snapshots],
+				                             max_width=self._settings.get_int(["snapshot", "max_width"]),
+				                             max_height=self._settings.get_int(["snapshot", "max_height"]),
+				                             quality=self._settings.get_int(["snapshot", "quality"]))
+		except SnapshotTransformError as e:
+			self._logger.warn("Could not combine the snapshots of {} cameras, only using the first one: {}".format(len(snapshots), e))
+			return snapshots[0][1]
+
+	def _get_snapshot(self, snapshot_url, camera=None, timeout=None):
+		# camera is None for OctoPrint's own webcam, which comes with its flip/rotate settings and the frame grabber,
+		# timeout caps the configured webcam timeouts
+		transform = self._get_snapshot_transform(camera)
+		grabber = self._grabber if camera is None else None
+		webcam_timeout = self._get_timeout("webcam")
+		if timeout is not None:
+			webcam_timeout = tuple(min(value, timeout) for value in webcam_timeout)
+
+		def load():
+			with self._metrics.timed(STAGE_FETCH):
+				snapshot = None
+				if grabber is not None:
+					# a frame from the stream costs nothing, only wait for one if there is no snapshot URL
+					# to fall back to
+					snapshot = grabber.latest(timeout=0 if snapshot_url else webcam_timeout[1])
+					if snapshot is None and not snapshot_url:
+						raise NoFrameError("Got no frame from the webcam stream")
+
+				if snapshot is None:
+					snapshot = fetch_snapshot(snapshot_url,
+					                          session=self._connections.webcam if self._connections else None,
+					                          max_bytes=self._settings.get_int(["snapshot", "max_fetch_bytes"]),
+					                          timeout=webcam_timeout)
+
+			# flip or rotate as needed
+			with self._metrics.timed(STAGE_TRANSFORM):
+				return self._process_snapshot(snapshot, *transform)
+
+		if self._snapshots is None:
+			return load()
+
+		# notifications fired within a short time of each other share one fetch & transform
+		return self._snapshots.get((snapshot_url,) + transform, load)
+
+	def _get_snapshot_transform(self, camera=None):
+		if camera is not None:
+			flips = (camera.hflip, camera.vflip, camera.rotate)
+		else:
+			flips = (self._settings.global_get_boolean(["webcam", "flipH"]),
+			         self._settings.global_get_boolean(["webcam", "flipV"]),
+			         self._settings.global_get_boolean(["webcam", "rotate90"]))
+		return flips + (self._settings.get_int(["snapshot", "max_width"]),
+		                self._settings.get_int(["snapshot", "max_height"]),
+		                self._settings.get_int(["snapshot", "quality"]))
+
+	def _process_snapshot(self, snapshot, hflip, vflip, rotate, max_width=0, max_height=0, quality=None,
+	                      pixfmt="yuv420p"):
+		if not vflip and not hflip and not rotate and not max_width and not max_height:
+			return snapshot
+
+		backend = self._settings.get(["snapshot", "transform"])
+
+		if backend in (TRANSFORM_AUTO, TRANSFORM_PILLOW):
+			if pillow_available():
+				try:
+					processed = transform_with_pillow(snapshot, hflip=hflip, vflip=vflip, rotate=rotate,
+					                                  max_width=max_width, max_height=max_height,
+					                                  quality=quality)
+				except SnapshotTransformError as e:
+					self._logger.warn("Failed to process image with Pillow: {}".format(e))
+				else:
+					self._logger.debug("Processed image with Pillow, {} bytes => {} bytes".format(len(snapshot),
+					                                                                              len(processed)))
+					return processed
+			elif backend == TRANSFORM_PILLOW:
+				self._logger.warn("Pillow is not installed, falling back to ffmpeg to process image")
+
+		if backend != TRANSFORM_FFMPEG:
+			# scaling alone isn't worth starting an ffmpeg process for every snapshot, only do that if
+			# ffmpeg was asked for explicitly
+			max_width = max_height = 0
+			if not vflip and not hflip and not rotate:
+				return snapshot
 
-		ffmpeg_command = [ffmpeg, "-y", "-i", snapshot_path]
+		ffmpeg = self._settings.global_get(["webcam", "ffmpeg"])
+		if not ffmpeg or not os.access(ffmpeg, os.X_OK):
+			return snapshot
 
-		rotate_params = ["format={}".format(pixfmt)] # workaround for foosel/OctoPrint#1317
-		if rotate:
-			rotate_params.append("transpose=2") # 90 degrees counter clockwise
-		if hflip:
-			rotate_params.append("hflip") 		# horizontal flip
-		if vflip:
-			rotate_params.append("vflip")		# vertical flip
+		if not hflip and not vflip and not rotate:
+			# only scaling to do, don't start ffmpeg if the snapshot is small enough already
+			size = jpeg_dimensions(snapshot)
+			if size is None or (size[0] <= (max_width or size[0]) and size[1] <= (max_height or size[1])):
+				return snapshot
 
-		ffmpeg_command += ["-vf", sarge.shell_quote(",".join(rotate_params)), snapshot_path]
-		self._logger.info("Running: {}".format(" ".join(ffmpeg_command)))
+		filters = ffmpeg_filters(hflip=hflip, vflip=vflip, rotate=rotate,
+		                         max_width=max_width, max_height=max_height,
+		                         pixfmt=pixfmt)
+		self._logger.info("Running snapshot through {} with filters {}".format(ffmpeg, ",".join(filters)))
 
-		p = sarge.run(ffmpeg_command, stdout=sarge.Capture(), stderr=sarge.Capture())
-		if p.returncode == 0:
-			self._logger.info("Rotated/flipped image with ffmpeg")
+		try:
+			snapshot = transform_with_ffmpeg(ffmpeg, snapshot, filters, quality=quality)
+		except SnapshotTransformError as e:
+			self._logger.warn("Failed to process image with ffmpeg, "
+			                  "got return code {}: {}".format(e.returncode, e.stderr))
 		else:
-			self._logger.warn("Failed to rotate/flip image with ffmpeg, "
-			                  "got return code {}: {}, {}".format(p.returncode,
-			                                                      p.stdout.text,
-			                                                      p.stderr.text))
+			self._logger.info("Processed image with ffmpeg")
+		return snapshot
+
+
+class _Alert(object):
+	def __init__(self, title, body, snapshot=False, priority=PRIORITY_HIGH):
+		self.title = title
+		self.body = body
+		self.snapshot = snapshot
+		self.priority = priority
 
 
 class NoSuchChannel(Exception):
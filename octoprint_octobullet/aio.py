@@ -0,0 +1,275 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+# Event loop delivery backend, needs Python 3 and aiohttp. Only imported if it is enabled via
+# dispatch.backend, so the plugin itself keeps working without either.
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import threading
+
+import aiohttp
+
+from .api import DEFAULT_API_URL
+from .history import STATUS_DELIVERED, STATUS_NOTE, STATUS_FAILED
+from .metrics import STAGE_UPLOAD, STAGE_PUSH, COUNTER_NOTE_FALLBACK
+
+
+class EventLoopBackend(object):
+	"""
+	Runs coroutines on a single event loop in a dedicated thread, with at most ``concurrency`` of them in flight.
+
+	:meth:`submit` may be called from any thread and blocks while the limit is reached, so a
+	dispatcher feeding it still applies its queue limits. On :meth:`shutdown` whatever is still in
+	flight after ``timeout`` seconds is cancelled.
+
+	Callbacks are run in order on a thread of their own, so one writing to disk doesn't hold up the
+	deliveries in flight on the loop.
+	"""
+
+	def __init__(self, concurrency=16, logger=None):
+		self._concurrency = max(1, concurrency)
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._slots = threading.BoundedSemaphore(self._concurrency)
+		self._lock = threading.Lock()
+		self._loop = None
+		self._thread = None
+		self._session = None
+		self._tasks = set()
+		self._callbacks = None
+
+	@property
+	def concurrency(self):
+		return self._concurrency
+
+	@property
+	def in_flight(self):
+		with self._lock:
+			return len(self._tasks)
+
+	@property
+	def session(self):
+		# only to be used from coroutines running on the loop
+		return self._session
+
+	def start(self):
+		with self._lock:
+			if self._thread is not None:
+				return
+
+			self._callbacks = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+			                                                        thread_name_prefix="OctobulletEventLoopCallbacks")
+			started = threading.Event()
+			self._thread = threading.Thread(target=self._run, args=(started,), name="OctobulletEventLoop")
+			self._thread.daemon = True
+			self._thread.start()
+		started.wait()
+
+	def submit(self, coroutine, callback=None):
+		"""
+		Schedules ``coroutine`` on the loop, ``callback`` is called with its result (or ``None`` if it
+		raised or was cancelled) on the callback thread. Returns a :class:`concurrent.futures.Future`.
+		"""
+
+		self._slots.acquire()
+		try:
+			with self._lock:
+				if self._thread is None:
+					raise RuntimeError("Event loop backend is not running")
+			future = asyncio.run_coroutine_threadsafe(self._track(coroutine), self._loop)
+		except Exception:
+			self._slots.release()
+			coroutine.close()
+			raise
+
+		callbacks = self._callbacks
+
+		def done(future):
+			self._slots.release()
+			if callback is None:
+				return
+			try:
+				result = future.result() if not future.cancelled() else None
+			except Exception:
+				result = None
+			callbacks.submit(self._call, callback, result)
+
+		future.add_done_callback(done)
+		return future
+
+	def shutdown(self, timeout=None):
+		with self._lock:
+			loop, thread = self._loop, self._thread
+			self._thread = None
+		if thread is None:
+			return
+
+		future = asyncio.run_coroutine_threadsafe(self._drain(timeout), loop)
+		try:
+			future.result()
+		except Exception:
+			self._logger.exception("Error while shutting down the event loop")
+		loop.call_soon_threadsafe(loop.stop)
+		thread.join()
+		# the callbacks of everything that was cancelled are queued by now
+		self._callbacks.shutdown(wait=True)
+
+	##~~ internals
+
+	def _call(self, callback, result):
+		try:
+			callback(result)
+		except Exception:
+			self._logger.exception("Error in the callback of an event loop delivery")
+
+	def _run(self, started):
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		self._loop = loop
+		# the session has to be created on the loop it is used from
+		loop.call_soon(self._create_session, started)
+		try:
+			loop.run_forever()
+		finally:
+			loop.close()
+
+	def _create_session(self, started):
+		self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._concurrency,
+		                                                                    limit_per_host=self._concurrency))
+		started.set()
+
+	async def _track(self, coroutine):
+		task = asyncio.ensure_future(coroutine)
+		with self._lock:
+			self._tasks.add(task)
+		try:
+			return await task
+		finally:
+			with self._lock:
+				self._tasks.discard(task)
+
+	async def _drain(self, timeout):
+		with self._lock:
+			tasks = list(self._tasks)
+		if tasks:
+			_, pending = await asyncio.wait(tasks, timeout=timeout)
+			if pending:
+				self._logger.info("Cancelling {} deliveries still in flight".format(len(pending)))
+				for task in pending:
+					task.cancel()
+				await asyncio.wait(pending)
+		await self._session.close()
+
+
+class AsyncPushBullet(object):
+	"""
+	The part of the Pushbullet API the plugin pushes through, as coroutines on an aiohttp session.
+
+	``on_response(status, headers)`` is called for every API response, e.g. to keep track of the
+	rate limit.
+	"""
+
+	def __init__(self, session, api_key, api_url=None, timeout=None, on_response=None):
+		self._session = session
+		self._api_url = (api_url or DEFAULT_API_URL).rstrip("/")
+		self._auth = aiohttp.BasicAuth(api_key, "")
+		self._timeout = _client_timeout(timeout)
+		self._on_response = on_response
+
+	async def push_note(self, title, body, channel=None):
+		return await self._push(dict(type="note", title=title, body=body), channel=channel)
+
+	async def push_file(self, file_name, file_url, file_type, body=None, title=None, channel=None):
+		return await self._push(dict(type="file", file_name=file_name, file_url=file_url, file_type=file_type,
+		                             body=body, title=title), channel=channel)
+
+	async def upload_file(self, data, file_name, file_type=None):
+		file_type = file_type or "image/jpeg"
+		upload = await self._request("POST", "/v2/upload-request", dict(file_name=file_name, file_type=file_type))
+
+		form = aiohttp.FormData()
+		for key, value in (upload.get("data") or dict()).items():
+			form.add_field(key, value)
+		form.add_field("file", data, filename=file_name, content_type=file_type)
+
+		async with self._session.post(upload["upload_url"], data=form, timeout=self._timeout) as response:
+			response.raise_for_status()
+
+		return dict(file_type=file_type, file_url=upload.get("file_url"), file_name=file_name)
+
+	async def _push(self, data, channel=None):
+		if channel:
+			data["channel_tag"] = channel
+		return await self._request("POST", "/v2/pushes", dict((key, value) for key, value in data.items()
+		                                                      if value is not None))
+
+	async def _request(self, method, path, data):
+		async with self._session.request(method, self._api_url + path,
+		                                 data=json.dumps(data),
+		                                 headers={"Content-Type": "application/json"},
+		                                 auth=self._auth,
+		                                 timeout=self._timeout) as response:
+			if self._on_response is not None:
+				self._on_response(response.status, response.headers)
+			if response.status != 200:
+				raise IOError("Pushbullet answered {} with {}: {}".format(path, response.status, await response.text()))
+			return await response.json(content_type=None)
+
+
+async def send_message(client, metrics, title, body, filename=None, snapshot=None, channel=None, on_upload=None,
+                       logger=None):
+	"""
+	Sends a notification with the image returned by ``snapshot()``, or as a plain note if there is
+	none or anything goes wrong with it. ``snapshot`` blocks (it fetches and transforms the image the
+	same way the threaded backend does, through its cache), so it is run on the loop's executor.
+	``on_upload(size)`` is called for every uploaded image.
+
+	Returns the :mod:`~octoprint_octobullet.history` status of the delivery, ``delivered``, ``note``
+	if only a note could be sent instead of the snapshot, or ``failed``.
+	"""
+
+	logger = logger if logger is not None else logging.getLogger(__name__)
+
+	fallback = False
+	if snapshot is not None:
+		try:
+			image = await asyncio.get_event_loop().run_in_executor(None, snapshot)
+			with metrics.timed(STAGE_UPLOAD):
+				file_data = await client.upload_file(image, filename, file_type="image/jpeg")
+			if on_upload is not None:
+				on_upload(len(image))
+			with metrics.timed(STAGE_PUSH):
+				await client.push_file(file_data["file_name"], file_data["file_url"], file_data["file_type"],
+				                       body=title + " " + body, channel=channel)
+			return STATUS_DELIVERED
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			logger.warn("Could not send the webcam image, sending only a note: {}".format(e))
+			metrics.increment(COUNTER_NOTE_FALLBACK)
+			fallback = True
+
+	try:
+		with metrics.timed(STAGE_PUSH):
+			await client.push_note(title, body, channel=channel)
+	except asyncio.CancelledError:
+		raise
+	except Exception as e:
+		logger.warn("Error while pushing a note: {}".format(e))
+		return STATUS_FAILED
+	return STATUS_NOTE if fallback else STATUS_DELIVERED
+
+
+def _client_timeout(timeout):
+	# (connect, read) like requests takes them
+	if timeout is None:
+		return None
+	connect, read = timeout
+	return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
@@ -0,0 +1,69 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import json
+
+import pushbullet
+import requests
+
+from .connections import MultipartFileBody
+
+
+DEFAULT_API_URL = "https://api.pushbullet.com"
+
+_API_URL_ATTRIBUTES = ("DEVICES_URL", "CHATS_URL", "CHANNELS_URL", "ME_URL", "PUSH_URL", "UPLOAD_REQUEST_URL",
+                       "EPHEMERALS_URL")
+
+
+class PooledPushBullet(pushbullet.PushBullet):
+	"""
+	:class:`pushbullet.PushBullet` that talks to the API through the connections of a :class:`ConnectionPool`.
+
+	``api_url`` allows pointing the client at something other than the official API, e.g. a local
+	stand-in for testing.
+	"""
+
+	def __init__(self, api_key, pool=None, api_url=None, **kwargs):
+		self._pool = pool
+		self.api_url = (api_url or DEFAULT_API_URL).rstrip("/")
+
+		if api_url and api_url.rstrip("/") != DEFAULT_API_URL:
+			for attribute in _API_URL_ATTRIBUTES:
+				url = getattr(self, attribute, None)
+				if url is not None:
+					setattr(self, attribute, url.replace(DEFAULT_API_URL, api_url.rstrip("/"), 1))
+
+		pushbullet.PushBullet.__init__(self, api_key, **kwargs)
+
+	def refresh(self):
+		# PushBullet.__init__ creates its session and then immediately refreshes, so this is the
+		# earliest point to route that session through our pool
+		if self._pool is not None:
+			self._pool.mount_api(self._session)
+		pushbullet.PushBullet.refresh(self)
+
+	def upload_file(self, f, file_name, file_type=None):
+		if self._pool is None:
+			return pushbullet.PushBullet.upload_file(self, f, file_name, file_type=file_type)
+
+		if not file_type:
+			file_type = "image/jpeg"
+
+		data = {"file_name": file_name, "file_type": file_type}
+		r = self._session.post(self.UPLOAD_REQUEST_URL, data=json.dumps(data))
+		if r.status_code != requests.codes.ok:
+			raise pushbullet.PushbulletError(r.text)
+
+		# stream the file instead of loading it into memory as a whole, it might be a timelapse
+		upload = r.json()
+		body = MultipartFileBody(upload.get("data"), "file", file_name, f, file_type)
+		response = self._pool.upload.post(upload.get("upload_url"),
+		                                  data=body,
+		                                  headers={"Content-Type": body.content_type})
+		response.raise_for_status()
+
+		return {"file_type": file_type, "file_url": upload.get("file_url"), "file_name": file_name}
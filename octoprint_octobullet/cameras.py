@@ -0,0 +1,238 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import collections
+import logging
+import threading
+import time
+
+
+class NoSnapshotError(Exception):
+	pass
+
+
+class Camera(object):
+	"""
+	A snapshot source with its own flip/rotate settings. A ``url`` of ``None`` stands for OctoPrint's own
+	webcam (and frame grabber).
+	"""
+
+	def __init__(self, name, url=None, hflip=False, vflip=False, rotate=False, deadline=None):
+		self.name = name
+		self.url = url
+		self.hflip = hflip
+		self.vflip = vflip
+		self.rotate = rotate
+		self.deadline = deadline
+
+	def __repr__(self):
+		return "Camera({!r}, url={!r})".format(self.name, self.url)
+
+
+def parse_cameras(sources):
+	"""
+	Turns the ``cameras.sources`` setting into :class:`Camera` instances, skipping disabled sources and
+	sources without a snapshot URL.
+
+	Tests:
+
+		>>> cameras = parse_cameras([dict(name="nozzle", snapshot="http://nozzle/snapshot", flipH=True, deadline="2.5"),
+		...                          dict(name="room", snapshot="http://room/snapshot", enabled=False),
+		...                          dict(snapshot="http://10.0.0.2/snapshot"),
+		...                          dict(name="unset", snapshot=""),
+		...                          dict(name="typo", snapshot="http://typo/snapshot", deadline="fast")])
+		>>> cameras
+		[Camera('nozzle', url='http://nozzle/snapshot'), Camera('camera3', url='http://10.0.0.2/snapshot'), Camera('typo', url='http://typo/snapshot')]
+		>>> cameras[0].hflip, cameras[0].vflip, cameras[0].deadline, cameras[1].deadline, cameras[2].deadline
+		(True, False, 2.5, None, None)
+	"""
+
+	cameras = []
+	for index, source in enumerate(sources or []):
+		if not isinstance(source, dict) or not source.get("enabled", True) or not source.get("snapshot"):
+			continue
+
+		try:
+			deadline = float(source["deadline"]) if source.get("deadline") not in (None, "") else None
+		except ValueError:
+			deadline = None
+
+		cameras.append(Camera(source.get("name") or "camera{}".format(index + 1),
+		                      url=source["snapshot"],
+		                      hflip=bool(source.get("flipH")),
+		                      vflip=bool(source.get("flipV")),
+		                      rotate=bool(source.get("rotate90")),
+		                      deadline=deadline))
+	return cameras
+
+
+class CapturePool(object):
+	"""
+	Takes the snapshots of several cameras at the same time on a small pool of worker threads.
+
+	:meth:`capture` returns as soon as every camera has either delivered or run past its deadline,
+	so the time it takes is that of the slowest camera that made its deadline, not the sum of all of
+	them. Cameras that are late or fail are left out of the result, a late snapshot arriving after
+	that is thrown away.
+
+	A worker still stuck on a camera that already missed its deadline doesn't count against
+	``workers``, so a camera that never answers can't starve the others of workers on later
+	captures.
+
+	Tests:
+
+		>>> never = threading.Event()
+		>>> def take(camera, timeout):
+		...     if camera.name == "dead":
+		...         never.wait()
+		...     return camera.name
+		>>> pool = CapturePool(workers=2)
+		>>> cameras = [Camera("dead", url="http://dead/snapshot"), Camera("nozzle", url="http://nozzle/snapshot")]
+		>>> [[camera.name for camera, _ in pool.capture(cameras, take, 0.2)] for _ in range(4)]
+		[['nozzle'], ['nozzle'], ['nozzle'], ['nozzle']]
+		>>> never.set()
+		>>> pool.shutdown()
+	"""
+
+	def __init__(self, workers=3, logger=None):
+		self._workers = max(1, workers)
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._queue = collections.deque()
+		self._condition = threading.Condition()
+		self._threads = []
+		self._busy = dict()
+		self._running = True
+
+	def set_workers(self, workers):
+		with self._condition:
+			self._workers = max(1, workers)
+
+	def capture(self, cameras, take, deadline):
+		"""
+		Calls ``take(camera, timeout)`` for all ``cameras`` in parallel, allowing each ``camera.deadline``
+		seconds, or ``deadline`` seconds if it has none. ``timeout`` is what is left of that by the time
+		the camera gets a worker and should be used as the timeout of whatever ``take`` waits for.
+
+		Returns a list of ``(camera, snapshot)`` tuples, in the order of ``cameras``, for the cameras
+		that delivered in time.
+		"""
+
+		start = time.time()
+		batch = _Batch(len(cameras))
+		deadlines = [start + (camera.deadline if camera.deadline is not None else deadline) for camera in cameras]
+
+		with self._condition:
+			if not self._running:
+				return []
+			for index, camera in enumerate(cameras):
+				self._queue.append((batch, index, camera, take, deadlines[index]))
+			self._start_workers()
+			self._condition.notify_all()
+
+		results = batch.wait(deadlines)
+
+		snapshots = []
+		for camera, result in zip(cameras, results):
+			if result is None:
+				self._logger.warn("Snapshot of camera {} missed its deadline, leaving it out".format(camera.name))
+			elif isinstance(result, _Failure):
+				self._logger.warn("Could not take a snapshot of camera {}, leaving it out: {}".format(camera.name,
+				                                                                                       result.error))
+			else:
+				snapshots.append((camera, result))
+		return snapshots
+
+	def shutdown(self):
+		with self._condition:
+			self._running = False
+			self._queue.clear()
+			self._condition.notify_all()
+
+	##~~ internals
+
+	def _available(self):
+		# must be called with the condition held, workers stuck on a capture that is over already don't count
+		self._threads = [thread for thread in self._threads if thread.is_alive()]
+		return [thread for thread in self._threads if thread not in self._busy or not self._busy[thread].closed]
+
+	def _start_workers(self):
+		# must be called with the condition held, workers are only started once there is something to capture
+		available = len(self._available())
+		while available < min(self._workers, len(self._queue) + available):
+			thread = threading.Thread(target=self._work, name="OctobulletCapture-{}".format(len(self._threads)))
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+			available += 1
+
+	def _work(self):
+		current = threading.current_thread()
+		while True:
+			with self._condition:
+				self._busy.pop(current, None)
+				if len(self._available()) > self._workers:
+					# more were started while this one was stuck
+					self._threads.remove(current)
+					return
+				while self._running and not self._queue:
+					self._condition.wait()
+				if not self._running:
+					return
+				batch, index, camera, take, deadline = self._queue.popleft()
+				self._busy[current] = batch
+
+			if batch.closed:
+				continue
+
+			try:
+				result = take(camera, max(0.0, deadline - time.time()))
+			except Exception as e:
+				result = _Failure(e)
+			batch.done(index, result)
+
+
+class _Failure(object):
+	def __init__(self, error):
+		self.error = error
+
+
+class _Batch(object):
+	def __init__(self, size):
+		self._condition = threading.Condition()
+		self._results = [None] * size
+		self._finished = [None] * size
+		self._closed = False
+
+	@property
+	def closed(self):
+		with self._condition:
+			return self._closed
+
+	def done(self, index, result):
+		with self._condition:
+			if self._closed:
+				return
+			self._results[index] = result
+			self._finished[index] = time.time()
+			self._condition.notify_all()
+
+	def wait(self, deadlines):
+		with self._condition:
+			while True:
+				now = time.time()
+				waiting = [deadline for deadline, finished in zip(deadlines, self._finished)
+				           if finished is None and deadline > now]
+				if not waiting:
+					break
+				self._condition.wait(max(waiting) - now)
+
+			self._closed = True
+			# a camera that only delivered after its own deadline, while others were still being waited for,
+			# is as late as one that never delivered
+			return [result if finished is not None and finished <= deadline else None
+			        for result, finished, deadline in zip(self._results, self._finished, deadlines)]
@@ -0,0 +1,221 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import logging
+import threading
+import time
+
+
+class ClientCache(object):
+	"""
+	Caches Pushbullet clients per access token, together with an index of the account's channels by tag.
+
+	Creating a client lists the account's devices, chats, user info and channels, so reusing a cached
+	client saves all of those round trips on reconnects and test pushes. Entries expire after ``ttl``
+	seconds (never if ``ttl`` is ``None`` or 0) or when explicitly invalidated.
+	"""
+
+	def __init__(self, factory, ttl=None, logger=None):
+		self._factory = factory
+		self._ttl = ttl
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._entries = dict()
+		self._lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+
+	def set_ttl(self, ttl):
+		self._ttl = ttl
+
+	def get(self, token):
+		"""
+		Returns ``(client, channels)`` for ``token``, with ``channels`` mapping channel tags to channel objects.
+
+		Errors raised by the factory (e.g. an invalid key) are passed on and not cached.
+		"""
+
+		now = time.time()
+		with self._lock:
+			entry = self._entries.get(token)
+			if entry is not None and self._ttl and now - entry[2] > self._ttl:
+				del self._entries[token]
+				entry = None
+
+			if entry is not None:
+				self.hits += 1
+				self._log_usage("hit")
+				return entry[0], entry[1]
+
+			self.misses += 1
+			self._log_usage("miss")
+
+		# creating the client talks to the API, so don't hold the lock for that
+		client = self._factory(token)
+		channels = dict((channel.channel_tag, channel) for channel in client.channels)
+
+		with self._lock:
+			self._entries[token] = (client, channels, now)
+		return client, channels
+
+	def invalidate(self, token=None):
+		with self._lock:
+			if token is None:
+				self._entries.clear()
+			else:
+				self._entries.pop(token, None)
+
+	def _log_usage(self, result):
+		self._logger.debug("Pushbullet client cache {} (hits: {}, misses: {})".format(result, self.hits, self.misses))
+
+
+class Reconnector(object):
+	"""
+	Runs connection attempts on a single long-lived thread, debounced and in order.
+
+	Each :meth:`request` supersedes all earlier ones: an attempt is only started once no newer
+	request came in for ``delay`` seconds, and the result of an attempt that was superseded while it
+	was running is discarded instead of being handed to ``apply``. So however many requests come in,
+	the last one always wins and there is never more than one attempt in flight.
+
+	Tests:
+
+		>>> release = threading.Event()
+		>>> attempts, applied = [], []
+		>>> def connect(token):
+		...     attempts.append(token)
+		...     if token == "slow":
+		...         release.wait()
+		...     return token
+		>>> reconnector = Reconnector(connect, applied.append, delay=0.1)
+		>>> reconnector.start()
+		>>> for token in ("first", "second", "third"):
+		...     reconnector.request(token)
+		>>> reconnector.wait(timeout=5), attempts, applied, reconnector.superseded
+		(True, ['third'], ['third'], 2)
+
+		An attempt superseded while it is running doesn't get applied:
+
+		>>> reconnector.request("slow", delay=0)
+		>>> deadline = time.time() + 5
+		>>> while "slow" not in attempts and time.time() < deadline:
+		...     time.sleep(0.01)
+		>>> reconnector.request("fast", delay=0)
+		>>> release.set()
+		>>> reconnector.wait(timeout=5), attempts, applied, reconnector.superseded
+		(True, ['third', 'slow', 'fast'], ['third', 'fast'], 3)
+		>>> reconnector.stop()
+	"""
+
+	def __init__(self, connect, apply, delay=0.5, logger=None):
+		self._connect = connect
+		self._apply = apply
+		self._delay = delay
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._condition = threading.Condition()
+		self._thread = None
+		self._running = False
+
+		self._pending = None
+		self._due = None
+		self._generation = 0
+		self._busy = False
+
+		self.superseded = 0
+
+	def start(self):
+		with self._condition:
+			if self._thread is not None:
+				return
+			self._running = True
+			self._thread = threading.Thread(target=self._work, name="OctobulletReconnect")
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self):
+		with self._condition:
+			self._running = False
+			self._condition.notify_all()
+
+	def request(self, *args, **kwargs):
+		"""
+		Asks for a connection attempt with ``args``, returns immediately.
+
+		A ``delay`` keyword overrides the debounce delay for this request, e.g. ``delay=0`` to connect
+		right away.
+		"""
+
+		delay = kwargs.get("delay", self._delay)
+		with self._condition:
+			if self._pending is not None:
+				self.superseded += 1
+			self._generation += 1
+			self._pending = args
+			self._due = time.time() + delay
+			self._condition.notify_all()
+
+	def wait(self, timeout=None):
+		"""
+		Waits up to ``timeout`` seconds until no connection attempt is pending or running anymore.
+
+		Returns whether that is the case.
+		"""
+
+		deadline = time.time() + timeout if timeout is not None else None
+		with self._condition:
+			while self._running and (self._pending is not None or self._busy):
+				remaining = deadline - time.time() if deadline is not None else None
+				if remaining is not None and remaining <= 0:
+					return False
+				self._condition.wait(remaining)
+			return True
+
+	##~~ internals
+
+	def _work(self):
+		while True:
+			with self._condition:
+				while self._running:
+					now = time.time()
+					if self._pending is not None and self._due <= now:
+						break
+					self._condition.wait(self._due - now if self._pending is not None else None)
+				else:
+					return
+
+				args, generation = self._pending, self._generation
+				self._pending = None
+				self._busy = True
+
+			try:
+				result = self._connect(*args)
+			except Exception:
+				self._logger.exception("Error while connecting")
+				result = None
+				failed = True
+			else:
+				failed = False
+
+			with self._condition:
+				# waiters only get the lock back once the result has been applied
+				self._busy = False
+				self._condition.notify_all()
+
+				if failed:
+					continue
+
+				if generation != self._generation:
+					self.superseded += 1
+					self._logger.debug("Discarding the result of a superseded connection attempt")
+					continue
+
+				try:
+					self._apply(result)
+				except Exception:
+					self._logger.exception("Error while applying a new connection")
@@ -0,0 +1,209 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import logging
+import os
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import urlparse
+
+from .ratelimit import RateBudget
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+	"""
+	HTTP adapter that applies a default ``(connect, read)`` timeout to every request sent through it.
+
+	The pushbullet library never passes a timeout, so without this a dead network would block the
+	sender forever.
+	"""
+
+	def __init__(self, timeout=None, **kwargs):
+		self.timeout = timeout
+		HTTPAdapter.__init__(self, **kwargs)
+
+	def send(self, request, timeout=None, **kwargs):
+		if timeout is None:
+			timeout = self.timeout
+		return HTTPAdapter.send(self, request, timeout=timeout, **kwargs)
+
+
+class MultipartFileBody(object):
+	"""
+	``multipart/form-data`` body of a file upload that reads the file in chunks while it is being sent.
+
+	requests builds multipart bodies passed as ``files`` in memory, so memory use would grow with the
+	size of the uploaded file. This has a known length (so it is sent with a ``Content-Length`` as
+	the upload endpoint requires) and can be iterated more than once in case the request is retried.
+
+	Tests:
+
+		>>> import io
+		>>> body = MultipartFileBody(dict(key="value"), "file", "test.txt", io.BytesIO(b"0123456789"), "text/plain",
+		...                          chunk_size=4, boundary="b")
+		>>> chunks = list(body)
+		>>> chunks[1:4]
+		[b'0123', b'4567', b'89']
+		>>> len(body) == len(b"".join(chunks))
+		True
+		>>> print(b"".join(chunks).decode("ascii").replace("\\r\\n", "|"))
+		--b|Content-Disposition: form-data; name="key"||value|--b|Content-Disposition: form-data; name="file"; filename="test.txt"|Content-Type: text/plain||0123456789|--b--|
+	"""
+
+	def __init__(self, fields, name, file_name, f, file_type, chunk_size=64 * 1024, boundary=None):
+		self.boundary = boundary or uuid.uuid4().hex
+		self._f = f
+		self._chunk_size = chunk_size
+
+		head = []
+		for key, value in sorted((fields or dict()).items()):
+			head.append("--{}\r\nContent-Disposition: form-data; name=\"{}\"\r\n\r\n{}\r\n".format(self.boundary,
+			                                                                                          _quote(key),
+			                                                                                          value))
+		head.append("--{}\r\nContent-Disposition: form-data; name=\"{}\"; filename=\"{}\"\r\n"
+		            "Content-Type: {}\r\n\r\n".format(self.boundary, _quote(name), _quote(file_name), file_type))
+		self._head = "".join(head).encode("utf-8")
+		self._tail = "\r\n--{}--\r\n".format(self.boundary).encode("utf-8")
+
+		self._start = f.tell()
+		f.seek(0, os.SEEK_END)
+		self._size = f.tell() - self._start
+		f.seek(self._start)
+
+	@property
+	def content_type(self):
+		return "multipart/form-data; boundary={}".format(self.boundary)
+
+	def __len__(self):
+		return len(self._head) + self._size + len(self._tail)
+
+	def __iter__(self):
+		self._f.seek(self._start)
+		yield self._head
+		while True:
+			chunk = self._f.read(self._chunk_size)
+			if not chunk:
+				break
+			yield chunk
+		yield self._tail
+
+
+def _quote(value):
+	return value.replace("\\", "\\\\").replace("\"", "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+class ConnectionPool(object):
+	"""
+	Long-lived HTTP connection pools shared by all webcam and Pushbullet requests of the plugin.
+
+	Webcam snapshots go through :attr:`webcam`, a session kept alive across notifications. Pushbullet
+	clients created through :class:`PooledPushBullet` mount the shared API adapter on their own
+	(authenticated) session, so keep-alive connections to the API are reused no matter which client
+	or channel a push is sent through.
+	"""
+
+	def __init__(self, pool_size=4, webcam_timeout=None, api_timeout=None, logger=None):
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self.ratelimited_until = None
+		self.budget = RateBudget()
+
+		self._webcam_adapter = TimeoutHTTPAdapter(timeout=webcam_timeout,
+		                                          pool_connections=pool_size,
+		                                          pool_maxsize=pool_size)
+		self._api_adapter = TimeoutHTTPAdapter(timeout=api_timeout,
+		                                       pool_connections=pool_size,
+		                                       pool_maxsize=pool_size)
+
+		self.webcam = requests.Session()
+		self.webcam.verify = False
+		self.mount_webcam(self.webcam)
+
+		self.upload = requests.Session()
+		self.mount_api(self.upload)
+
+	def set_timeouts(self, webcam_timeout=None, api_timeout=None):
+		self._webcam_adapter.timeout = webcam_timeout
+		self._api_adapter.timeout = api_timeout
+
+	def mount_webcam(self, session):
+		self._mount(session, self._webcam_adapter)
+
+	def mount_api(self, session):
+		# only Pushbullet's responses say anything about its rate limit, a 429 from a webcam or a proxy
+		# in front of it must not hold back the outbox
+		self._mount(session, self._api_adapter, hooks=(self._track_ratelimit,))
+
+	def stats(self):
+		"""
+		Returns a dict of ``host => (requests, connections)`` for all pools, the difference between the two
+		being the number of requests that reused an already open connection.
+		"""
+
+		result = dict()
+		for adapter in (self._webcam_adapter, self._api_adapter):
+			pools = adapter.poolmanager.pools
+			for key in list(pools.keys()):
+				pool = pools.get(key)
+				if pool is None:
+					continue
+				host = "{}://{}:{}".format(pool.scheme, pool.host, pool.port)
+				requests_sent, connections = result.get(host, (0, 0))
+				result[host] = (requests_sent + pool.num_requests, connections + pool.num_connections)
+		return result
+
+	def close(self):
+		self.webcam.close()
+		self.upload.close()
+
+	def _mount(self, session, adapter, hooks=()):
+		session.mount("https://", adapter)
+		session.mount("http://", adapter)
+		for hook in tuple(hooks) + (self._log_timing,):
+			if hook not in session.hooks["response"]:
+				session.hooks["response"].append(hook)
+
+	def track_ratelimit(self, status_code, headers):
+		"""
+		Updates the rate limit budget from the headers of a Pushbullet response, for clients that don't
+		go through a session mounted here.
+		"""
+
+		self.budget.update(headers)
+
+		if status_code != 429:
+			return
+
+		try:
+			reset = float(headers.get("X-Ratelimit-Reset"))
+		except (TypeError, ValueError):
+			# no usable reset time, back off for a minute
+			reset = time.time() + 60
+		self.ratelimited_until = reset
+		self._logger.warn("Pushbullet rate limit reached, not retrying before {}".format(time.ctime(reset)))
+
+	def _track_ratelimit(self, response, *args, **kwargs):
+		self.track_ratelimit(response.status_code, response.headers)
+
+	def _log_timing(self, response, *args, **kwargs):
+		if not self._logger.isEnabledFor(logging.DEBUG):
+			return
+
+		request = response.request
+		url = urlparse(request.url)
+		host = "{}://{}:{}".format(url.scheme, url.hostname, url.port or (443 if url.scheme == "https" else 80))
+		requests_sent, connections = self.stats().get(host, (0, 0))
+
+		self._logger.debug("{method} {url} took {duration:.0f}ms, "
+		                   "{requests} requests over {connections} connections so far".format(method=request.method,
+		                                                                                     url=host + url.path,
+		                                                                                     duration=response.elapsed.total_seconds() * 1000,
+		                                                                                     requests=requests_sent,
+		                                                                                     connections=connections))
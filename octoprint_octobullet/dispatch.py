@@ -0,0 +1,325 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import collections
+import logging
+import threading
+import time
+
+from .ratelimit import PRIORITY_LOW, PRIORITY_HIGH
+
+
+JOB_DONE = "done"
+JOB_PROGRESS = "progress"
+JOB_DIGEST = "digest"
+JOB_MOVIE = "movie"
+JOB_ALERT = "alert"
+JOB_REPLY = "reply"
+
+BACKEND_THREADS = "threads"
+BACKEND_ASYNCIO = "asyncio"
+
+# jobs of these kinds may be discarded when the queue overflows, everything else is always delivered
+_DROPPABLE_KINDS = (JOB_PROGRESS,)
+
+# queued jobs of these kinds are replaced by newer jobs of the same kind and key
+_SUPERSEDABLE_KINDS = (JOB_PROGRESS,)
+
+# rate limit priority of each kind, anything not listed here is of high priority
+_PRIORITIES = {JOB_PROGRESS: PRIORITY_LOW}
+
+
+class NotificationJob(object):
+	"""
+	A single notification waiting for delivery.
+
+	Jobs are created on OctoPrint's event and progress threads and handed over to the
+	:class:`NotificationDispatcher`, which does all the (slow) webcam and Pushbullet work on
+	its own worker threads.
+
+	``device`` is the iden of the Pushbullet device a reply goes to instead of the configured
+	channel, e.g. the phone a command came from.
+	"""
+
+	def __init__(self, title, body, filename=None, kind=JOB_DONE, key=None, attachments=None, path=None,
+	             snapshot=True, created=None, event=None, priority=None, device=None):
+		self.title = title
+		self.body = body
+		self.filename = filename
+		self.kind = kind
+		self.event = event
+		self._priority = priority
+		self.device = device
+		self.key = key
+		self.attachments = attachments or []
+		self.path = path
+		self.snapshot = snapshot
+		self.created = created if created is not None else time.time()
+
+	@classmethod
+	def from_dict(cls, data):
+		return cls(data["title"], data["body"],
+		           filename=data.get("filename"),
+		           kind=data.get("kind", JOB_DONE),
+		           key=data.get("key"),
+		           attachments=data.get("attachments"),
+		           path=data.get("path"),
+		           snapshot=data.get("snapshot", True),
+		           created=data.get("created"),
+		           event=data.get("event"),
+		           priority=data.get("priority"),
+		           device=data.get("device"))
+
+	def as_dict(self):
+		return dict(title=self.title,
+		            body=self.body,
+		            filename=self.filename,
+		            kind=self.kind,
+		            key=self.key,
+		            attachments=self.attachments,
+		            path=self.path,
+		            snapshot=self.snapshot,
+		            created=self.created,
+		            event=self.event,
+		            priority=self._priority,
+		            device=self.device)
+
+	@property
+	def droppable(self):
+		return self.kind in _DROPPABLE_KINDS
+
+	@property
+	def priority(self):
+		if self._priority is not None:
+			return self._priority
+		return _PRIORITIES.get(self.kind, PRIORITY_HIGH)
+
+	@property
+	def supersedable(self):
+		return self.kind in _SUPERSEDABLE_KINDS and self.key is not None
+
+	def __repr__(self):
+		return "NotificationJob(kind={!r}, title={!r})".format(self.kind, self.title)
+
+
+class NotificationDispatcher(object):
+	"""
+	Bounded notification queue processed by one or more worker threads.
+
+	A new progress update replaces a still queued progress update for the same print job in place,
+	as only the most recent one is of any interest.
+
+	If the queue is full when a new job arrives, the oldest droppable job (a progress update)
+	is discarded to make room. If there is none, a new droppable job is discarded instead. Jobs
+	that are not droppable (e.g. print done) are never discarded, even if that means exceeding
+	the configured queue size.
+
+	Jobs that are not droppable but arrive after :meth:`shutdown` was called are handed to
+	``rejected`` instead, e.g. to keep them for a retry after the next start.
+
+	Tests:
+
+		>>> rejected = []
+		>>> dispatcher = NotificationDispatcher(lambda job: None, queue_size=3, rejected=rejected.append)
+		>>> def progress(percent, key="benchy"):
+		...     return NotificationJob("{} at {}%".format(key, percent), "", kind=JOB_PROGRESS, key=key)
+		>>> dispatcher.submit(progress(10)), dispatcher.submit(NotificationJob("cube done", "", kind=JOB_DONE))
+		(True, True)
+		>>> dispatcher.submit(progress(20)), dispatcher.superseded, dispatcher.pending
+		(True, 1, 2)
+		>>> dispatcher.submit(progress(10, key="calibration"))
+		True
+		>>> dispatcher.submit(NotificationJob("benchy done", "", kind=JOB_DONE)), dispatcher.dropped
+		(True, 1)
+		>>> dispatcher.submit(NotificationJob("calibration failed", "", kind=JOB_ALERT)), dispatcher.dropped
+		(True, 2)
+		>>> dispatcher.submit(progress(30)), dispatcher.dropped
+		(False, 3)
+		>>> dispatcher.submit(NotificationJob("vase done", "", kind=JOB_DONE)), dispatcher.pending
+		(True, 4)
+		>>> [job.title for job in dispatcher.shutdown(timeout=0)]
+		['cube done', 'benchy done', 'calibration failed', 'vase done']
+		>>> dispatcher.pending
+		0
+		>>> dispatcher.submit(NotificationJob("late done", "", kind=JOB_DONE)), dispatcher.submit(progress(40))
+		(False, False)
+		>>> [job.title for job in rejected]
+		['late done']
+	"""
+
+	def __init__(self, handler, queue_size=10, workers=1, rejected=None, logger=None):
+		self._handler = handler
+		self._rejected = rejected
+		self._queue_size = max(1, queue_size)
+		self._worker_count = max(1, workers)
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._queue = collections.deque()
+		self._condition = threading.Condition()
+		self._workers = []
+		self._accepting = True
+		self._dropped = 0
+		self._superseded = 0
+
+	@property
+	def dropped(self):
+		return self._dropped
+
+	@property
+	def superseded(self):
+		return self._superseded
+
+	@property
+	def pending(self):
+		with self._condition:
+			return len(self._queue)
+
+	def set_queue_size(self, queue_size):
+		with self._condition:
+			self._queue_size = max(1, queue_size)
+
+	def start(self):
+		with self._condition:
+			if self._workers:
+				return
+
+			for index in range(self._worker_count):
+				worker = threading.Thread(target=self._work, name="OctobulletDispatch-{}".format(index))
+				worker.daemon = True
+				worker.start()
+				self._workers.append(worker)
+
+	def submit(self, job):
+		"""
+		Queues ``job`` for delivery, returns ``True`` if it was accepted and ``False`` if it was discarded.
+
+		Never blocks on anything but the queue's own lock, so it is safe to call from event callbacks.
+		"""
+
+		with self._condition:
+			accepting = self._accepting
+
+		if not accepting:
+			if job.droppable or self._rejected is None:
+				self._logger.warn("Dispatcher is shutting down, discarding {!r}".format(job))
+			else:
+				self._logger.info("Dispatcher is shutting down, handing over {!r}".format(job))
+				self._rejected(job)
+			return False
+
+		with self._condition:
+			if job.supersedable:
+				for index, queued in enumerate(self._queue):
+					if queued.kind == job.kind and queued.key == job.key:
+						self._queue[index] = job
+						self._superseded += 1
+						self._logger.debug("Replaced queued {!r} with {!r}".format(queued, job))
+						return True
+
+			if len(self._queue) >= self._queue_size and not self._make_room(job):
+				return False
+
+			self._queue.append(job)
+			self._condition.notify()
+			return True
+
+	def shutdown(self, timeout=None):
+		"""
+		Stops accepting new jobs and waits up to ``timeout`` seconds for the queue to drain.
+
+		Returns the jobs that could not be delivered in time. They are taken off the queue, so the
+		workers don't start on them anymore once this returns.
+		"""
+
+		with self._condition:
+			self._accepting = False
+			self._condition.notify_all()
+			workers = list(self._workers)
+
+		deadline = time.time() + timeout if timeout is not None else None
+		for worker in workers:
+			if deadline is None:
+				worker.join()
+			else:
+				worker.join(max(0, deadline - time.time()))
+
+		with self._condition:
+			remaining = list(self._queue)
+			self._queue.clear()
+		if remaining:
+			self._logger.warn("Could not deliver {} queued notification(s) before shutdown".format(len(remaining)))
+		return remaining
+
+	##~~ internals
+
+	def _make_room(self, job):
+		# must be called with the condition held
+		for queued in self._queue:
+			if queued.droppable:
+				self._queue.remove(queued)
+				self._dropped += 1
+				self._logger.info("Notification queue is full, dropped oldest queued {!r}".format(queued))
+				return True
+
+		if job.droppable:
+			self._dropped += 1
+			self._logger.info("Notification queue is full, dropped {!r}".format(job))
+			return False
+
+		# never drop anything that isn't droppable, rather exceed the queue size
+		return True
+
+	def _work(self):
+		while True:
+			with self._condition:
+				while not self._queue and self._accepting:
+					self._condition.wait()
+
+				if not self._queue:
+					# shutting down and drained
+					return
+
+				job = self._queue.popleft()
+
+			try:
+				self._handler(job)
+			except Exception:
+				self._logger.exception("Error while delivering {!r}".format(job))
+
+
+class DigestCollector(object):
+	"""
+	Collects items for ``window`` seconds after the first one arrived and then hands all of them to ``flush`` at once.
+
+	``flush`` is called on a timer thread, so it should do nothing more than queue the digest.
+	"""
+
+	def __init__(self, window, flush):
+		self._window = window
+		self._flush = flush
+
+		self._items = []
+		self._timer = None
+		self._lock = threading.Lock()
+
+	def add(self, item):
+		with self._lock:
+			self._items.append(item)
+			if self._timer is None:
+				self._timer = threading.Timer(self._window, self.flush)
+				self._timer.daemon = True
+				self._timer.start()
+
+	def flush(self):
+		with self._lock:
+			items, self._items = self._items, []
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+
+		if items:
+			self._flush(items)
@@ -0,0 +1,222 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import collections
+import logging
+import threading
+import time
+
+
+_SOI = b"\xff\xd8"
+_EOI = b"\xff\xd9"
+
+
+def extract_frames(buffer, max_frame_bytes=None):
+	"""
+	Splits complete JPEG frames off an MJPEG stream buffer, returns them and the unprocessed rest.
+
+	Frames are found by their start and end of image markers, so it doesn't matter how the stream
+	frames them (multipart boundaries, headers or none at all). An incomplete frame growing beyond
+	``max_frame_bytes`` is thrown away.
+
+	Tests:
+
+		>>> extract_frames(b"--boundary\\r\\n\\r\\n\\xff\\xd8one\\xff\\xd9\\r\\n--boundary\\r\\n\\xff\\xd8tw")
+		([b'\\xff\\xd8one\\xff\\xd9'], b'\\xff\\xd8tw')
+		>>> extract_frames(b"\\xff\\xd8a\\xff\\xd9\\xff\\xd8b\\xff\\xd9")
+		([b'\\xff\\xd8a\\xff\\xd9', b'\\xff\\xd8b\\xff\\xd9'], b'')
+		>>> extract_frames(b"no frame here")
+		([], b'')
+		>>> extract_frames(b"\\xff\\xd8far too long", max_frame_bytes=4)
+		([], b'')
+	"""
+
+	frames = []
+	while True:
+		start = buffer.find(_SOI)
+		if start < 0:
+			# keep a trailing 0xff, it might be the first half of the next start marker
+			return frames, buffer[-1:] if buffer.endswith(b"\xff") else b""
+
+		end = buffer.find(_EOI, start + 2)
+		if end < 0:
+			rest = buffer[start:]
+			if max_frame_bytes and len(rest) > max_frame_bytes:
+				rest = b""
+			return frames, rest
+
+		frames.append(buffer[start:end + 2])
+		buffer = buffer[end + 2:]
+
+
+class NoFrameError(Exception):
+	pass
+
+
+class FrameGrabber(object):
+	"""
+	Reads the webcam's MJPEG stream on a background thread and keeps its most recent frames in a ring buffer.
+
+	Taking a snapshot then costs nothing but a lookup, instead of a request to the (often slow or
+	missing) snapshot URL. The stream is only read while there is demand for it: between
+	:meth:`begin` and :meth:`end` (e.g. while printing), plus ``linger`` seconds after that to cover
+	notifications still being delivered, or after :meth:`latest` was asked to wait for a frame.
+	"""
+
+	def __init__(self, url, session=None, frames=2, max_age=2.0, linger=30.0, max_frame_bytes=8 * 1024 * 1024,
+	             chunk_size=16 * 1024, logger=None):
+		self._url = url
+		self._session = session
+		self._max_age = max_age
+		self._linger = linger
+		self._max_frame_bytes = max_frame_bytes
+		self._chunk_size = chunk_size
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._frames = collections.deque(maxlen=max(1, frames))
+		self._condition = threading.Condition()
+		self._thread = None
+		self._response = None
+		self._demand = 0
+		self._wanted_until = 0
+		self._stopped = False
+
+		self.frames_read = 0
+
+	@property
+	def running(self):
+		return self._thread is not None
+
+	def begin(self):
+		with self._condition:
+			self._demand += 1
+			self._start()
+
+	def end(self):
+		with self._condition:
+			self._demand = max(0, self._demand - 1)
+			self._wanted_until = time.time() + self._linger
+
+	def latest(self, timeout=0):
+		"""
+		Returns the most recent frame if it's at most ``max_age`` seconds old, ``None`` otherwise.
+
+		With a ``timeout``, the grabber is started if necessary and up to ``timeout`` seconds are
+		spent waiting for a fresh frame.
+		"""
+
+		deadline = time.time() + timeout
+		with self._condition:
+			if timeout:
+				self._wanted_until = max(self._wanted_until, time.time() + self._linger)
+				self._start()
+
+			while True:
+				if self._frames:
+					timestamp, frame = self._frames[-1]
+					if time.time() - timestamp <= self._max_age:
+						return frame
+
+				remaining = deadline - time.time()
+				if remaining <= 0 or not self.running:
+					return None
+				self._condition.wait(remaining)
+
+	def stop(self):
+		with self._condition:
+			self._stopped = True
+			self._demand = 0
+			self._wanted_until = 0
+			response = self._response
+			self._condition.notify_all()
+
+		if response is not None:
+			# unblocks a pending read
+			try:
+				response.close()
+			except Exception:
+				pass
+
+	##~~ internals
+
+	def _start(self):
+		# must be called with the condition held
+		if self._thread is not None or self._stopped:
+			return
+		self._thread = threading.Thread(target=self._work, name="OctobulletFrameGrabber")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _wanted(self):
+		return not self._stopped and (self._demand > 0 or time.time() < self._wanted_until)
+
+	def _work(self):
+		self._logger.info("Starting to grab frames from {}".format(self._url))
+		try:
+			while True:
+				with self._condition:
+					if not self._wanted():
+						# in the same locked section, so a begin() right after this starts a new thread
+						self._finish()
+						return
+
+				try:
+					self._read_stream()
+				except Exception as e:
+					if self._wanted():
+						self._logger.warn("Error while reading the webcam stream: {}".format(e))
+
+				with self._condition:
+					if not self._wanted():
+						self._finish()
+						return
+					# don't hammer a webcam server that keeps closing the stream
+					self._condition.wait(1.0)
+		finally:
+			with self._condition:
+				if self._thread is threading.current_thread():
+					# died from an unexpected error
+					self._finish()
+			self._logger.info("Stopped grabbing frames from {}".format(self._url))
+
+	def _finish(self):
+		# must be called with the condition held
+		self._thread = None
+		self._response = None
+		self._frames.clear()
+		self._condition.notify_all()
+
+	def _read_stream(self):
+		session = self._session
+		if session is None:
+			import requests
+			session = requests
+
+		response = session.get(self._url, stream=True, verify=False)
+		with self._condition:
+			self._response = response
+
+		try:
+			response.raise_for_status()
+
+			buffer = b""
+			for chunk in response.iter_content(self._chunk_size):
+				frames, buffer = extract_frames(buffer + chunk, max_frame_bytes=self._max_frame_bytes)
+				if not frames:
+					continue
+
+				with self._condition:
+					now = time.time()
+					for frame in frames:
+						self._frames.append((now, frame))
+					self.frames_read += len(frames)
+					self._condition.notify_all()
+
+					if not self._wanted():
+						return
+		finally:
+			response.close()
@@ -0,0 +1,246 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import collections
+import io
+import json
+import logging
+import os
+import threading
+
+
+STATUS_DELIVERED = "delivered"
+STATUS_NOTE = "note"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+
+STATUSES = (STATUS_DELIVERED, STATUS_NOTE, STATUS_FAILED, STATUS_SKIPPED)
+
+# titles are cut off after this many characters, so every record takes about the same amount of memory
+_MAX_TITLE_LENGTH = 100
+
+
+class DeliveryRecord(object):
+	"""
+	What happened to a single notification: when it was created, when its delivery started and
+	finished, and how it ended. ``status`` is one of
+
+	* ``delivered``: sent as intended
+	* ``note``: sent, but only as a plain note because the snapshot or file could not be sent
+	* ``failed``: not sent (it might still be retried from the outbox, which is recorded separately)
+	* ``skipped``: not sent to save what was left of the rate limit
+	"""
+
+	__slots__ = ("kind", "event", "title", "status", "created", "started", "finished", "retry")
+
+	def __init__(self, kind, event, title, status, created, started, finished, retry=False):
+		self.kind = kind
+		self.event = event
+		self.title = title[:_MAX_TITLE_LENGTH] if title else title
+		self.status = status
+		self.created = created
+		self.started = started
+		self.finished = finished
+		self.retry = retry
+
+	@classmethod
+	def from_dict(cls, data):
+		return cls(data["kind"], data.get("event"), data.get("title"), data["status"],
+		           data["created"], data["started"], data["finished"],
+		           retry=data.get("retry", False))
+
+	def as_dict(self):
+		return dict(kind=self.kind,
+		            event=self.event,
+		            title=self.title,
+		            status=self.status,
+		            created=self.created,
+		            started=self.started,
+		            finished=self.finished,
+		            retry=self.retry)
+
+	def __repr__(self):
+		return "DeliveryRecord(kind={!r}, status={!r}, finished={!r})".format(self.kind, self.status, self.finished)
+
+
+class DeliveryHistory(object):
+	"""
+	The last ``capacity`` deliveries, in a ring buffer that is allocated once and overwritten from then on.
+
+	Adding a record is O(1) and memory use is bounded by the capacity no matter how long OctoPrint
+	runs. If a ``path`` is given, every record is also appended to that file (one JSON record per
+	line), from which the history is restored on :meth:`load`. Once the file grows beyond
+	``max_file_size`` bytes it is rotated to ``path + ".1"``, replacing the previous one, so at most
+	twice that ends up on disk.
+
+	Tests:
+
+		>>> history = DeliveryHistory(capacity=3)
+		>>> for index, status in enumerate([STATUS_DELIVERED, STATUS_FAILED, STATUS_NOTE, STATUS_DELIVERED]):
+		...     history.add(DeliveryRecord("done", "PrintDone", "Job {}".format(index), status, index, index, index + 0.5))
+		>>> len(history)
+		3
+		>>> [record.title for record in history.query()]
+		['Job 3', 'Job 2', 'Job 1']
+		>>> [record.title for record in history.query(status=STATUS_DELIVERED)]
+		['Job 3']
+		>>> [record.title for record in history.query(since=2.0, until=3.0)]
+		['Job 2']
+		>>> [record.title for record in history.query(limit=2)]
+		['Job 3', 'Job 2']
+		>>> history.resize(2)
+		>>> [record.title for record in history.query()]
+		['Job 3', 'Job 2']
+	"""
+
+	def __init__(self, capacity=200, path=None, max_file_size=1024 * 1024, logger=None):
+		self._capacity = max(1, capacity)
+		self._path = path
+		self._max_file_size = max_file_size
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._lock = threading.Lock()
+		self._records = [None] * self._capacity
+		self._next = 0
+		self._count = 0
+		self._file = None
+
+	def __len__(self):
+		with self._lock:
+			return self._count
+
+	@property
+	def capacity(self):
+		return self._capacity
+
+	@property
+	def path(self):
+		return self._path
+
+	@property
+	def max_file_size(self):
+		return self._max_file_size
+
+	def add(self, record):
+		with self._lock:
+			self._append(record)
+			if self._path is not None:
+				self._write(record)
+
+	def query(self, kind=None, event=None, status=None, since=None, until=None, limit=None):
+		"""
+		Returns the records matching all of the given filters, newest first. ``since`` and ``until``
+		are compared against the time the delivery finished.
+		"""
+
+		result = []
+		with self._lock:
+			for offset in range(1, self._count + 1):
+				if limit is not None and len(result) >= limit:
+					break
+
+				record = self._records[(self._next - offset) % self._capacity]
+				if kind is not None and record.kind != kind:
+					continue
+				if event is not None and record.event != event:
+					continue
+				if status is not None and record.status != status:
+					continue
+				if since is not None and record.finished < since:
+					continue
+				if until is not None and record.finished > until:
+					continue
+				result.append(record)
+		return result
+
+	def resize(self, capacity):
+		capacity = max(1, capacity)
+		with self._lock:
+			if capacity == self._capacity:
+				return
+			records = self._ordered()[-capacity:]
+			self._capacity = capacity
+			self._records = [None] * capacity
+			self._next = 0
+			self._count = 0
+			for record in records:
+				self._append(record)
+
+	def load(self):
+		"""
+		Restores the history from the file (and the rotated one before it), returns the number of
+		records restored.
+		"""
+
+		if self._path is None:
+			return 0
+
+		with self._lock:
+			# only the newest records fit anyway
+			records = collections.deque(maxlen=self._capacity)
+			for path in (self._path + ".1", self._path):
+				if not os.path.exists(path):
+					continue
+				try:
+					with io.open(path, "rb") as f:
+						for line in f:
+							try:
+								records.append(DeliveryRecord.from_dict(json.loads(line.decode("utf-8"))))
+							except (ValueError, KeyError, TypeError):
+								# most likely a partial write of the last record before a crash
+								continue
+				except IOError:
+					self._logger.exception("Could not read the delivery history from {}".format(path))
+
+			for record in records:
+				self._append(record)
+			return len(records)
+
+	def close(self):
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+	##~~ internals
+
+	def _append(self, record):
+		# must be called with the lock held
+		self._records[self._next] = record
+		self._next = (self._next + 1) % self._capacity
+		self._count = min(self._count + 1, self._capacity)
+
+	def _ordered(self):
+		# must be called with the lock held, oldest first
+		return [self._records[(self._next - self._count + index) % self._capacity] for index in range(self._count)]
+
+	def _write(self, record):
+		# must be called with the lock held
+		try:
+			if self._file is None:
+				self._file = io.open(self._path, "ab")
+			elif self._file.tell() >= self._max_file_size:
+				self._rotate()
+
+			self._file.write((json.dumps(record.as_dict()) + "\n").encode("utf-8"))
+			self._file.flush()
+		except (IOError, OSError):
+			self._logger.exception("Could not write to the delivery history at {}".format(self._path))
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+	def _rotate(self):
+		self._file.close()
+		self._file = None
+
+		rotated = self._path + ".1"
+		if os.path.exists(rotated):
+			os.remove(rotated)
+		os.rename(self._path, rotated)
+
+		self._file = io.open(self._path, "ab")
@@ -0,0 +1,239 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import json
+import logging
+import os
+import threading
+import time
+
+from octoprint.util import atomic_write
+
+from .outbox import backoff_delay
+
+
+DEFAULT_STREAM_URL = "wss://stream.pushbullet.com/websocket/"
+
+
+def parse_command(push, device_iden, allowed):
+	"""
+	Returns the command and its arguments if ``push`` is a note sent to the device ``device_iden``
+	whose first word is one of the ``allowed`` commands, ``None`` otherwise.
+
+	Tests:
+
+		>>> parse_command(dict(type="note", target_device_iden="octoprint", body=" Pause  now"), "octoprint", ["pause"])
+		('pause', ['now'])
+		>>> parse_command(dict(type="note", target_device_iden="octoprint", title="status"), "octoprint", ["status"])
+		('status', [])
+		>>> parse_command(dict(type="note", target_device_iden="phone", body="pause"), "octoprint", ["pause"]) is None
+		True
+		>>> parse_command(dict(type="note", target_device_iden="octoprint", body="cancel"), "octoprint", ["pause"]) is None
+		True
+		>>> parse_command(dict(type="note", target_device_iden="octoprint", body="pause", dismissed=True), "octoprint", ["pause"]) is None
+		True
+	"""
+
+	if push.get("type") != "note" or push.get("dismissed") or not push.get("active", True):
+		return None
+	if not device_iden or push.get("target_device_iden") != device_iden:
+		# our own notifications go to all devices, only what was explicitly sent to us is a command
+		return None
+
+	words = (push.get("body") or push.get("title") or "").split()
+	if not words or words[0].lower() not in allowed:
+		return None
+	return words[0].lower(), words[1:]
+
+
+class StreamListener(object):
+	"""
+	Listens to Pushbullet's realtime event stream over a single persistent websocket and hands new pushes to ``on_push``.
+
+	The stream only carries ``nop`` keep-alives (every 30 seconds) and ``tickle`` messages saying that
+	something changed. On a push tickle, and after every (re)connect in case one was missed, only the
+	pushes modified since the newest one seen so far are fetched with ``fetch(modified_after)``. That
+	cursor is persisted to ``cursor_path``, so pushes sent while OctoPrint was down are picked up after
+	a restart, but nothing from before the first start.
+
+	If nothing arrives for ``timeout`` seconds the connection is considered dead and reopened, failed
+	connection attempts are retried with jittered exponential backoff.
+	"""
+
+	def __init__(self, url, fetch, on_push, cursor_path, timeout=90.0, retry_delay=1.0, max_retry_delay=300.0,
+	             logger=None):
+		self._url = url
+		self._fetch = fetch
+		self._on_push = on_push
+		self._cursor_path = cursor_path
+		self._timeout = timeout
+		self._retry_delay = retry_delay
+		self._max_retry_delay = max_retry_delay
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._condition = threading.Condition()
+		self._thread = None
+		self._running = False
+		self._socket = None
+		self._cursor = None
+
+		self.connected = False
+		self.connects = 0
+		self.fetches = 0
+
+	@property
+	def cursor(self):
+		return self._cursor
+
+	def start(self):
+		with self._condition:
+			if self._thread is not None:
+				return
+			self._running = True
+			self._thread = threading.Thread(target=self._work, name="OctobulletStream")
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self, timeout=None):
+		with self._condition:
+			self._running = False
+			self._condition.notify_all()
+			thread = self._thread
+			self._thread = None
+			socket = self._socket
+
+		if socket is not None:
+			# unblocks a pending receive
+			try:
+				socket.close()
+			except Exception:
+				pass
+
+		if thread is not None and thread is not threading.current_thread():
+			thread.join(timeout)
+
+	##~~ internals
+
+	def _work(self):
+		self._load_cursor()
+
+		attempt = 0
+		while True:
+			with self._condition:
+				if not self._running:
+					return
+
+			try:
+				socket = self._connect()
+			except Exception as e:
+				self._logger.warn("Could not connect to the Pushbullet stream: {}".format(e))
+			else:
+				attempt = 0
+				try:
+					self._listen(socket)
+				except Exception as e:
+					with self._condition:
+						if self._running:
+							self._logger.warn("Lost the connection to the Pushbullet stream: {}".format(e))
+				finally:
+					self._disconnect(socket)
+
+			with self._condition:
+				if not self._running:
+					return
+				delay = backoff_delay(attempt, self._retry_delay, self._max_retry_delay)
+				attempt += 1
+				self._logger.info("Reconnecting to the Pushbullet stream in {:.0f}s".format(delay))
+				self._condition.wait(delay)
+
+	def _connect(self):
+		# websocket-client comes with the pushbullet library but is only needed here
+		import websocket
+
+		socket = websocket.create_connection(self._url, timeout=self._timeout)
+		with self._condition:
+			if not self._running:
+				socket.close()
+				raise IOError("Listener was stopped")
+			self._socket = socket
+			self.connected = True
+			self.connects += 1
+		self._logger.info("Connected to the Pushbullet stream")
+		return socket
+
+	def _disconnect(self, socket):
+		with self._condition:
+			self._socket = None
+			self.connected = False
+		try:
+			socket.close()
+		except Exception:
+			pass
+
+	def _listen(self, socket):
+		# tickles might have been missed while we weren't connected
+		self._catch_up()
+
+		while True:
+			# raises on a close or if not even a nop arrived within the timeout
+			message = socket.recv()
+			if not message:
+				raise IOError("Stream was closed")
+
+			try:
+				data = json.loads(message)
+			except ValueError:
+				self._logger.debug("Ignoring malformed stream message {!r}".format(message))
+				continue
+
+			if data.get("type") == "tickle" and data.get("subtype") == "push":
+				self._catch_up()
+
+	def _catch_up(self):
+		if self._cursor is None:
+			# first start, only pushes from now on are of interest
+			self._cursor = time.time()
+			self._save_cursor()
+
+		try:
+			pushes = self._fetch(self._cursor)
+		except Exception as e:
+			self._logger.warn("Could not fetch new pushes: {}".format(e))
+			return
+		self.fetches += 1
+
+		cursor = self._cursor
+		for push in sorted(pushes, key=lambda push: push.get("modified", 0)):
+			modified = push.get("modified", 0)
+			if modified <= self._cursor:
+				continue
+			cursor = max(cursor, modified)
+
+			try:
+				self._on_push(push)
+			except Exception:
+				self._logger.exception("Error while handling push {}".format(push.get("iden")))
+
+		if cursor != self._cursor:
+			self._cursor = cursor
+			self._save_cursor()
+
+	def _load_cursor(self):
+		if self._cursor is not None or not os.path.exists(self._cursor_path):
+			return
+		try:
+			with open(self._cursor_path, "rb") as f:
+				self._cursor = float(json.loads(f.read().decode("utf-8"))["modified_after"])
+		except Exception:
+			self._logger.exception("Could not read the stream cursor from {}, starting over".format(self._cursor_path))
+
+	def _save_cursor(self):
+		try:
+			with atomic_write(self._cursor_path, mode="wb") as f:
+				f.write(json.dumps(dict(modified_after=self._cursor)).encode("utf-8"))
+		except Exception:
+			self._logger.exception("Could not write the stream cursor to {}".format(self._cursor_path))
@@ -0,0 +1,113 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import string
+
+
+_formatter = string.Formatter()
+
+
+class TemplateError(Exception):
+	pass
+
+
+class MessageTemplate(object):
+	"""
+	A message template in ``str.format`` syntax, parsed once and rendered many times.
+
+	Rendering only evaluates the placeholders the template actually references, values may be
+	callables which are then only called if needed. If ``placeholders`` is given, referencing any
+	other placeholder raises a :class:`TemplateError` right away instead of failing on every render.
+
+	Tests:
+
+		>>> template = MessageTemplate("{file} done after {elapsed_time}", placeholders=("file", "elapsed_time", "eta"))
+		>>> sorted(template.fields)
+		['elapsed_time', 'file']
+		>>> template.render(dict(file="test.gcode", elapsed_time=lambda: "1h 2min", eta=lambda: 1 // 0))
+		'test.gcode done after 1h 2min'
+		>>> MessageTemplate("{progress:>3}% {file!r}").render(dict(progress=5, file="a.gcode"))
+		"  5% 'a.gcode'"
+		>>> MessageTemplate("{{literal}} braces").render(dict())
+		'{literal} braces'
+		>>> for broken in ("{flie}", "{file"):
+		...     try:
+		...         MessageTemplate(broken, placeholders=("file",))
+		...     except TemplateError as e:
+		...         print(e)
+		Unknown placeholder {flie}, available are {file}
+		Invalid template '{file': expected '}' before end of string
+	"""
+
+	def __init__(self, template, placeholders=None):
+		self.template = template
+		self.fields = frozenset()
+
+		try:
+			parsed = list(_formatter.parse(template))
+		except ValueError as e:
+			raise TemplateError("Invalid template {!r}: {}".format(template, e))
+
+		# a list of literal strings and (name, conversion, format spec) tuples
+		self._parts = []
+		fields = set()
+		simple = True
+
+		for literal, field, spec, conversion in parsed:
+			if literal:
+				self._parts.append(literal)
+			if field is None:
+				continue
+
+			name = field
+			for separator in (".", "["):
+				name = name.split(separator, 1)[0]
+			if not name or name.isdigit():
+				raise TemplateError("Positional placeholders are not supported: {!r}".format(template))
+			if name != field or (spec and "{" in spec) or conversion not in (None, "r", "s"):
+				# attribute or item access, nested placeholders or rare conversions, leave those to str.format
+				simple = False
+
+			fields.add(name)
+			self._parts.append((name, conversion, spec))
+
+		if placeholders is not None:
+			unknown = fields - set(placeholders)
+			if unknown:
+				raise TemplateError("Unknown placeholder {}, available are {}".format(
+					", ".join("{" + name + "}" for name in sorted(unknown)),
+					", ".join("{" + name + "}" for name in placeholders)))
+
+		self.fields = frozenset(fields)
+		if not simple:
+			self._parts = None
+
+	def render(self, values):
+		resolved = dict()
+		for name in self.fields:
+			try:
+				value = values[name]
+			except KeyError:
+				raise TemplateError("No value for placeholder {{{}}}".format(name))
+			resolved[name] = value() if callable(value) else value
+
+		if self._parts is None:
+			return self.template.format(**resolved)
+
+		output = []
+		for part in self._parts:
+			if isinstance(part, tuple):
+				name, conversion, spec = part
+				value = resolved[name]
+				if conversion == "r":
+					value = repr(value)
+				elif conversion == "s":
+					value = str(value)
+				output.append(format(value, spec))
+			else:
+				output.append(part)
+		return "".join(output)
@@ -0,0 +1,183 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import bisect
+import threading
+import time
+
+
+STAGE_QUEUE = "queue"
+STAGE_FETCH = "fetch"
+STAGE_TRANSFORM = "transform"
+STAGE_UPLOAD = "upload"
+STAGE_PUSH = "push"
+
+STAGES = (STAGE_QUEUE, STAGE_FETCH, STAGE_TRANSFORM, STAGE_UPLOAD, STAGE_PUSH)
+
+COUNTER_DELIVERED = "delivered"
+COUNTER_FAILED = "failed"
+COUNTER_NOTE_FALLBACK = "note_fallback"
+COUNTER_RATELIMIT_DEGRADED = "ratelimit_degraded"
+COUNTER_RATELIMIT_SKIPPED = "ratelimit_skipped"
+COUNTER_CAMERA_DROPPED = "camera_dropped"
+
+COUNTERS = (COUNTER_DELIVERED, COUNTER_FAILED, COUNTER_NOTE_FALLBACK, COUNTER_RATELIMIT_DEGRADED,
+            COUNTER_RATELIMIT_SKIPPED, COUNTER_CAMERA_DROPPED)
+
+# upper bounds in seconds, anything slower ends up in the implicit +Inf bucket
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+	"""
+	Fixed bucket latency histogram, takes the same amount of memory no matter how many values it has seen.
+
+	Tests:
+
+		>>> histogram = Histogram(buckets=(0.1, 1.0))
+		>>> for value in (0.05, 0.5, 0.7, 3.0):
+		...     histogram.observe(value)
+		>>> histogram.count, round(histogram.sum, 2)
+		(4, 4.25)
+		>>> histogram.cumulative()
+		[(0.1, 1), (1.0, 3), (inf, 4)]
+	"""
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = tuple(sorted(buckets))
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def cumulative(self):
+		result = []
+		total = 0
+		for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+			total += count
+			result.append((bound, total))
+		return result
+
+	def as_dict(self):
+		return dict(count=self.count,
+		            sum=self.sum,
+		            buckets=[dict(le=bound, count=count) for bound, count in self.cumulative()])
+
+
+class Metrics(object):
+	"""
+	Per stage latency histograms and outcome counters of the notification pipeline.
+
+	Recording a value only takes a lock and a bisect over a dozen bucket bounds, so it is fine to
+	do on every notification.
+	"""
+
+	def __init__(self, buckets=DEFAULT_BUCKETS, clock=time.time):
+		self._clock = clock
+		self._histograms = dict((stage, Histogram(buckets)) for stage in STAGES)
+		self._counters = dict((counter, 0) for counter in COUNTERS)
+		self._lock = threading.Lock()
+
+	def observe(self, stage, seconds):
+		with self._lock:
+			self._histograms[stage].observe(seconds)
+
+	def increment(self, counter, amount=1):
+		with self._lock:
+			self._counters[counter] = self._counters.get(counter, 0) + amount
+
+	def timed(self, stage):
+		"""
+		Context manager recording the time spent in its body for ``stage``, whether it raises or not.
+		"""
+		return _Timer(self, stage)
+
+	def as_dict(self):
+		with self._lock:
+			return dict(stages=dict((stage, histogram.as_dict()) for stage, histogram in self._histograms.items()),
+			            counters=dict(self._counters))
+
+	def prometheus(self, prefix="octobullet", gauges=None, counters=None):
+		"""
+		Renders all metrics, plus the given ``gauges`` and ``counters`` (name to value, counters get a
+		``_total`` suffix), in the Prometheus text exposition format.
+
+		Tests:
+
+			>>> metrics = Metrics(buckets=(1.0,))
+			>>> metrics.observe(STAGE_PUSH, 0.5)
+			>>> metrics.increment(COUNTER_DELIVERED)
+			>>> text = metrics.prometheus(gauges=dict(queue_pending=2), counters=dict(queue_dropped=3))
+			>>> print("\\n".join(line for line in text.splitlines() if "push" in line or "delivered" in line or "queue_" in line))
+			octobullet_stage_seconds_bucket{stage="push",le="1"} 1
+			octobullet_stage_seconds_bucket{stage="push",le="+Inf"} 1
+			octobullet_stage_seconds_sum{stage="push"} 0.5
+			octobullet_stage_seconds_count{stage="push"} 1
+			octobullet_notifications_total{outcome="delivered"} 1
+			# TYPE octobullet_queue_pending gauge
+			octobullet_queue_pending 2
+			# TYPE octobullet_queue_dropped_total counter
+			octobullet_queue_dropped_total 3
+		"""
+
+		data = self.as_dict()
+		lines = ["# HELP {}_stage_seconds Time spent per notification pipeline stage".format(prefix),
+		         "# TYPE {}_stage_seconds histogram".format(prefix)]
+		for stage in STAGES:
+			histogram = data["stages"][stage]
+			for bucket in histogram["buckets"]:
+				lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, stage,
+				                                                                     _format_bound(bucket["le"]),
+				                                                                     bucket["count"]))
+			lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(prefix, stage, _format_number(histogram["sum"])))
+			lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, stage, histogram["count"]))
+
+		lines += ["# HELP {}_notifications_total Notification outcomes".format(prefix),
+		          "# TYPE {}_notifications_total counter".format(prefix)]
+		for counter in sorted(data["counters"]):
+			lines.append('{}_notifications_total{{outcome="{}"}} {}'.format(prefix, counter, data["counters"][counter]))
+
+		for name, value in sorted((gauges or dict()).items()):
+			lines.append("# TYPE {}_{} gauge".format(prefix, name))
+			lines.append("{}_{} {}".format(prefix, name, _format_number(value)))
+
+		for name, value in sorted((counters or dict()).items()):
+			lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+			lines.append("{}_{}_total {}".format(prefix, name, _format_number(value)))
+
+		return "\n".join(lines) + "\n"
+
+
+class _Timer(object):
+	def __init__(self, metrics, stage):
+		self._metrics = metrics
+		self._stage = stage
+		self._start = None
+
+	def __enter__(self):
+		self._start = self._metrics._clock()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._metrics.observe(self._stage, self._metrics._clock() - self._start)
+		return False
+
+
+def _format_bound(value):
+	if value == float("inf"):
+		return "+Inf"
+	return _format_number(value)
+
+
+def _format_number(value):
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value)
@@ -0,0 +1,273 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+from octoprint.util import atomic_write
+
+
+def backoff_delay(attempt, base, maximum, jitter=random.random):
+	"""
+	Exponential backoff with jitter: half of the delay is fixed, the other half random.
+
+	Tests:
+
+		>>> backoff_delay(0, 10, 600, jitter=lambda: 0.0)
+		5.0
+		>>> backoff_delay(3, 10, 600, jitter=lambda: 1.0)
+		80.0
+		>>> backoff_delay(20, 10, 600, jitter=lambda: 1.0)
+		600.0
+	"""
+
+	delay = min(float(maximum), float(base) * 2 ** min(attempt, 32))
+	return delay / 2.0 + delay / 2.0 * jitter()
+
+
+class Outbox(object):
+	"""
+	Persistent queue of notifications that could not be delivered, retried with jittered exponential backoff.
+
+	Pending notifications are recorded in an append-only journal (one JSON record per line) so they
+	survive a restart, the journal is compacted once it contains enough obsolete records. Retries are
+	sent one at a time in order, with a shared backoff across all entries since a failure is almost
+	always caused by the network or the API rather than the notification itself. ``not_before`` may
+	return a timestamp before which no retry is attempted, e.g. the reset time of a rate limit.
+
+	At most ``max_entries`` notifications are kept, older ones are dropped first. Entries older than
+	``max_age`` seconds are discarded instead of being retried.
+
+	Tests:
+
+		>>> import shutil, tempfile
+		>>> folder = tempfile.mkdtemp()
+		>>> path = os.path.join(folder, "outbox.jsonl")
+		>>> def records():
+		...     with open(path, "rb") as f:
+		...         return len(f.readlines())
+		>>> outbox = Outbox(path, None, max_entries=3)
+		>>> for title in ("cube", "benchy", "vase", "calibration"):
+		...     outbox.add(dict(title=title))
+		>>> len(outbox), records()
+		(3, 5)
+
+		After a restart, the oldest entry stays dropped and the journal is compacted:
+
+		>>> delivered = []
+		>>> restarted = Outbox(path, lambda data: delivered.append(data["title"]) or True, max_entries=3,
+		...                    max_age=3600, retry_delay=0)
+		>>> restarted.load(), records()
+		(3, 3)
+		>>> restarted.add(dict(title="stale", created=time.time() - 7200))
+		>>> restarted.start()
+		>>> deadline = time.time() + 5
+		>>> while len(restarted) and time.time() < deadline:
+		...     time.sleep(0.01)
+		>>> restarted.stop()
+		>>> delivered, os.path.exists(path)
+		(['vase', 'calibration'], False)
+		>>> shutil.rmtree(folder)
+	"""
+
+	def __init__(self, path, deliver, max_entries=50, max_age=86400, retry_delay=10, max_retry_delay=900,
+	             not_before=None, logger=None):
+		self._path = path
+		self._deliver = deliver
+		self._max_entries = max(1, max_entries)
+		self._max_age = max_age
+		self._retry_delay = retry_delay
+		self._max_retry_delay = max_retry_delay
+		self._not_before = not_before
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._entries = collections.OrderedDict()
+		self._journal_records = 0
+		self._attempt = 0
+		self._next_attempt = 0
+
+		self._condition = threading.Condition()
+		self._thread = None
+		self._running = False
+
+	def __len__(self):
+		with self._condition:
+			return len(self._entries)
+
+	def load(self):
+		"""
+		Replays the journal, returns the number of pending notifications found.
+		"""
+
+		entries = collections.OrderedDict()
+		records = 0
+
+		if os.path.exists(self._path):
+			with open(self._path, "rb") as f:
+				for line in f:
+					try:
+						record = json.loads(line.decode("utf-8"))
+					except ValueError:
+						# most likely a torn last line from a crash, ignore it
+						continue
+
+					records += 1
+					if record.get("op") == "add":
+						entries[record["id"]] = record["data"]
+					elif record.get("op") == "remove":
+						entries.pop(record["id"], None)
+
+		with self._condition:
+			self._entries = entries
+			self._journal_records = records
+			self._compact()
+
+		if entries:
+			self._logger.info("Found {} undelivered notification(s) in the outbox".format(len(entries)))
+		return len(entries)
+
+	def add(self, data):
+		with self._condition:
+			while len(self._entries) >= self._max_entries:
+				dropped, _ = self._entries.popitem(last=False)
+				self._append({"op": "remove", "id": dropped})
+				self._logger.warn("Outbox is full, dropped oldest undelivered notification")
+
+			if "created" not in data:
+				data = dict(data, created=time.time())
+
+			identifier = uuid.uuid4().hex
+			self._entries[identifier] = data
+			self._append({"op": "add", "id": identifier, "data": data})
+
+			if len(self._entries) == 1:
+				# first entry after a quiet period, start over with the backoff
+				self._attempt = 0
+				self._next_attempt = time.time() + backoff_delay(0, self._retry_delay, self._max_retry_delay)
+
+			self._condition.notify()
+
+	def start(self):
+		with self._condition:
+			if self._thread is not None:
+				return
+			self._running = True
+			self._thread = threading.Thread(target=self._work, name="OctobulletOutbox")
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self, timeout=None):
+		with self._condition:
+			self._running = False
+			self._condition.notify_all()
+			thread = self._thread
+			self._thread = None
+
+		if thread is not None:
+			thread.join(timeout)
+
+	##~~ internals
+
+	def _work(self):
+		while True:
+			with self._condition:
+				identifier, data = self._next_due()
+				if not self._running:
+					return
+				if identifier is None:
+					continue
+
+			try:
+				delivered = self._deliver(data)
+			except Exception:
+				self._logger.exception("Error while retrying notification from the outbox")
+				delivered = False
+
+			with self._condition:
+				if delivered:
+					self._logger.info("Delivered notification {!r} from the outbox".format(data.get("title")))
+					self._remove(identifier)
+					self._attempt = 0
+					self._next_attempt = 0
+				else:
+					self._attempt += 1
+					delay = backoff_delay(self._attempt, self._retry_delay, self._max_retry_delay)
+					self._next_attempt = time.time() + delay
+					self._logger.info("Retrying undelivered notification(s) in {:.0f}s".format(delay))
+
+	def _next_due(self):
+		# must be called with the condition held, waits until an entry is due or we are stopped
+		while self._running:
+			self._expire()
+			if not self._entries:
+				self._condition.wait()
+				continue
+
+			due = self._next_attempt
+			if self._not_before is not None:
+				due = max(due, self._not_before() or 0)
+
+			now = time.time()
+			if due > now:
+				self._condition.wait(due - now)
+				continue
+
+			return next(iter(self._entries.items()))
+		return None, None
+
+	def _expire(self):
+		if not self._max_age:
+			return
+
+		cutoff = time.time() - self._max_age
+		for identifier, data in list(self._entries.items()):
+			if data.get("created", 0) < cutoff:
+				self._logger.warn("Discarding undelivered notification {!r}, it is too old".format(data.get("title")))
+				self._remove(identifier)
+
+	def _remove(self, identifier):
+		if self._entries.pop(identifier, None) is not None:
+			self._append({"op": "remove", "id": identifier})
+		if not self._entries or self._journal_records > 2 * self._max_entries:
+			self._compact()
+
+	def _append(self, record):
+		try:
+			with open(self._path, "ab") as f:
+				f.write((json.dumps(record) + "\n").encode("utf-8"))
+				f.flush()
+				os.fsync(f.fileno())
+			self._journal_records += 1
+		except Exception:
+			self._logger.exception("Could not write to the outbox journal at {}".format(self._path))
+
+	def _compact(self):
+		if not self._entries:
+			if os.path.exists(self._path):
+				try:
+					os.remove(self._path)
+				except Exception:
+					self._logger.exception("Could not remove the outbox journal at {}".format(self._path))
+			self._journal_records = 0
+			return
+
+		if self._journal_records == len(self._entries):
+			return
+
+		try:
+			with atomic_write(self._path, mode="wb") as f:
+				for identifier, data in self._entries.items():
+					f.write((json.dumps({"op": "add", "id": identifier, "data": data}) + "\n").encode("utf-8"))
+			self._journal_records = len(self._entries)
+		except Exception:
+			self._logger.exception("Could not compact the outbox journal at {}".format(self._path))
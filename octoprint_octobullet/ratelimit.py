@@ -0,0 +1,199 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import threading
+import time
+
+
+class TokenBucket(object):
+	"""
+	Classic token bucket: holds up to ``capacity`` tokens and refills at ``rate`` tokens per second.
+
+	Tests:
+
+		>>> now = [0.0]
+		>>> bucket = TokenBucket(rate=1.0, capacity=2, clock=lambda: now[0])
+		>>> bucket.consume(), bucket.consume(), bucket.consume()
+		(True, True, False)
+		>>> now[0] = 1.5
+		>>> bucket.consume()
+		True
+		>>> round(bucket.delay(), 1)
+		0.5
+	"""
+
+	def __init__(self, rate, capacity, clock=time.time):
+		self._rate = float(rate)
+		self._capacity = float(capacity)
+		self._clock = clock
+
+		self._tokens = float(capacity)
+		self._updated = clock()
+		self._lock = threading.Lock()
+
+	@property
+	def tokens(self):
+		with self._lock:
+			self._refill()
+			return self._tokens
+
+	def consume(self, amount=1):
+		with self._lock:
+			self._refill()
+			if self._tokens < amount:
+				return False
+			self._tokens -= amount
+			return True
+
+	def delay(self, amount=1):
+		"""
+		Seconds until ``amount`` tokens will be available.
+		"""
+
+		with self._lock:
+			self._refill()
+			missing = amount - self._tokens
+			if missing <= 0:
+				return 0.0
+			return missing / self._rate if self._rate > 0 else float("inf")
+
+	def wait(self, amount=1, cancelled=None):
+		"""
+		Blocks until ``amount`` tokens could be consumed, returns ``False`` if ``cancelled`` was set in the meantime.
+		"""
+
+		while True:
+			if self.consume(amount):
+				return True
+
+			delay = self.delay(amount)
+			if cancelled is None:
+				time.sleep(delay)
+			elif cancelled.wait(delay):
+				return False
+
+	def reset(self, tokens, capacity=None, rate=None):
+		"""
+		Overrides the bucket's state, e.g. with authoritative numbers from the server.
+		"""
+
+		with self._lock:
+			if capacity is not None:
+				self._capacity = float(capacity)
+			if rate is not None:
+				self._rate = float(rate)
+			self._tokens = min(self._capacity, float(tokens))
+			self._updated = self._clock()
+
+	@property
+	def capacity(self):
+		return self._capacity
+
+	def _refill(self):
+		# must be called with the lock held
+		now = self._clock()
+		self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+		self._updated = now
+
+
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+# as used in the settings
+PRIORITY_NAMES = dict(low=PRIORITY_LOW, normal=PRIORITY_NORMAL, high=PRIORITY_HIGH)
+
+ADMIT_FULL = "full"
+ADMIT_NOTE = "note"
+ADMIT_SKIP = "skip"
+
+
+class RateBudget(object):
+	"""
+	Client side view of the account's Pushbullet rate limit, used to decide how a push of a given priority is sent.
+
+	The budget is a :class:`TokenBucket` that is reset from the ``X-Ratelimit-Limit``,
+	``X-Ratelimit-Remaining`` and ``X-Ratelimit-Reset`` headers of every API response and in
+	between refills linearly so that it is full again at the reset time. Until the first response
+	with these headers arrives the budget is considered full.
+
+	High priority pushes (print done and errors) are always sent in full. Normal priority pushes
+	(test messages) are sent as a note without an image once less than ``reserve`` of the budget is
+	left. Low priority pushes (progress updates) are sent as a note without an image below
+	``degrade_below`` and skipped altogether below ``skip_below``, so they can never use up what is
+	left for the completion message.
+
+	Tests:
+
+		>>> now = [1000.0]
+		>>> budget = RateBudget(degrade_below=0.5, skip_below=0.2, reserve=0.05, clock=lambda: now[0])
+		>>> budget.admit(PRIORITY_LOW)
+		'full'
+		>>> budget.update({"X-Ratelimit-Limit": "100", "X-Ratelimit-Remaining": "30", "X-Ratelimit-Reset": "1100"})
+		>>> budget.admit(PRIORITY_LOW), budget.admit(PRIORITY_NORMAL), budget.admit(PRIORITY_HIGH)
+		('note', 'full', 'full')
+		>>> budget.update({"X-Ratelimit-Limit": "100", "X-Ratelimit-Remaining": "3", "X-Ratelimit-Reset": "1100"})
+		>>> budget.admit(PRIORITY_LOW), budget.admit(PRIORITY_NORMAL), budget.admit(PRIORITY_HIGH)
+		('skip', 'note', 'full')
+		>>> now[0] = 1100.0
+		>>> budget.admit(PRIORITY_LOW), round(budget.fraction, 2)
+		('full', 1.0)
+	"""
+
+	def __init__(self, degrade_below=0.5, skip_below=0.2, reserve=0.05, clock=time.time):
+		self._clock = clock
+		self._bucket = None
+		self._lock = threading.Lock()
+		self.configure(degrade_below=degrade_below, skip_below=skip_below, reserve=reserve)
+
+	def configure(self, degrade_below=None, skip_below=None, reserve=None):
+		if degrade_below is not None:
+			self._degrade_below = degrade_below
+		if skip_below is not None:
+			self._skip_below = skip_below
+		if reserve is not None:
+			self._reserve = reserve
+
+	@property
+	def fraction(self):
+		bucket = self._bucket
+		if bucket is None or not bucket.capacity:
+			return 1.0
+		return bucket.tokens / bucket.capacity
+
+	def update(self, headers):
+		try:
+			limit = float(headers["X-Ratelimit-Limit"])
+			remaining = float(headers["X-Ratelimit-Remaining"])
+			reset = float(headers["X-Ratelimit-Reset"])
+		except (KeyError, TypeError, ValueError):
+			return
+
+		if limit <= 0:
+			return
+
+		# refill whatever has been used up by the reset time
+		rate = (limit - remaining) / max(1.0, reset - self._clock())
+
+		with self._lock:
+			if self._bucket is None:
+				self._bucket = TokenBucket(rate, limit, clock=self._clock)
+			self._bucket.reset(remaining, capacity=limit, rate=rate)
+
+	def admit(self, priority):
+		if priority >= PRIORITY_HIGH:
+			return ADMIT_FULL
+
+		fraction = self.fraction
+		if priority >= PRIORITY_NORMAL:
+			return ADMIT_FULL if fraction >= self._reserve else ADMIT_NOTE
+
+		if fraction >= self._degrade_below:
+			return ADMIT_FULL
+		if fraction >= self._skip_below:
+			return ADMIT_NOTE
+		return ADMIT_SKIP
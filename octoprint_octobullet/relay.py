@@ -0,0 +1,371 @@
+# coding=utf-8
+from __future__ import absolute_import, print_function
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+# Relay mode: instead of talking to Pushbullet themselves, any number of OctoPrint instances send their
+# notifications to a single relay process, which batches them, applies one rate limit for the shared
+# account and keeps one pool of connections to the API.
+#
+# Start the relay with
+#
+#     python -m octoprint_octobullet.relay --token <access token> [--port 8765]
+#
+# and enable relay mode in the plugin settings of each instance.
+
+import base64
+import collections
+import io
+import json
+import logging
+import threading
+import time
+
+import requests
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+
+from .api import PooledPushBullet
+from .clients import ClientCache
+from .connections import ConnectionPool
+from .outbox import backoff_delay
+from .ratelimit import TokenBucket
+
+
+DEFAULT_PORT = 8765
+
+_SECRET_HEADER = "X-Relay-Secret"
+
+
+class RelayError(Exception):
+	pass
+
+
+class RelayClient(object):
+	"""
+	Sends notifications to a relay, used by the plugin when relay mode is enabled.
+	"""
+
+	def __init__(self, url, secret=None, session=None):
+		self._url = url.rstrip("/")
+		self._secret = secret
+		self._session = session if session is not None else requests.Session()
+
+	def send(self, title, body, filename=None, image=None, channel=None):
+		payload = dict(title=title,
+		               body=body,
+		               filename=filename,
+		               channel=channel,
+		               image=base64.b64encode(image).decode("ascii") if image else None)
+
+		headers = {"Content-Type": "application/json"}
+		if self._secret:
+			headers[_SECRET_HEADER] = self._secret
+
+		response = self._session.post(self._url + "/notify", data=json.dumps(payload), headers=headers)
+		if response.status_code != 202:
+			raise RelayError("Relay answered with {}: {}".format(response.status_code, response.text))
+
+
+class Relay(object):
+	"""
+	Delivers notifications received from any number of instances through one shared Pushbullet client.
+
+	Notifications are collected for ``batch_window`` seconds. Text-only notifications for the same
+	channel collected in the same window are merged into one note. All pushes share one token bucket
+	of ``rate`` pushes per second with a burst of ``burst``.
+
+	Instances only learn that a notification was queued, so the relay keeps failed pushes until
+	they go through, with the same jittered exponential backoff as the plugin's outbox and no
+	earlier than a rate limit reported by the API allows. Notifications older than ``max_age``
+	seconds are given up on.
+	"""
+
+	def __init__(self, token, channel=None, api_url=None, rate=1.0, burst=10, batch_window=1.0, max_queue=500,
+	             retry_delay=10.0, max_retry_delay=900.0, max_age=86400, pool_size=4, timeout=(5.0, 30.0),
+	             logger=None):
+		self._token = token
+		self._channel = channel
+		self._batch_window = batch_window
+		self._max_queue = max_queue
+		self._retry_delay = retry_delay
+		self._max_retry_delay = max_retry_delay
+		self._max_age = max_age
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._connections = ConnectionPool(pool_size=pool_size, api_timeout=timeout, logger=self._logger)
+		self._clients = ClientCache(lambda t: PooledPushBullet(t, pool=self._connections, api_url=api_url),
+		                            logger=self._logger)
+		self._bucket = TokenBucket(rate, burst)
+
+		self._queue = collections.deque()
+		self._condition = threading.Condition()
+		self._stopped = threading.Event()
+		self._thread = None
+
+		self.stats = dict(received=0, pushes=0, merged=0, failed=0, rejected=0)
+
+	def submit(self, notification):
+		with self._condition:
+			if len(self._queue) >= self._max_queue:
+				self.stats["rejected"] += 1
+				return False
+
+			notification.setdefault("attempts", 0)
+			notification.setdefault("received", time.time())
+			self._queue.append(notification)
+			self.stats["received"] += 1
+			self._condition.notify()
+			return True
+
+	def status(self):
+		with self._condition:
+			return dict(self.stats, queued=len(self._queue), tokens=self._bucket.tokens)
+
+	def start(self):
+		# fail early on an invalid token
+		self._clients.get(self._token)
+
+		self._thread = threading.Thread(target=self._work, name="OctobulletRelay")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self, timeout=None):
+		self._stopped.set()
+		with self._condition:
+			self._condition.notify_all()
+		if self._thread is not None:
+			self._thread.join(timeout)
+		self._connections.close()
+
+	##~~ internals
+
+	def _work(self):
+		while not self._stopped.is_set():
+			with self._condition:
+				delay = self._next_due()
+				while (delay is None or delay > 0) and not self._stopped.is_set():
+					self._condition.wait(delay)
+					delay = self._next_due()
+			if self._stopped.is_set():
+				return
+
+			# give other instances a moment to add to this batch
+			self._stopped.wait(self._batch_window)
+
+			with self._condition:
+				now = time.time()
+				batch = [notification for notification in self._queue if notification.get("not_before", 0) <= now]
+				waiting = [notification for notification in self._queue if notification.get("not_before", 0) > now]
+				self._queue.clear()
+				self._queue.extend(waiting)
+
+			for notifications in self._group(batch):
+				if not self._bucket.wait(cancelled=self._stopped):
+					return
+
+				ratelimited_until = self._connections.ratelimited_until
+				if ratelimited_until and ratelimited_until > time.time():
+					if self._stopped.wait(ratelimited_until - time.time()):
+						return
+
+				self._push(notifications)
+
+	def _group(self, batch):
+		# notifications with an image are pushed one by one, text-only ones are merged per channel
+		notes = collections.OrderedDict()
+		for notification in batch:
+			if notification.get("image"):
+				yield [notification]
+			else:
+				notes.setdefault(notification.get("channel") or self._channel, []).append(notification)
+
+		for notifications in notes.values():
+			yield notifications
+
+	def _push(self, notifications):
+		first = notifications[0]
+		channel = first.get("channel") or self._channel
+
+		if len(notifications) == 1:
+			title, body = first["title"], first["body"]
+		else:
+			title = "{} notifications".format(len(notifications))
+			body = "\n\n".join("{}\n{}".format(n["title"], n["body"]) for n in notifications)
+
+		try:
+			client, channels = self._clients.get(self._token)
+			sender = channels.get(channel, client) if channel else client
+
+			image = first.get("image")
+			if image:
+				try:
+					file_data = client.upload_file(io.BytesIO(base64.b64decode(image)),
+					                               first.get("filename") or "snapshot.jpg",
+					                               file_type="image/jpeg")
+					sender.push_file(file_data["file_name"], file_data["file_url"], file_data["file_type"],
+					                 body=title + " " + body)
+				except Exception:
+					self._logger.exception("Error while pushing a file, sending only a note")
+					sender.push_note(title, body)
+			else:
+				sender.push_note(title, body)
+		except Exception:
+			self._logger.exception("Error while pushing {} notification(s)".format(len(notifications)))
+			self._requeue(notifications)
+			return
+
+		self.stats["pushes"] += 1
+		self.stats["merged"] += len(notifications) - 1
+
+	def _next_due(self):
+		# must be called with the condition held, seconds until the first queued notification may be
+		# pushed, None if there is none
+		if not self._queue:
+			return None
+		return max(0.0, min(notification.get("not_before", 0) for notification in self._queue) - time.time())
+
+	def _requeue(self, notifications):
+		now = time.time()
+		ratelimited_until = self._connections.ratelimited_until or 0
+		with self._condition:
+			for notification in notifications:
+				if self._max_age and now - notification["received"] > self._max_age:
+					self.stats["failed"] += 1
+					self._logger.warn("Giving up on notification {!r} after {} attempts".format(notification["title"],
+					                                                                          notification["attempts"] + 1))
+					continue
+
+				delay = backoff_delay(notification["attempts"], self._retry_delay, self._max_retry_delay)
+				notification["attempts"] += 1
+				notification["not_before"] = max(now + delay, ratelimited_until)
+				self._queue.append(notification)
+			self._condition.notify()
+
+
+class RelayServer(ThreadingMixIn, HTTPServer):
+	"""
+	HTTP front end of a :class:`Relay`: ``POST /notify`` queues a notification, ``GET /status`` reports counters.
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, address, relay, secret=None):
+		HTTPServer.__init__(self, address, _RelayHandler)
+		self.relay = relay
+		self.secret = secret
+
+
+class _RelayHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		if not self._authorized():
+			return
+
+		if self.path == "/status":
+			self._json(200, self.server.relay.status())
+		else:
+			self._json(404, dict(error="not found"))
+
+	def do_POST(self):
+		length = int(self.headers.get("Content-Length", 0))
+		data = self.rfile.read(length) if length else b""
+
+		if not self._authorized():
+			return
+
+		if self.path != "/notify":
+			self._json(404, dict(error="not found"))
+			return
+
+		try:
+			notification = json.loads(data.decode("utf-8"))
+			if not isinstance(notification.get("title"), (type(u""), str)) or "body" not in notification:
+				raise ValueError("title and body are required")
+		except ValueError as e:
+			self._json(400, dict(error=str(e)))
+			return
+
+		if self.server.relay.submit(notification):
+			self._json(202, dict(queued=True))
+		else:
+			self._json(503, dict(error="queue full"))
+
+	def log_message(self, *args):
+		pass
+
+	def _authorized(self):
+		if self.server.secret and self.headers.get(_SECRET_HEADER) != self.server.secret:
+			self._json(403, dict(error="forbidden"))
+			return False
+		return True
+
+	def _json(self, status, data):
+		body = json.dumps(data).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+def main():
+	import argparse
+	import os
+
+	parser = argparse.ArgumentParser(description="Relays notifications of many OctoPrint instances to Pushbullet")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+	parser.add_argument("--token", default=os.environ.get("OCTOBULLET_RELAY_TOKEN"),
+	                    help="Pushbullet access token, defaults to $OCTOBULLET_RELAY_TOKEN")
+	parser.add_argument("--channel", help="channel tag to push to if an instance doesn't ask for one")
+	parser.add_argument("--secret", default=os.environ.get("OCTOBULLET_RELAY_SECRET"),
+	                    help="shared secret instances have to provide, defaults to $OCTOBULLET_RELAY_SECRET")
+	parser.add_argument("--api-url", help="Pushbullet API to talk to, e.g. a local stand-in for testing")
+	parser.add_argument("--rate", type=float, default=60.0, help="pushes per minute")
+	parser.add_argument("--burst", type=int, default=10, help="pushes that may be sent back to back")
+	parser.add_argument("--batch-window", type=float, default=1.0,
+	                    help="seconds to collect notifications before pushing them")
+	parser.add_argument("--max-queue", type=int, default=500)
+	parser.add_argument("--max-age", type=float, default=86400,
+	                    help="seconds after which a notification that could not be pushed is given up on")
+	parser.add_argument("--verbose", action="store_true")
+	args = parser.parse_args()
+
+	if not args.token:
+		parser.error("a Pushbullet access token is required")
+
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+	                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+	relay = Relay(args.token,
+	              channel=args.channel,
+	              api_url=args.api_url,
+	              rate=args.rate / 60.0,
+	              burst=args.burst,
+	              batch_window=args.batch_window,
+	              max_queue=args.max_queue,
+	              max_age=args.max_age)
+	relay.start()
+
+	server = RelayServer((args.host, args.port), relay, secret=args.secret)
+	logging.getLogger(__name__).info("Relay listening on {}:{}".format(args.host, args.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		relay.stop(timeout=5.0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,160 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import logging
+import threading
+import time
+
+
+def parse_milestones(value):
+	"""
+	Tests:
+
+		>>> parse_milestones("75, 25,50")
+		[25, 50, 75]
+		>>> parse_milestones([50, "25", 100, 0, 50])
+		[25, 50]
+		>>> parse_milestones(None)
+		[]
+		>>> parse_milestones("25, foo")
+		Traceback (most recent call last):
+		...
+		ValueError: invalid literal for int() with base 10: 'foo'
+	"""
+
+	if not value:
+		return []
+
+	if not isinstance(value, (list, tuple)):
+		value = [x.strip() for x in str(value).split(",") if x.strip()]
+
+	return sorted(set(m for m in (int(x) for x in value) if 0 < m < 100))
+
+
+class ProgressScheduler(object):
+	"""
+	Decides when periodic progress updates are due, on a single timer thread.
+
+	While a print is running, ``callback(progress, milestone)`` is called every ``interval`` seconds
+	with ``milestone`` set to ``False``, and once for each milestone percentage the print reaches
+	with ``milestone`` set to ``True``. Feeding progress through :meth:`progress` only compares a
+	couple of integers, so it is cheap enough to call from every progress event.
+	"""
+
+	def __init__(self, callback, logger=None):
+		self._callback = callback
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+		self._condition = threading.Condition()
+		self._thread = None
+		self._running = False
+
+		self._interval = 0
+		self._milestones = []
+		self._next_milestone = None
+		self._reached_milestone = None
+		self._due = None
+		self._progress = 0
+
+	@property
+	def active(self):
+		return self._due is not None or self._next_milestone is not None
+
+	def start(self):
+		with self._condition:
+			if self._thread is not None:
+				return
+			self._running = True
+			self._thread = threading.Thread(target=self._work, name="OctobulletScheduler")
+			self._thread.daemon = True
+			self._thread.start()
+
+	def shutdown(self):
+		with self._condition:
+			self._running = False
+			self._condition.notify_all()
+
+	def begin(self, interval, milestones=None):
+		"""
+		Starts scheduling updates for a new print job, the first interval update is due after ``interval`` seconds.
+		"""
+
+		with self._condition:
+			self._progress = 0
+			self._milestones = list(milestones or [])
+			self._reached_milestone = None
+			self._next_milestone = self._milestones[0] if self._milestones else None
+			self._configure_interval(interval)
+			self._condition.notify_all()
+
+	def reconfigure(self, interval, milestones=None):
+		"""
+		Applies changed settings to a running job, restarting the interval timer.
+		"""
+
+		with self._condition:
+			if not self.active:
+				return
+
+			self._milestones = list(milestones or [])
+			self._next_milestone = next((m for m in self._milestones if m > self._progress), None)
+			self._configure_interval(interval)
+			self._condition.notify_all()
+
+	def end(self):
+		with self._condition:
+			self._due = None
+			self._next_milestone = None
+			self._reached_milestone = None
+			self._condition.notify_all()
+
+	def progress(self, progress):
+		self._progress = progress
+
+		milestone = self._next_milestone
+		if milestone is None or progress < milestone:
+			return
+
+		with self._condition:
+			if self._next_milestone is None or progress < self._next_milestone:
+				return
+
+			# if we skipped over several milestones at once only report the most recent one
+			self._reached_milestone = max(m for m in self._milestones if m <= progress)
+			self._next_milestone = next((m for m in self._milestones if m > progress), None)
+			self._condition.notify_all()
+
+	##~~ internals
+
+	def _configure_interval(self, interval):
+		# must be called with the condition held
+		self._interval = interval
+		self._due = time.time() + interval if interval > 0 else None
+
+	def _work(self):
+		while True:
+			with self._condition:
+				while self._running:
+					if self._reached_milestone is not None:
+						progress, milestone = self._reached_milestone, True
+						self._reached_milestone = None
+						break
+
+					now = time.time()
+					if self._due is not None and self._due <= now:
+						progress, milestone = self._progress, False
+						self._due = now + self._interval
+						break
+
+					self._condition.wait(self._due - now if self._due is not None else None)
+				else:
+					return
+
+			try:
+				self._callback(progress, milestone)
+			except Exception:
+				self._logger.exception("Error while sending a progress update")
@@ -0,0 +1,432 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <gina@octoprint.org>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import collections
+import io
+import struct
+import threading
+import time
+
+import sarge
+
+
+TRANSFORM_AUTO = "auto"
+TRANSFORM_PILLOW = "pillow"
+TRANSFORM_FFMPEG = "ffmpeg"
+
+_JPEG_QUALITY = 85
+
+# start of frame markers carrying the image dimensions, i.e. everything from 0xC0 to 0xCF but DHT, JPG and DAC
+_JPEG_SOF_MARKERS = frozenset(m for m in range(0xc0, 0xd0) if m not in (0xc4, 0xc8, 0xcc))
+
+# stands in for "no limit" in size calculations
+_UNLIMITED = 100000
+
+# (hflip, vflip, rotate) => single Pillow transpose operation equivalent to ffmpeg's "transpose=2,hflip,vflip" chain
+_TRANSPOSE_OPERATIONS = {
+	(True, False, False): "FLIP_LEFT_RIGHT",
+	(False, True, False): "FLIP_TOP_BOTTOM",
+	(True, True, False): "ROTATE_180",
+	(False, False, True): "ROTATE_90",
+	(True, False, True): "TRANSVERSE",
+	(False, True, True): "TRANSPOSE",
+	(True, True, True): "ROTATE_270",
+}
+
+
+class SnapshotCache(object):
+	"""
+	Short lived cache for processed snapshots that coalesces concurrent requests for the same snapshot.
+
+	If several notifications ask for the same ``key`` (snapshot URL plus transform settings) while it
+	is being fetched, only the first one runs ``loader``, all others wait for and share its result.
+	Results are kept for ``ttl`` seconds, as long as the cache stays below ``max_bytes`` in total.
+
+	Tests:
+
+		>>> cache = SnapshotCache(ttl=60)
+		>>> release = threading.Event()
+		>>> loads = []
+		>>> def loader():
+		...     loads.append(threading.current_thread().name)
+		...     release.wait()
+		...     return b"snapshot"
+		>>> results = []
+		>>> threads = [threading.Thread(target=lambda: results.append(cache.get("webcam", loader))) for _ in range(5)]
+		>>> for thread in threads:
+		...     thread.start()
+		>>> deadline = time.time() + 5
+		>>> while cache.hits + cache.misses < 5 and time.time() < deadline:
+		...     time.sleep(0.01)
+		>>> release.set()
+		>>> for thread in threads:
+		...     thread.join()
+		>>> len(loads), results
+		(1, [b'snapshot', b'snapshot', b'snapshot', b'snapshot', b'snapshot'])
+		>>> cache.get("webcam", loader), len(loads)
+		(b'snapshot', 1)
+
+		A failed load is not cached, the next request tries again:
+
+		>>> def broken():
+		...     raise ValueError("webcam is offline")
+		>>> cache.get("nozzle", broken)
+		Traceback (most recent call last):
+		...
+		ValueError: webcam is offline
+		>>> cache.get("nozzle", lambda: b"nozzle")
+		b'nozzle'
+	"""
+
+	def __init__(self, ttl=2.0, max_bytes=4 * 1024 * 1024):
+		self._ttl = ttl
+		self._max_bytes = max_bytes
+
+		self._entries = collections.OrderedDict()
+		self._size = 0
+		self._inflight = dict()
+		self._lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+
+	def configure(self, ttl=None, max_bytes=None):
+		with self._lock:
+			if ttl is not None:
+				self._ttl = ttl
+			if max_bytes is not None:
+				self._max_bytes = max_bytes
+			self._evict()
+
+	def get(self, key, loader):
+		with self._lock:
+			self._evict()
+
+			entry = self._entries.get(key)
+			if entry is not None:
+				self.hits += 1
+				return entry[0]
+
+			flight = self._inflight.get(key)
+			leader = flight is None
+			if leader:
+				flight = self._inflight[key] = _Flight()
+				self.misses += 1
+			else:
+				self.hits += 1
+
+		if not leader:
+			return flight.wait()
+
+		try:
+			data = loader()
+		except Exception as e:
+			with self._lock:
+				del self._inflight[key]
+			flight.fail(e)
+			raise
+
+		with self._lock:
+			del self._inflight[key]
+			if self._ttl and len(data) <= self._max_bytes:
+				self._entries[key] = (data, time.time())
+				self._size += len(data)
+				self._evict()
+		flight.succeed(data)
+		return data
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._size = 0
+
+	def _evict(self):
+		# must be called with the lock held
+		cutoff = time.time() - (self._ttl or 0)
+		while self._entries:
+			key, (data, created) = next(iter(self._entries.items()))
+			if created >= cutoff and self._size <= self._max_bytes:
+				break
+			del self._entries[key]
+			self._size -= len(data)
+
+
+class _Flight(object):
+	def __init__(self):
+		self._event = threading.Event()
+		self._result = None
+		self._error = None
+
+	def succeed(self, result):
+		self._result = result
+		self._event.set()
+
+	def fail(self, error):
+		self._error = error
+		self._event.set()
+
+	def wait(self):
+		self._event.wait()
+		if self._error is not None:
+			raise self._error
+		return self._result
+
+
+class SnapshotTransformError(Exception):
+	def __init__(self, message, returncode=None, stderr=None):
+		Exception.__init__(self, message)
+		self.returncode = returncode
+		self.stderr = stderr
+
+
+class SnapshotTooLargeError(Exception):
+	pass
+
+
+def fetch_snapshot(url, session=None, max_bytes=None, timeout=None, chunk_size=64 * 1024):
+	"""
+	Fetches a snapshot from ``url`` and returns its raw bytes, without ever touching the disk.
+
+	If provided, the request is sent through ``session`` so its connection can be kept alive, and
+	with ``timeout`` instead of the session's default one. The response is read in chunks and given up on with a :class:`SnapshotTooLargeError` as soon as it
+	exceeds ``max_bytes``, so a misconfigured URL (e.g. pointing at the stream) can't exhaust memory.
+	"""
+
+	if session is None:
+		import requests
+		session = requests
+
+	response = session.get(url, verify=False, stream=True, timeout=timeout)
+	try:
+		response.raise_for_status()
+
+		chunks = []
+		size = 0
+		for chunk in response.iter_content(chunk_size):
+			size += len(chunk)
+			if max_bytes and size > max_bytes:
+				raise SnapshotTooLargeError("Snapshot from {} is larger than {} bytes".format(url, max_bytes))
+			chunks.append(chunk)
+		return b"".join(chunks)
+	finally:
+		response.close()
+
+
+def ffmpeg_filters(hflip=False, vflip=False, rotate=False, max_width=0, max_height=0, pixfmt="yuv420p"):
+	"""
+	Tests:
+
+		>>> ffmpeg_filters()
+		[]
+		>>> ffmpeg_filters(hflip=True, rotate=True)
+		['format=yuv420p', 'transpose=2', 'hflip']
+		>>> ffmpeg_filters(hflip=True, vflip=True, rotate=True)
+		['format=yuv420p', 'transpose=2', 'hflip', 'vflip']
+		>>> ffmpeg_filters(vflip=True, max_width=1280)
+		['format=yuv420p', 'vflip', "scale=w='min(iw,1280)':h='min(ih,100000)':force_original_aspect_ratio=decrease"]
+	"""
+
+	if not hflip and not vflip and not rotate and not max_width and not max_height:
+		return []
+
+	filters = ["format={}".format(pixfmt)] # workaround for foosel/OctoPrint#1317
+	if rotate:
+		filters.append("transpose=2") # 90 degrees counter clockwise
+	if hflip:
+		filters.append("hflip")       # horizontal flip
+	if vflip:
+		filters.append("vflip")       # vertical flip
+	if max_width or max_height:
+		# only ever scale down, never up
+		filters.append("scale=w='min(iw,{})':h='min(ih,{})':force_original_aspect_ratio=decrease".format(max_width or _UNLIMITED,
+		                                                                                                max_height or _UNLIMITED))
+	return filters
+
+
+def jpeg_dimensions(data):
+	"""
+	Returns ``(width, height)`` of the JPEG ``data`` by reading its frame header, without decoding anything.
+
+	Returns ``None`` if ``data`` doesn't look like a JPEG.
+
+	Tests:
+
+		>>> header = b"\\xff\\xd8" + b"\\xff\\xe0\\x00\\x04\\x00\\x00" + b"\\xff\\xc0\\x00\\x11\\x08\\x02\\xd0\\x05\\x00"
+		>>> jpeg_dimensions(header)
+		(1280, 720)
+		>>> jpeg_dimensions(b"GIF89a") is None
+		True
+	"""
+
+	if data[:2] != b"\xff\xd8":
+		return None
+
+	offset = 2
+	length = len(data)
+	while offset + 4 <= length:
+		if data[offset:offset + 1] != b"\xff":
+			return None
+		marker = struct.unpack(">B", data[offset + 1:offset + 2])[0]
+		if marker == 0xff:
+			# fill byte
+			offset += 1
+			continue
+
+		segment_length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+		if marker in _JPEG_SOF_MARKERS:
+			if offset + 9 > length:
+				return None
+			height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+			return width, height
+		offset += 2 + segment_length
+
+	return None
+
+
+_pillow = []
+
+
+def _pillow_image():
+	# Pillow takes a while to import, so only do that once a snapshot actually needs to be transformed
+	if not _pillow:
+		try:
+			from PIL import Image
+		except ImportError:
+			Image = None
+		_pillow.append(Image)
+	return _pillow[0]
+
+
+def pillow_available():
+	return _pillow_image() is not None
+
+
+def transform_with_pillow(data, hflip=False, vflip=False, rotate=False, max_width=0, max_height=0,
+                          quality=_JPEG_QUALITY):
+	"""
+	Applies the flip/rotate settings and size limits to the JPEG ``data`` in-process using Pillow.
+
+	Scaling happens first, while decoding (JPEG draft mode), and all flip/rotate combinations are
+	collapsed into a single transpose operation, so the image is decoded and encoded exactly once.
+	If nothing needs to be done, ``data`` is returned unchanged. Returns the resulting JPEG bytes.
+	"""
+
+	Image = _pillow_image()
+	if Image is None:
+		raise SnapshotTransformError("Pillow is not available")
+
+	operation = _TRANSPOSE_OPERATIONS.get((bool(hflip), bool(vflip), bool(rotate)))
+
+	try:
+		image = Image.open(io.BytesIO(data))
+
+		# limits apply to the final orientation, so swap them if we are going to rotate afterwards
+		bounds = (max_width or _UNLIMITED, max_height or _UNLIMITED)
+		if rotate:
+			bounds = (bounds[1], bounds[0])
+		resize = image.size[0] > bounds[0] or image.size[1] > bounds[1]
+
+		if operation is None and not resize:
+			return data
+
+		if resize:
+			image.thumbnail(bounds)
+
+		if operation is not None:
+			# Pillow >= 9.1 moved the constants into an enum
+			image = image.transpose(getattr(getattr(Image, "Transpose", Image), operation))
+
+		if image.mode not in ("RGB", "L"):
+			image = image.convert("RGB")
+
+		output = io.BytesIO()
+		image.save(output, format="JPEG", quality=quality)
+		return output.getvalue()
+	except Exception as e:
+		raise SnapshotTransformError("Pillow could not transform the snapshot: {}".format(e))
+
+
+def composite_with_pillow(images, max_width=0, max_height=0, quality=_JPEG_QUALITY):
+	"""
+	Puts the JPEG ``images`` side by side into a single JPEG, all scaled to the height of the smallest one
+	and the result limited to ``max_width`` x ``max_height``. Returns the resulting JPEG bytes.
+	"""
+
+	Image = _pillow_image()
+	if Image is None:
+		raise SnapshotTransformError("Pillow is not available")
+
+	try:
+		decoded = [Image.open(io.BytesIO(data)) for data in images]
+		height = min(image.size[1] for image in decoded)
+
+		scaled = []
+		for image in decoded:
+			if image.mode not in ("RGB", "L"):
+				image = image.convert("RGB")
+			if image.size[1] != height:
+				image = image.resize((max(1, image.size[0] * height // image.size[1]), height))
+			scaled.append(image)
+
+		composite = Image.new("RGB", (sum(image.size[0] for image in scaled), height))
+		offset = 0
+		for image in scaled:
+			composite.paste(image, (offset, 0))
+			offset += image.size[0]
+
+		bounds = (max_width or _UNLIMITED, max_height or _UNLIMITED)
+		if composite.size[0] > bounds[0] or composite.size[1] > bounds[1]:
+			composite.thumbnail(bounds)
+
+		output = io.BytesIO()
+		composite.save(output, format="JPEG", quality=quality)
+		return output.getvalue()
+	except Exception as e:
+		raise SnapshotTransformError("Pillow could not composite the snapshots: {}".format(e))
+
+
+def transform_with_ffmpeg(ffmpeg, data, filters, quality=None):
+	"""
+	Runs the JPEG ``data`` through ``ffmpeg`` applying ``filters``, piping it through stdin and stdout.
+
+	Returns the transformed JPEG bytes, raises :class:`SnapshotTransformError` if ffmpeg fails.
+	"""
+
+	# no shell involved, so the filter chain must not be quoted
+	command = [ffmpeg, "-f", "jpeg_pipe", "-i", "pipe:0", "-vf", ",".join(filters)]
+	if quality:
+		command += ["-q:v", str(_ffmpeg_qscale(quality))]
+	command += ["-f", "image2pipe", "-vcodec", "mjpeg", "pipe:1"]
+
+	p = sarge.run(command, input=data, stdout=sarge.Capture(), stderr=sarge.Capture())
+	if p.returncode != 0:
+		raise SnapshotTransformError("ffmpeg returned {}".format(p.returncode),
+		                             returncode=p.returncode,
+		                             stderr=p.stderr.text)
+
+	result = p.stdout.bytes
+	if not result:
+		raise SnapshotTransformError("ffmpeg produced no output", returncode=p.returncode, stderr=p.stderr.text)
+	return result
+
+
+def _ffmpeg_qscale(quality):
+	"""
+	Maps a JPEG quality of 1-100 onto ffmpeg's mjpeg qscale of 31-2 (lower is better).
+
+	Tests:
+
+		>>> _ffmpeg_qscale(100)
+		2
+		>>> _ffmpeg_qscale(85)
+		6
+		>>> _ffmpeg_qscale(1)
+		31
+	"""
+
+	quality = max(1, min(100, quality))
+	return int(round(2 + (100 - quality) * 29 / 99.0))
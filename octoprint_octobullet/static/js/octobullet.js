@@ -5,7 +5,60 @@ $(function() {
         self.settings = parameters[0];
 
         self.busy = ko.observable(false);
-        
+        self.connectionStatus = ko.observable(undefined);
+
+        self.connectionText = ko.pureComputed(function() {
+            switch (self.connectionStatus()) {
+                case "connected":
+                    return gettext("Connected to Pushbullet");
+                case "channel":
+                    return gettext("Connected to Pushbullet, but the channel is unknown, pushing to all devices instead");
+                case "apikey":
+                    return gettext("Could not connect to Pushbullet, the Access Token is invalid");
+                case "error":
+                    return gettext("Could not connect to Pushbullet, check the log");
+                default:
+                    return "";
+            }
+        });
+        self.connectionOk = ko.pureComputed(function() {
+            return self.connectionStatus() === "connected";
+        });
+
+        self.addCamera = function() {
+            self.settings.settings.plugins.octobullet.cameras.sources.push({
+                name: ko.observable(""),
+                snapshot: ko.observable(""),
+                flipH: ko.observable(false),
+                flipV: ko.observable(false),
+                rotate90: ko.observable(false)
+            });
+        };
+
+        self.removeCamera = function(camera) {
+            self.settings.settings.plugins.octobullet.cameras.sources.remove(camera);
+        };
+
+        self.onSettingsShown = function() {
+            $.ajax({
+                url: API_BASEURL + "plugin/octobullet",
+                type: "GET",
+                dataType: "json",
+                success: function(response) {
+                    self.connectionStatus(response.connection);
+                }
+            });
+        };
+
+        self.onDataUpdaterPluginMessage = function(plugin, data) {
+            if (plugin !== "octobullet" || data.type !== "connection") {
+                return;
+            }
+
+            // reconnects after a settings save happen in the background, this is their outcome
+            self.connectionStatus(data.status);
+        };
+
         self.sendTestMessage = function() {
             self.busy(true);
             $.ajax({
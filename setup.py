@@ -59,7 +59,14 @@ plugin_ignored_packages = []
 # Example:
 #     plugin_requires = ["someDependency==dev"]
 #     additional_setup_parameters = {"dependency_links": ["https://github.com/someUser/someRepo/archive/master.zip#egg=someDependency-dev"]}
-additional_setup_parameters = {}
+additional_setup_parameters = {
+	# Pillow allows rotating/flipping snapshots in-process instead of through ffmpeg, aiohttp enables the
+	# asyncio delivery backend
+	"extras_require": {"pillow": ["Pillow"], "asyncio": ["aiohttp"]},
+
+	# standalone relay process for relay mode
+	"entry_points": {"console_scripts": ["octobullet-relay = octoprint_octobullet.relay:main"]}
+}
 
 # README/long description file to use for PyPi uploads. Must be the full absolute path. If the filename ends on
 # .md and pypandoc is installed a conversion from Markdown to ReStructured Text will be performed utilizing